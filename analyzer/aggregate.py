@@ -0,0 +1,248 @@
+"""
+This module contains the per-IP table the other analysis functions
+derive their results from, so that a stream only has to be walked
+once, however many of them are called on it.
+
+During a live capture, StreamingAggregates keeps the table up to date
+as packets are placed into and evicted from the capture buffer, so
+that refreshing the analysis only costs as much as the packets that
+changed, rather than the whole buffer.
+"""
+
+from analyzer.dns_index import get_resp_ips
+from analyzer.security import SecurityCounters
+from capturer import enrichment
+from capturer.p0f_proxy import get_security_info_batch
+
+import collections
+import copy
+import threading
+
+def build_ip_table(stream, dns_index=None):
+    """
+    Returns an IPTable of the packets in the provided stream.
+    """
+    ip_table = IPTable(dns_index)
+    for packet in stream:
+        ip_table.add_packet(packet)
+    return ip_table
+
+class IPTable:
+    """
+    Statistics on every IP address used as a source or destination in
+    a stream of packets, gathered in a single pass over the stream.
+    Packets may also be removed again, oldest first (see remove_packet).
+
+    The dictionaries below are ordered by when each address was first
+    added (as a source before a destination, for the same packet):
+        packet_counts:  number of packets each address is used in
+        traffic_sizes:  total length of the packets each address is used in
+        first_seen / last_seen:  timestamps of the first and last of them
+        fqdns:  set of the fully qualified domain names of the DNS
+            responses that resolved to each address (only for
+            addresses seen in an answer of a DNS response)
+
+    dns_index is the DNSIndex the names of the other addresses may be
+    looked up in (see analyzer.ip.get_ip_to_fqdns), or None.
+
+    The country name and security info of each address are looked up
+    (in one batch each) the first time they are needed.
+    """
+
+    def __init__(self, dns_index=None):
+        self.dns_index = dns_index
+        self.packet_counts = {}
+        self.traffic_sizes = {}
+        self.fqdns = {}
+        # IP -> deque of the timestamps of its packets, and
+        # IP -> {fqdn: number of DNS responses}, so that
+        # packets can be removed again
+        self._timestamps = {}
+        self._fqdn_counts = {}
+        self._country_names = None
+        self._security_info = None
+        self._derived = {}
+
+    def add_packet(self, packet):
+        """
+        Adds the provided packet to the statistics of its addresses.
+        """
+        packet_counts = self.packet_counts
+        traffic_sizes = self.traffic_sizes
+        length = packet.length
+        timestamp = packet.timestamp
+        for ip in (packet.src_addr, packet.dst_addr):
+            if ip in packet_counts:
+                packet_counts[ip] += 1
+                traffic_sizes[ip] += length
+                self._timestamps[ip].append(timestamp)
+            else:
+                packet_counts[ip] = 1
+                traffic_sizes[ip] = length
+                self._timestamps[ip] = collections.deque([timestamp])
+
+        for resp_ip in get_resp_ips(packet):
+            if resp_ip in self.fqdns:
+                self.fqdns[resp_ip].update(packet.dns_query_names)
+            else:
+                self.fqdns[resp_ip] = set(packet.dns_query_names)
+                self._fqdn_counts[resp_ip] = {}
+            fqdn_counts = self._fqdn_counts[resp_ip]
+            for fqdn in packet.dns_query_names:
+                fqdn_counts[fqdn] = fqdn_counts.get(fqdn, 0) + 1
+
+        self._invalidate()
+
+    def remove_packet(self, packet):
+        """
+        Removes the provided packet from the statistics of its
+        addresses. Packets must be removed in the order they were
+        added, as a ring buffer evicts them.
+        """
+        packet_counts = self.packet_counts
+        for ip in (packet.src_addr, packet.dst_addr):
+            if packet_counts[ip] > 1:
+                packet_counts[ip] -= 1
+                self.traffic_sizes[ip] -= packet.length
+                self._timestamps[ip].popleft()
+            else:
+                del packet_counts[ip]
+                del self.traffic_sizes[ip]
+                del self._timestamps[ip]
+
+        for resp_ip in get_resp_ips(packet):
+            fqdn_counts = self._fqdn_counts[resp_ip]
+            for fqdn in packet.dns_query_names:
+                if fqdn_counts[fqdn] > 1:
+                    fqdn_counts[fqdn] -= 1
+                else:
+                    del fqdn_counts[fqdn]
+                    self.fqdns[resp_ip].discard(fqdn)
+            if not fqdn_counts:
+                del self._fqdn_counts[resp_ip]
+                del self.fqdns[resp_ip]
+
+        self._invalidate()
+
+    def copy(self, removable=True):
+        """
+        Returns a copy of the table, which packets can be added
+        to and removed from independently of this one.
+
+        If removable is False, only the first and last timestamp of
+        each address are copied, so the copy costs as much as the
+        number of addresses rather than the number of packets, but
+        packets can no longer be removed from it.
+        """
+        ip_table = copy.copy(self)
+        ip_table.packet_counts = dict(self.packet_counts)
+        ip_table.traffic_sizes = dict(self.traffic_sizes)
+        ip_table.fqdns = {ip: set(fqdns) for ip, fqdns in self.fqdns.items()}
+        if removable:
+            ip_table._timestamps = {ip: collections.deque(timestamps)
+                    for ip, timestamps in self._timestamps.items()}
+        else:
+            ip_table._timestamps = {ip: collections.deque((timestamps[0],
+                    timestamps[-1])) for ip, timestamps in
+                    self._timestamps.items()}
+        ip_table._fqdn_counts = {ip: dict(fqdn_counts)
+                for ip, fqdn_counts in self._fqdn_counts.items()}
+        ip_table._derived = dict(self._derived)
+        return ip_table
+
+    @property
+    def first_seen(self):
+        return {ip: timestamps[0]
+                for ip, timestamps in self._timestamps.items()}
+
+    @property
+    def last_seen(self):
+        return {ip: timestamps[-1]
+                for ip, timestamps in self._timestamps.items()}
+
+    def get_host_ip_addr(self):
+        """
+        Returns the host IP address (the address used in every
+        packet), or None, if one cannot be guessed.
+        """
+        for addr, count in self.packet_counts.items():
+            if count >= len(self.packet_counts):
+                return addr
+        return None
+
+    def get_country_names(self):
+        """
+        Returns a dictionary relating each address to its country
+        name (see enrichment.get_country_names).
+        """
+        if self._country_names is None:
+            self._country_names = enrichment.get_country_names(
+                    self.packet_counts)
+        return self._country_names
+
+    def get_security_info(self):
+        """
+        Returns a dictionary relating each address to its security
+        info (see enrichment.get_security_info), or None if it has none.
+        """
+        if self._security_info is None:
+            if enrichment.watcher_thread:
+                self._security_info = {ip: enrichment.get_security_info(ip)
+                        for ip in self.packet_counts}
+            else:
+                self._security_info = get_security_info_batch(
+                        self.packet_counts)
+        return self._security_info
+
+    def get_derived(self, name, compute):
+        """
+        Returns the result of compute() stored under the provided name,
+        calling it only the first time the name is asked for (until the
+        next packet is added). Lets the analysis functions share results
+        they would otherwise each derive from the table again.
+        """
+        if name not in self._derived:
+            self._derived[name] = compute()
+        return self._derived[name]
+
+    def _invalidate(self):
+        self._country_names = None
+        self._security_info = None
+        self._derived = {}
+
+class StreamingAggregates:
+    """
+    Buffer listener (see PacketBuffer.add_listener) that keeps an
+    IPTable and SecurityCounters of the packets in the capture buffer
+    up to date as packets are placed into and evicted from it. The
+    table is given the provided DNSIndex (see IPTable), if any.
+
+    The analysis functions should be given the copies returned by
+    snapshot, as the capture thread keeps changing the originals.
+    """
+
+    def __init__(self, dns_index=None):
+        self._lock = threading.Lock()
+        self.ip_table = IPTable(dns_index)
+        self.security_counters = SecurityCounters()
+
+    def on_append(self, tsa_packet):
+        with self._lock:
+            self.ip_table.add_packet(tsa_packet)
+            self.security_counters.add_packet(tsa_packet)
+
+    def on_evict(self, tsa_packet):
+        with self._lock:
+            self.ip_table.remove_packet(tsa_packet)
+            self.security_counters.remove_packet(tsa_packet)
+
+    def snapshot(self):
+        """
+        Returns an (ip_table, security_counters) tuple of copies of
+        the current aggregates, which packets can't be removed from.
+        Copying costs as much as the number of addresses, not the
+        number of packets.
+        """
+        with self._lock:
+            return (self.ip_table.copy(removable=False),
+                    self.security_counters.copy())
@@ -2,10 +2,10 @@
 This module contains country related analysis functions
 """
 
-from capturer.geoip_proxy import get_country_name
+from analyzer.aggregate import build_ip_table
 from analyzer.ip import get_host_ip_addr, get_ip_to_packet_count, get_ip_to_total_traffic_size, UNKNOWN, PACKET_COUNT, TRAFFIC_SIZE
 
-def get_country_to_packet_count(stream):
+def get_country_to_packet_count(stream, ip_table=None):
     """
     Counts the number of packets the host has sent to or received
     from different countries. If an ip address cannot be mapped to
@@ -13,21 +13,26 @@ def get_country_to_packet_count(stream):
 
     Args:
         packets (list): List of TSAPacket objects
+        ip_table (IPTable): IPTable of the packets, if already built
 
     Returns:
         A dictionary where the keys are names of countries and the
         values are the number of packets from / to that country.
     """
 
+    if ip_table is None:
+        ip_table = build_ip_table(stream)
+
     # Get dictionary of ip addresses to counts, minus host IP address
-    ip_counts = get_ip_to_packet_count(stream)
-    host_ip_addr = get_host_ip_addr(stream, ip_counts)
+    ip_counts = get_ip_to_packet_count(stream, ip_table)
+    host_ip_addr = get_host_ip_addr(stream, ip_counts, ip_table)
     ip_counts.pop(host_ip_addr, None)
 
     # Coalesce country packet counts using ip count dict
     country_counts = {UNKNOWN: 0}
+    ip_countries = ip_table.get_country_names()
     for ip, count in ip_counts.items():
-        country_name = get_country_name(ip)
+        country_name = ip_countries[ip]
         if country_name:
             if country_name in country_counts:
                 country_counts[country_name] += count
@@ -39,7 +44,7 @@ def get_country_to_packet_count(stream):
     return country_counts
 
 
-def get_country_to_traffic_size(stream):
+def get_country_to_traffic_size(stream, ip_table=None):
     """
     Size of traffic in bytes that the host has sent to or received
     from different countries. If an ip address cannot be mapped to
@@ -47,6 +52,7 @@ def get_country_to_traffic_size(stream):
 
     Args:
         packets (list): List of TSAPacket objects
+        ip_table (IPTable): IPTable of the packets, if already built
 
     Returns:
         A dictionary where the keys are names of countries and the
@@ -54,15 +60,19 @@ def get_country_to_traffic_size(stream):
         to that country.
     """
 
+    if ip_table is None:
+        ip_table = build_ip_table(stream)
+
     # Get dictionary of ip addresses to counts, minus host IP address
-    ip_traffic_size = get_ip_to_total_traffic_size(stream)
-    host_ip_addr = get_host_ip_addr(stream)
+    ip_traffic_size = get_ip_to_total_traffic_size(stream, ip_table)
+    host_ip_addr = get_host_ip_addr(stream, ip_table=ip_table)
     ip_traffic_size.pop(host_ip_addr, None)
 
     # Coalesce country packet counts using ip count dict
     country_traffic_sizes = {UNKNOWN: 0}
+    ip_countries = ip_table.get_country_names()
     for ip, traffic_size in ip_traffic_size.items():
-        country_name = get_country_name(ip)
+        country_name = ip_countries[ip]
         if country_name:
             if country_name in country_traffic_sizes:
                 country_traffic_sizes[country_name] += traffic_size
@@ -75,20 +85,24 @@ def get_country_to_traffic_size(stream):
 
 
 
-def consolidate_country_data(stream):
+def consolidate_country_data(stream, ip_table=None):
     """
     Consolidates all known country data
 
     Args:
         stream (TSAStream object): List of TSAPacket objects
+        ip_table (IPTable): IPTable of the packets, if already built
 
     Returns:
         A dictionary mapping each country to a dictionary of data,
         ex: {"USA": {"Packet Count": 50, "Traffic Size": 1200}}
     """   
+    if ip_table is None:
+        ip_table = build_ip_table(stream)
+
     country_data = {}
-    country_traffic_size = get_country_to_traffic_size(stream)
-    country_packet_count = get_country_to_packet_count(stream)
+    country_traffic_size = get_country_to_traffic_size(stream, ip_table)
+    country_packet_count = get_country_to_packet_count(stream, ip_table)
 
     for country in country_traffic_size:
         data = {}
@@ -2,57 +2,68 @@
 This module contains dns / hostname related analysis functions.
 """
 
+from analyzer.aggregate import build_ip_table
 from analyzer.ip import get_host_ip_addr, get_ip_to_packet_count, \
         get_ip_to_fqdns, get_ip_to_security_info, get_ip_to_total_traffic_size, \
-        get_ip_to_country_name, aggregate_on_dns, \
+        get_ip_to_country_name, get_domain_aliases, aggregate_on_dns, \
         PACKET_COUNT, TRAFFIC_SIZE, SECURITY_INFO, COUNTRY_NAMES
 
-def get_tldn_to_packet_count(stream):
+def get_tldn_to_packet_count(stream, ip_table=None):
     """
     Counts the number of packets the host has sent to or received from each
     Fully Qualified Domain Name (fqdns), aggregated.
 
     Args:
         packets (list): List of TSAPacket objects
+        ip_table (IPTable): IPTable of the packets, if already built
 
     Returns:
         A dictionary where the keys are tld domains and the values are the
     number of packets from / to that tld domain.
     """
 
+    if ip_table is None:
+        ip_table = build_ip_table(stream)
+
     # Get dictionary of ip addrs to counts / fqdns, minus host IP address
-    ip_counts = get_ip_to_packet_count(stream)
-    ip_fqdns = get_ip_to_fqdns(stream)
-    host_ip_addr = get_host_ip_addr(stream, ip_counts)
+    ip_counts = get_ip_to_packet_count(stream, ip_table)
+    ip_fqdns = get_ip_to_fqdns(stream, ip_table)
+    host_ip_addr = get_host_ip_addr(stream, ip_counts, ip_table)
     ip_counts.pop(host_ip_addr, None)
 
-    fqdn_alias_count = aggregate_on_dns(ip_counts, ip_fqdns)
+    fqdn_alias_count = aggregate_on_dns(ip_counts, ip_fqdns,
+            aliases=get_domain_aliases(stream, ip_table))
 
     return fqdn_alias_count
 
 
-def get_tldn_to_traffic_size(stream):
+def get_tldn_to_traffic_size(stream, ip_table=None):
     """
     Computes the size of traffic in bytes that  the host has sent to or
     received from each Fully Qualified Domain Name (fqdns), aggregated.
 
     Args:
         packets (list): List of TSAPacket objects
+        ip_table (IPTable): IPTable of the packets, if already built
 
     Returns:
         A dictionary where the keys are tld domains and the values are the
         size of traffic received from / to that tld domain.
     """
-    ip_traffic_size = get_ip_to_total_traffic_size(stream)
-    ip_fqdns = get_ip_to_fqdns(stream)
-    host_ip_addr = get_host_ip_addr(stream)
+    if ip_table is None:
+        ip_table = build_ip_table(stream)
+
+    ip_traffic_size = get_ip_to_total_traffic_size(stream, ip_table)
+    ip_fqdns = get_ip_to_fqdns(stream, ip_table)
+    host_ip_addr = get_host_ip_addr(stream, ip_table=ip_table)
     ip_traffic_size.pop(host_ip_addr, None)
 
-    fqdn_alias_count = aggregate_on_dns(ip_traffic_size, ip_fqdns)
+    fqdn_alias_count = aggregate_on_dns(ip_traffic_size, ip_fqdns,
+            aliases=get_domain_aliases(stream, ip_table))
 
     return fqdn_alias_count
 
-def get_tldn_to_security_info(stream):
+def get_tldn_to_security_info(stream, ip_table=None):
     """
     Returns a dictionary relating Top Level Domain Names (tldn) to
     dictionaries containing security info gathered by p0f.
@@ -68,45 +79,57 @@ def get_tldn_to_security_info(stream):
         num_hops:  network distance in packet hops
         uptime:  estimated uptime of the system (in minutes)
     """
-    ip_security_info = get_ip_to_security_info(stream)
-    ip_fqdn = get_ip_to_fqdns(stream)
-    host_ip_addr = get_host_ip_addr(stream)
+    if ip_table is None:
+        ip_table = build_ip_table(stream)
+
+    ip_security_info = get_ip_to_security_info(stream, ip_table)
+    ip_fqdn = get_ip_to_fqdns(stream, ip_table)
+    host_ip_addr = get_host_ip_addr(stream, ip_table=ip_table)
     ip_security_info.pop(host_ip_addr, None)
 
     tldn_security_info = aggregate_on_dns(ip_security_info, ip_fqdn,
-                                          is_numeric=False)
+                                          is_numeric=False,
+                                          aliases=get_domain_aliases(stream,
+                                              ip_table))
 
     return tldn_security_info
 
-def get_tldn_to_country_names(stream):
+def get_tldn_to_country_names(stream, ip_table=None):
     """
     Returns a dictionary relating Top Level Domain Names (tldn) to
     a list of country names its servers are believed to be in.
 
     Args:
         packets (list): List of TSAPacket objects
+        ip_table (IPTable): IPTable of the packets, if already built
 
     Returns:
         A dictionary where the keys are tld domains and the values are lists
         of country names
 
     """
-    ip_country_names = get_ip_to_country_name(stream)
-    ip_fqdns = get_ip_to_fqdns(stream)
-    host_ip_addr = get_host_ip_addr(stream)
+    if ip_table is None:
+        ip_table = build_ip_table(stream)
+
+    ip_country_names = get_ip_to_country_name(stream, ip_table)
+    ip_fqdns = get_ip_to_fqdns(stream, ip_table)
+    host_ip_addr = get_host_ip_addr(stream, ip_table=ip_table)
     ip_country_names.pop(host_ip_addr, None)
 
     tldn_country_names = aggregate_on_dns(ip_country_names, ip_fqdns,
-                                         is_numeric=False)
+                                         is_numeric=False,
+                                         aliases=get_domain_aliases(stream,
+                                             ip_table))
 
     return tldn_country_names
 
-def consolidate_fqdn_data(stream):
+def consolidate_fqdn_data(stream, ip_table=None):
     """
     Consolidates all known tldn data
 
     Args:
         stream (TSAStream object): List of TSAPacket objects
+        ip_table (IPTable): IPTable of the packets, if already built
 
     Returns:
         A dictionary mapping each domain to a dictionary of data,
@@ -125,11 +148,14 @@ def consolidate_fqdn_data(stream):
         uptime:  estimated uptime of the system (in minutes)
 
     """   
+    if ip_table is None:
+        ip_table = build_ip_table(stream)
+
     tldn_data = {}
-    tldn_traffic_size = get_tldn_to_traffic_size(stream)
-    tldn_packet_count = get_tldn_to_packet_count(stream)
-    tldn_security_info = get_tldn_to_security_info(stream)
-    tldn_country_names = get_tldn_to_country_names(stream)
+    tldn_traffic_size = get_tldn_to_traffic_size(stream, ip_table)
+    tldn_packet_count = get_tldn_to_packet_count(stream, ip_table)
+    tldn_security_info = get_tldn_to_security_info(stream, ip_table)
+    tldn_country_names = get_tldn_to_country_names(stream, ip_table)
 
     for tldn in tldn_traffic_size:
         data = {}
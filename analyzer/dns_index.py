@@ -0,0 +1,166 @@
+"""
+This module contains the index of the fully qualified domain names
+that IP addresses were resolved from.
+
+During a live capture, DNSIndex is fed the DNS responses in the capture
+as packets are captured, so that addresses can still be related to
+domain names after the responses naming them have been evicted from
+the capture buffer. Names expire once the TTL of the answer they came
+in has passed (by the timestamps of the packets fed to the index),
+and the least recently used addresses are evicted once the index is
+estimated to use more memory than its limit.
+"""
+
+from datetime import datetime, timedelta
+
+import collections
+import sys
+import threading
+
+# Rough memory use (in bytes) of each address's entry in the index,
+# and of each name in an entry, not counting the strings themselves
+ENTRY_OVERHEAD = 400
+NAME_OVERHEAD = 150
+
+def get_resp_ips(packet):
+    """
+    Returns a list of the addresses of the A and AAAA answers of the
+    provided packet (or of its dns_resp_ip, for packets parsed without
+    dns_resp_ips), which is empty if it isn't a DNS response with any.
+    """
+    if packet.dns_resp_ips:
+        return packet.dns_resp_ips
+    if packet.dns_resp_ip:
+        return [packet.dns_resp_ip]
+    return []
+
+class DNSIndex:
+    """
+    Buffer listener (see PacketBuffer.add_listener) relating the
+    addresses in the A and AAAA answers of DNS responses to the names
+    queried in them. Packets evicted from the buffer stay indexed.
+
+    Each name expires ttl seconds after the response it came in, where
+    ttl is the response's dns_resp_ttl, but at least min_ttl. Responses
+    without a TTL never expire. Once the index is estimated to use more
+    than max_bytes (if not None), the addresses that were least
+    recently added or looked up are evicted.
+    """
+
+    def __init__(self, max_bytes=None, min_ttl=0):
+        self._lock = threading.Lock()
+        # IP address -> {fqdn: expiry time}, least recently used first
+        self._entries = collections.OrderedDict()
+        self._num_bytes = 0
+        self.max_bytes = max_bytes
+        self.min_ttl = min_ttl
+        # Latest timestamp of the packets added, which
+        # is the current time as far as expiry goes
+        self.current_time = None
+        self.num_expired = 0
+        self.num_evicted = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def num_bytes(self):
+        """
+        Estimated memory use of the index, in bytes.
+        """
+        with self._lock:
+            return self._num_bytes
+
+    def add_packet(self, packet):
+        """
+        Indexes the answers of the provided packet, if it is a DNS
+        response, and advances the current time to its timestamp.
+        """
+        timestamp = packet.timestamp
+        resp_ips = get_resp_ips(packet)
+        with self._lock:
+            if self.current_time is None or timestamp > self.current_time:
+                self.current_time = timestamp
+            if not resp_ips or not packet.dns_query_names:
+                self._expire_oldest()
+                return
+
+            if packet.dns_resp_ttl is None:
+                expiry = datetime.max
+            else:
+                expiry = timestamp + timedelta(seconds=max(
+                        packet.dns_resp_ttl, self.min_ttl))
+            for ip in resp_ips:
+                entry = self._entries.get(ip)
+                if entry is None:
+                    entry = {}
+                    self._entries[ip] = entry
+                    self._num_bytes += sys.getsizeof(ip) + ENTRY_OVERHEAD
+                else:
+                    self._entries.move_to_end(ip)
+                for fqdn in packet.dns_query_names:
+                    if fqdn not in entry:
+                        entry[fqdn] = expiry
+                        self._num_bytes += sys.getsizeof(fqdn) + NAME_OVERHEAD
+                    elif entry[fqdn] < expiry:
+                        entry[fqdn] = expiry
+
+            self._expire_oldest()
+            while self.max_bytes is not None and \
+                    self._num_bytes > self.max_bytes and self._entries:
+                (ip, entry) = self._entries.popitem(last=False)
+                self._num_bytes -= _get_entry_size(ip, entry)
+                self.num_evicted += 1
+
+    def on_append(self, tsa_packet):
+        self.add_packet(tsa_packet)
+
+    def on_evict(self, tsa_packet):
+        pass
+
+    def get_fqdns(self, ip):
+        """
+        Returns the set of the names the provided address was resolved
+        from that have not expired, or None if there are none.
+        """
+        with self._lock:
+            entry = self._entries.get(ip)
+            if entry is None:
+                return None
+            self._remove_expired(ip, entry)
+            if not entry:
+                return None
+            self._entries.move_to_end(ip)
+            return set(entry)
+
+    def _remove_expired(self, ip, entry):
+        """
+        Removes the expired names of the provided entry, and
+        the entry itself if all of its names have expired.
+        """
+        expired = [fqdn for fqdn, expiry in entry.items()
+                if expiry <= self.current_time]
+        for fqdn in expired:
+            del entry[fqdn]
+            self._num_bytes -= sys.getsizeof(fqdn) + NAME_OVERHEAD
+        self.num_expired += len(expired)
+        if not entry:
+            del self._entries[ip]
+            self._num_bytes -= sys.getsizeof(ip) + ENTRY_OVERHEAD
+
+    def _expire_oldest(self):
+        """
+        Removes the least recently used entries whose names have all
+        expired, stopping at the first with a name that hasn't, so
+        expired entries don't wait to be evicted to free their memory.
+        """
+        while self._entries:
+            (ip, entry) = next(iter(self._entries.items()))
+            if max(entry.values()) > self.current_time:
+                break
+            self._remove_expired(ip, entry)
+
+def _get_entry_size(ip, entry):
+    return sys.getsizeof(ip) + ENTRY_OVERHEAD + sum(sys.getsizeof(fqdn) +
+            NAME_OVERHEAD for fqdn in entry)
@@ -0,0 +1,105 @@
+"""
+Maps host names to their registered domain names: the public suffix
+of the name (e.g. "co.uk") and the label in front of it, as in
+"bbc.co.uk" for "www.news.bbc.co.uk".
+
+Names are matched against a trie of the labels of the public suffix
+list that ships with tld, from the last label to the first, giving
+the same results as tld.get_tld (with fix_protocol set) without
+parsing each name as a URL. Anything that isn't a plain host name
+(e.g. a URL, a name with a port, or a non-ASCII name) is passed to
+tld.get_tld instead. Results are kept in an LRU cache.
+"""
+
+from tld import get_tld
+from tld.utils import get_tld_names
+
+import functools
+import re
+
+# Number of names whose registered domains are cached
+CACHE_MAX_ENTRIES = 65536
+
+# Lowercased names made up only of these characters are looked up
+# in the trie, as tld would find them unchanged after URL parsing
+HOST_NAME_PATTERN = re.compile(r'[a-z0-9_*.-]+\Z')
+
+# Key marking the trie nodes that end a public suffix list entry
+_END = None
+
+# Trie of the public suffix list entries: label -> child node,
+# starting from the last label of each entry
+_suffix_trie = None
+
+@functools.lru_cache(maxsize=CACHE_MAX_ENTRIES)
+def get_registered_domain(host_name):
+    """
+    Returns the registered domain name (string) of the provided
+    host name (or URL), or None if it doesn't have a public suffix.
+    """
+    name = host_name.lower()
+    if not HOST_NAME_PATTERN.match(name):
+        res = get_tld(host_name, as_object=True, fail_silently=True,
+                      fix_protocol=True)
+        return None if res is None else str(res)
+
+    labels = name.split('.')
+    index = _find_suffix(labels)
+    if index is None:
+        return None
+    # A name that is a public suffix itself is its own domain
+    index = max(1, index)
+    return "{0}.{1}".format(labels[index - 1], ".".join(labels[index:]))
+
+def _find_suffix(labels):
+    """
+    Returns the index of the first of the provided labels that starts
+    the longest public suffix of them, or None if none of them do.
+    As in tld, labels[i:] is a public suffix if the list has it as an
+    entry, or has a wildcard ("*.") or exception ("!") entry for it.
+    """
+    node = _get_suffix_trie()
+    index = None
+    # node is the trie node of labels[i + 1:]
+    for i in range(len(labels) - 1, -1, -1):
+        label = labels[i]
+        child = node.get(label)
+        if (child is not None and _END in child) or \
+                _END in node.get('*', ()) or \
+                _END in node.get('!' + label, ()):
+            index = i
+        if child is None:
+            break
+        node = child
+    return index
+
+def _get_suffix_trie():
+    global _suffix_trie
+    if _suffix_trie is None:
+        trie = {}
+        tld_names = get_tld_names()
+        if isinstance(tld_names, dict):
+            # Later versions of tld return their own tries of the
+            # entries (by list file) rather than the entries
+            for tld_trie in tld_names.values():
+                _copy_tld_trie_node(tld_trie.root, trie)
+        else:
+            for entry in tld_names:
+                node = trie
+                for label in reversed(entry.split('.')):
+                    node = node.setdefault(label, {})
+                node[_END] = True
+        _suffix_trie = trie
+    return _suffix_trie
+
+def _copy_tld_trie_node(tld_node, node):
+    """
+    Adds the entries under the provided tld.trie.TrieNode to the
+    provided node of the suffix trie.
+    """
+    if tld_node.leaf:
+        node[_END] = True
+    if tld_node.exception:
+        node.setdefault('!' + tld_node.exception, {})[_END] = True
+    for label, tld_child in (tld_node.children or {}).items():
+        _copy_tld_trie_node(tld_child, node.setdefault(label, {}))
@@ -2,9 +2,8 @@
 This module contains IP related analysis functions.
 """
 
-from capturer.p0f_proxy import get_security_info
-from capturer.geoip_proxy import get_country_name
-from tld import get_tld
+from analyzer.aggregate import build_ip_table
+from analyzer.domain_names import get_registered_domain
 
 #Constants
 UNKNOWN = "Unknown"
@@ -14,84 +13,80 @@ TRAFFIC_SIZE = "Traffic Size"
 SECURITY_INFO = "Security Info"
 COUNTRY_NAMES = "Country Names"
 
-# cache of ip to fqdns
-ip_fqdns_cache = {}
-
-def get_host_ip_addr(stream, ip_counts=None):
+def get_host_ip_addr(stream, ip_counts=None, ip_table=None):
     """
     Returns the host IP address from a stream of packets,
     or None, if one cannot be guessed.
 
     If dictionary of ip addresses to packet counts is provided,
     that is used instead of recalculated for efficiency.
+    Likewise if an IPTable of the stream is provided (see
+    analyzer.aggregate), which the other functions in this
+    module accept too.
 
     Host IP address must appear in each packet at least once.
     """
     if not ip_counts:
-        ip_counts = get_ip_to_packet_count(stream)
+        if ip_table is None:
+            ip_table = build_ip_table(stream)
+        return ip_table.get_host_ip_addr()
     for addr, count in ip_counts.items():
         if count >= len(ip_counts):
             return addr
     return None
 
-def get_ip_to_packet_count(stream):
+def get_ip_to_packet_count(stream, ip_table=None):
     """
     Returns a dictionary relating IP addresses to the
     number of times they are used as a source or
     destination address in the provided stream.
     """
-    ip_counts = {}
-    for packet in stream:
-        src = packet.src_addr
-        dst = packet.dst_addr
-        ip_counts[src] = ip_counts[src] + 1 if src in ip_counts else 1
-        ip_counts[dst] = ip_counts[dst] + 1 if dst in ip_counts else 1
-    return ip_counts
+    if ip_table is None:
+        ip_table = build_ip_table(stream)
+    return dict(ip_table.packet_counts)
 
-def get_ip_to_fqdns(stream):
+def get_ip_to_fqdns(stream, ip_table=None):
     """
     Returns a dictionary relating IP addresses to a set
     of all fully qualified domain names that use them in
     the provided stream.
 
+    Addresses that are not in an answer of a DNS response in the
+    stream are looked up in the IPTable's DNS index (see
+    analyzer.dns_index), if it has one, which holds the names of
+    the unexpired answers seen earlier in the capture.
     """
-    global ip_fqdns_cache
-
-    ip_fqdns = {}
-    for packet in stream:
-        if packet.dns_resp_ip:
-            resp_ip = packet.dns_resp_ip
-            if resp_ip in ip_fqdns:
-                ip_fqdns[resp_ip].update(packet.dns_query_names)
-            else:
-                ip_fqdns[resp_ip] = set(packet.dns_query_names)
-
-    ips = []
-    for packet in stream:
-        src = packet.src_addr
-        dst = packet.dst_addr
-        ips.extend([src, dst])
-
-    ips = set(ips)
-
-    # update the cache with new info
-    for ip, fqdns in ip_fqdns.items():
-        ip_fqdns_cache[ip] = set(fqdns)
-
-    # use cache to add missing info to result
-    for ip in ips:
-        if ip not in ip_fqdns and ip in ip_fqdns_cache:
-            ip_fqdns[ip] = set(ip_fqdns_cache[ip])
-
+    if ip_table is None:
+        ip_table = build_ip_table(stream)
+    # The sets are shared with the table, so they are not copied
+    # for every call (none of the callers modify them)
+    return dict(ip_table.get_derived('ip_fqdns',
+            lambda: _get_ip_fqdns(ip_table)))
+
+def _get_ip_fqdns(ip_table):
+    """
+    Returns the fqdns of the provided IPTable, along with
+    those its DNS index has for the other addresses in it.
+    """
+    ip_fqdns = dict(ip_table.fqdns)
+    dns_index = ip_table.dns_index
+    if dns_index is not None:
+        for ip in ip_table.packet_counts:
+            if ip not in ip_fqdns:
+                fqdns = dns_index.get_fqdns(ip)
+                if fqdns:
+                    ip_fqdns[ip] = fqdns
     return ip_fqdns
 
-def get_ip_to_security_info(stream):
+def get_ip_to_security_info(stream, ip_table=None):
     """
     Returns a dictionary relating IP addresses to
     dictionaries containing security info gathered by p0f.
 
     If an IP address doesn't have any security information it
-    is not included in the dictionary
+    is not included in the dictionary. If its security information
+    is still being looked up (see capturer.enrichment), each of its
+    fields is enrichment.PENDING.
 
     Each dictionary containing security info will have the following fields,
     with missing or undetermined fields having a value of None:
@@ -104,63 +99,165 @@ def get_ip_to_security_info(stream):
         num_hops:  network distance in packet hops
         uptime:  estimated uptime of the system (in minutes)
     """
-    ip_security = {}
-    for packet in stream:
-        src = packet.src_addr
-        dst = packet.dst_addr
-        ips = [src, dst]
+    if ip_table is None:
+        ip_table = build_ip_table(stream)
 
-        for ip in ips:
-            if ip not in ip_security:
-                security_info = get_security_info(ip)
-                if security_info:
-                    ip_security[ip] = security_info
+    ip_security = {}
+    for ip, security_info in ip_table.get_security_info().items():
+        if security_info:
+            ip_security[ip] = security_info
 
     return ip_security
 
-def get_ip_to_country_name(stream):
+def get_ip_to_country_name(stream, ip_table=None):
     """
     Returns a dictionary relating IP addresses to the country
     that the server of each IP address is believed to be located in.
     If an ip address cannot be associated with a country UNKNOWN
-    is returned.
+    is returned, and if its country is still being looked up (see
+    capturer.enrichment), enrichment.PENDING is.
     """
+    if ip_table is None:
+        ip_table = build_ip_table(stream)
+
     ip_country = {}
-    for packet in stream:
-        src = packet.src_addr
-        dst = packet.dst_addr
-        ips = [src, dst]
-
-        for ip in ips:
-            if ip not in ip_country:
-                country_name = get_country_name(ip)
-                if country_name:
-                    ip_country[ip] = country_name
-                else:
-                    ip_country[ip] = UNKNOWN
+    for ip, country_name in ip_table.get_country_names().items():
+        if country_name:
+            ip_country[ip] = country_name
+        else:
+            ip_country[ip] = UNKNOWN
 
     return ip_country
 
 
-def get_ip_to_total_traffic_size(stream):
+def get_ip_to_total_traffic_size(stream, ip_table=None):
     """
     Returns a dictionary relating IP addresses to their total traffic size.
     Where total traffic size is the size of all the packets that the address
     is present in as a source or a destination in the provided stream.
     """
-    ip_traffic_size = {}
-    for packet in stream:
-        src = packet.src_addr
-        dst = packet.dst_addr
-        length = packet.length
-        ip_traffic_size[src] = ip_traffic_size[src] + length if src in ip_traffic_size else length
-        ip_traffic_size[dst] = ip_traffic_size[dst] + length if dst in ip_traffic_size else length
-    return ip_traffic_size
+    if ip_table is None:
+        ip_table = build_ip_table(stream)
+    return dict(ip_table.traffic_sizes)
+
+def get_domain_aliases(stream, ip_table=None):
+    """
+    Returns the DomainAliases of the domain names used by the IP
+    addresses in the provided stream, other than the host address.
+    They are only worked out once per IPTable, however many of the
+    aggregations (see aggregate_on_dns) they are passed to.
+    """
+    if ip_table is None:
+        ip_table = build_ip_table(stream)
+
+    def build():
+        ip_fqdns = get_ip_to_fqdns(stream, ip_table)
+        host_ip_addr = get_host_ip_addr(stream, ip_table=ip_table)
+        return build_domain_aliases(ip_fqdns, [ip for ip in
+                ip_table.packet_counts if ip != host_ip_addr])
+
+    return ip_table.get_derived('domain_aliases', build)
 
-def aggregate_on_dns(ip_values, ip_fqdns, is_numeric=True):
+def build_domain_aliases(ip_fqdns, ip_addrs):
+    """
+    Returns the DomainAliases of the domain names
+    used by the provided IP addresses.
+
+    Args:
+        ip_fqdns (dictionary): maps ip address to fqdns
+        ip_addrs (iterable): ip addresses to include
+    """
+    aliases = DomainAliases()
+    for ip in ip_addrs:
+        fqdns = ip_fqdns.get(ip, None)
+        if fqdns:
+            aliases.add_ip(ip, fqdns)
+    return aliases
+
+class DomainAliases:
+    """
+    Groups domain names into sets of aliases: two domains are
+    aliases if an IP address is used by both of them, or if
+    both are aliases of a third domain.
+
+    The sets are kept in a disjoint-set forest (with union by size
+    and path compression), so adding an address costs close to
+    linear time in the number of its domains, however many domains
+    share it. Each set is labelled with the sorted, comma separated
+    names of its domains.
+    """
+
+    def __init__(self):
+        # domain -> parent domain (itself, for the root of a set),
+        # and root -> number of domains in its set
+        self._parents = {}
+        self._sizes = {}
+        # root -> label, worked out the first time one is asked for
+        self._labels = None
+        # ip address -> one of the domains it is used by
+        self.ip_domains = {}
+
+    def add_ip(self, ip, fqdns):
+        """
+        Makes the domains of the provided fqdns, which
+        use the provided IP address, aliases of each other.
+        """
+        domains = [str(get_registered_domain(fqdn)) for fqdn in fqdns]
+        self.ip_domains[ip] = domains[0]
+        for domain in domains:
+            self.union(domains[0], domain)
+
+    def find(self, domain):
+        """
+        Returns the root of the set of the provided domain,
+        adding it in a set of its own if it is new.
+        """
+        parents = self._parents
+        if domain not in parents:
+            parents[domain] = domain
+            self._sizes[domain] = 1
+            self._labels = None
+            return domain
+
+        root = domain
+        while parents[root] != root:
+            root = parents[root]
+        # Point the whole path at the root
+        while parents[domain] != root:
+            (parents[domain], domain) = (root, parents[domain])
+        return root
+
+    def union(self, domain1, domain2):
+        """
+        Merges the sets of the provided domains.
+        """
+        root1 = self.find(domain1)
+        root2 = self.find(domain2)
+        if root1 == root2:
+            return
+        if self._sizes[root1] < self._sizes[root2]:
+            (root1, root2) = (root2, root1)
+        self._parents[root2] = root1
+        self._sizes[root1] += self._sizes.pop(root2)
+        self._labels = None
+
+    def get_label(self, domain):
+        """
+        Returns the label of the set of the provided domain.
+        """
+        if self._labels is None:
+            members = {}
+            for member in self._parents:
+                members.setdefault(self.find(member), []).append(member)
+            self._labels = {root: ", ".join(sorted(domains))
+                    for root, domains in members.items()}
+        return self._labels[self.find(domain)]
+
+def aggregate_on_dns(ip_values, ip_fqdns, is_numeric=True, aliases=None):
     """
     Aggregates the values in ip_values based on domains accessed from
-    ip_fqdns. Values from same ip_addresses same domain names are combines
+    ip_fqdns. Values of ip addresses used by domains that are aliases
+    of each other (see DomainAliases) are combined.
 
     Args:
         ip_values (dictionary): maps ip address to some computed value
@@ -169,68 +266,33 @@ def aggregate_on_dns(ip_values, ip_fqdns, is_numeric=True):
 
         is_numeric (boolean): are the values numeric? If so, add the values,
                               else create a list of values.
+        aliases (DomainAliases): the aliases of the domains in ip_fqdns,
+                                 if already built (see get_domain_aliases).
+                                 It is not modified: ip addresses it
+                                 doesn't cover are aggregated as unknown.
 
     Returns:
-        a dictionary mapping tld domains to the values in ip_values,
-        aggregated as sums or as a list.
+        a dictionary mapping the labels of sets of aliased tld domains
+        to the values in ip_values, aggregated as sums or as a list.
     """
-    # Coalesce fqdn packet counts using ip values dict
-    fqdn_domain_values = {}
-    fqdn_domain_values[UNKNOWN] = 0 if is_numeric else []
-    fqdn_domain_aliases = {}
-    fqdn_domain_aliases[UNKNOWN] = {UNKNOWN}
+    if aliases is None:
+        aliases = build_domain_aliases(ip_fqdns, ip_values)
 
-    for ip, value in ip_values.items():
-        fqdns = ip_fqdns.get(ip, None)
+    fqdn_alias_values = {}
+    fqdn_alias_values[UNKNOWN] = 0 if is_numeric else []
 
-        if fqdns:
-            domain_set = set()
-            for fqdn in fqdns:
-                res = get_tld(fqdn, as_object=True, fail_silently=True,
-                              fix_protocol=True)
-                domain_set.add(str(res))
-            domain_set = list(domain_set)
-            # Add domains to domain counts, only adding first entry if multiple
-            domain = domain_set[0]
-            if domain in fqdn_domain_values:
-                if is_numeric:
-                    fqdn_domain_values[domain] += value
-                else:
-                    fqdn_domain_values[domain].append(value)
+    for ip, value in ip_values.items():
+        domain = aliases.ip_domains.get(ip, None)
+        alias_name = aliases.get_label(domain) if domain else UNKNOWN
+        if alias_name in fqdn_alias_values:
+            if is_numeric:
+                fqdn_alias_values[alias_name] += value
             else:
-                if is_numeric:
-                    fqdn_domain_values[domain] = value
-                else:
-                    fqdn_domain_values[domain] = [value]
-
-            # Add aliases for domains
-            for domain1 in domain_set:
-                if domain1 not in fqdn_domain_aliases:
-                    fqdn_domain_aliases[domain1] = {domain1}
-                for domain2 in domain_set:
-                    if domain2 not in fqdn_domain_aliases[domain1]:
-                        if (domain2 in fqdn_domain_aliases):
-                            for domain in fqdn_domain_aliases[domain2]:
-                                if domain != domain1:
-                                    if (domain in fqdn_domain_aliases):
-                                        fqdn_domain_aliases[domain] = fqdn_domain_aliases[domain].union(fqdn_domain_aliases[domain1])
-                                        fqdn_domain_aliases[domain1] = fqdn_domain_aliases[domain].union(fqdn_domain_aliases[domain1])
-                        fqdn_domain_aliases[domain1].add(domain2)
-
+                fqdn_alias_values[alias_name].append(value)
         else:
             if is_numeric:
-                fqdn_domain_values[UNKNOWN] += value
+                fqdn_alias_values[alias_name] = value
             else:
-                fqdn_domain_values[UNKNOWN].append(value)
-
-    fqdn_alias_count = {}
-    for domain in fqdn_domain_values:
-        alias_list = list(fqdn_domain_aliases[domain])
-        alias_list.sort()
-        alias_name = ", ".join(alias_list)
-        if alias_name in fqdn_alias_count:
-            fqdn_alias_count[alias_name] += fqdn_domain_values[domain]
-        else:
-            fqdn_alias_count[alias_name] = fqdn_domain_values[domain]
+                fqdn_alias_values[alias_name] = [value]
 
-    return fqdn_alias_count
+    return fqdn_alias_values
@@ -1,22 +1,56 @@
 """
 This module contains metrics related analysis functions
+
+During a live capture, RollupStore keeps per-second counters of the
+captured traffic (and coarser roll-ups of them) as packets arrive, so
+that the bandwidth and traffic volume of the capture can be graphed
+over windows longer than the packet buffer holds, at a fixed cost.
 """
 
+from datetime import datetime, timedelta
+
+import threading
+
+import numpy as np
+
 BANDWIDTH_DATA = "bandwidth"
 TRAFFIC_VOLUME_DATA = "traffic volume"
 AVERAGE_BANDWIDTH = "average bandwidth"
 
 MICROSECONDS_IN_SECONDS = 1000000
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+# Most buckets get_bandwidth_traffic_volume splits a stream into.
+# Narrower bucket widths are widened to stay under it.
+MAX_BUCKETS = 100000
 
-def get_bandwidth_traffic_volume(stream, buckets=50):
+# (resolution in seconds, number of slots) of each tier of a
+# RollupStore, finest first: an hour of seconds, six hours of
+# 10 seconds, a day of minutes, and a month of hours
+ROLLUP_TIERS = [(1, 3600), (10, 2160), (60, 1440), (3600, 720)]
+
+# Packet time stamps are naive datetimes, so the rollup slots are
+# counted from a naive epoch, which keeps them aligned to local time
+ROLLUP_EPOCH = datetime(1970, 1, 1)
+
+def get_bandwidth_traffic_volume(stream, buckets=50, bucket_width=None):
     """
     Calculates the bandwidth and traffic rate for the stream of packets
     from the lowest time stamp to the highest time stamp.
 
-    Granularity is determined using buckets
+    Granularity is determined using buckets: the time between the lowest
+    and highest time stamps is split into that many equal buckets, or,
+    if bucket_width is provided, into buckets bucket_width long. If the
+    buckets would be zero seconds long (e.g. if every packet has the
+    same time stamp), a single one second bucket is used instead. If
+    there would be more than MAX_BUCKETS buckets, they are widened so
+    that there are MAX_BUCKETS.
 
     Args:
         packets (list): List of TSAPacket objects
+        buckets (int): Number of buckets to split the time into
+        bucket_width (timedelta or number): Length of each bucket
+            (in seconds, if a number), overriding buckets
 
     Returns:
         A dictionary with these mappings:
@@ -29,58 +63,59 @@ def get_bandwidth_traffic_volume(stream, buckets=50):
         Where time is a datetime object, bandwidth and average bandwidth are in
         bits per second, and traffic volume is in bytes
     """
-    time_length_dicts = [dict(time=packet.timestamp, length=packet.length) for packet in stream]
+    if hasattr(stream, 'get_values_for_key'):
+        times = stream.get_values_for_key('timestamp')
+        lengths = stream.get_values_for_key('length')
+    else:
+        times = [packet.timestamp for packet in stream]
+        lengths = [packet.length for packet in stream]
 
-    if len(time_length_dicts) == 0:
+    if len(times) == 0:
         return {BANDWIDTH_DATA: [], TRAFFIC_VOLUME_DATA: [], AVERAGE_BANDWIDTH: 0}
 
-    total_traffic = sum([item['length'] for item in time_length_dicts])
-
-    latest_time = max(time_length_dicts, key=lambda item:item['time'])['time']
-    earliest_time = min(time_length_dicts, key=lambda item:item['time'])['time']
+    latest_time = max(times)
+    earliest_time = min(times)
     traffic_duration =  latest_time - earliest_time
-    step = traffic_duration / buckets
-    step_in_seconds = (step.seconds) + (step.microseconds / MICROSECONDS_IN_SECONDS)
+    if bucket_width is None:
+        step = traffic_duration / buckets
+    elif isinstance(bucket_width, timedelta):
+        step = bucket_width
+    else:
+        step = timedelta(seconds=bucket_width)
+    if step < timedelta(0):
+        raise ValueError("Bucket width must not be negative")
+    if not step:
+        step = timedelta(seconds=1)
 
-    y_traffic_volume = []
+    # Bucket i holds the packets in [earliest + i * step, earliest +
+    # (i + 1) * step), except that packets at the latest time stamp
+    # go into the last bucket, even if it ends exactly on it
+    duration_us = traffic_duration // ONE_MICROSECOND
+    step_us = step // ONE_MICROSECOND
+    if duration_us > step_us * MAX_BUCKETS:
+        step_us = -(-duration_us // MAX_BUCKETS)
+        step = timedelta(microseconds=step_us)
+    num_buckets = max(-(-duration_us // step_us), 1)
+    step_in_seconds = step.total_seconds()
+    offsets = (np.array(times, dtype='datetime64[us]') -
+            np.datetime64(earliest_time, 'us')).astype(np.int64)
+    indices = np.minimum(offsets // step_us, num_buckets - 1)
+    bucket_traffic = np.bincount(indices, weights=np.array(lengths,
+            dtype=np.float64), minlength=num_buckets)
+
+    y_traffic_volume = bucket_traffic.astype(np.int64).tolist()
     y_bandwidth = []
     x = []
 
-    left_bound = earliest_time
-    right_bound = left_bound + step
-
-    sum_total_of_traffic = 0
     sum_total_of_bandwidth = 0
-
-    while left_bound < latest_time:
-        sum_traffic = 0
-        # sum data for all packets that fall in current windoes
-        for time_length in time_length_dicts:
-            if time_length['time'] >= left_bound and time_length['time'] < right_bound:
-                sum_traffic += time_length['length']
-
-            # Deal with corner case of last edge / bound
-            if right_bound == latest_time and time_length['time'] == right_bound:
-                sum_traffic += time_length['length']
-
-
+    for index, sum_traffic in enumerate(y_traffic_volume):
         bandwidth = (sum_traffic * 8) / step_in_seconds
-
-        sum_total_of_traffic += sum_traffic
         sum_total_of_bandwidth += bandwidth
         # time period at the center of this bound
-        x.append(left_bound + step/2)
-        # total traffic for this time period in bytes
-        y_traffic_volume.append(sum_traffic)
+        x.append(earliest_time + step * index + step/2)
         # bandwidth for this time period in bits per second
         y_bandwidth.append(bandwidth)
 
-        left_bound += step
-        right_bound += step
-
-    assert (sum_total_of_traffic == total_traffic)
-    assert (len(x) == len(y_bandwidth) == len(y_traffic_volume))
-
     traffic_points = list(zip(x, y_traffic_volume))
     bandwidth_points = list(zip(x, y_bandwidth))
     ave_bandwidth = sum_total_of_bandwidth / len(bandwidth_points)
@@ -88,4 +123,166 @@ def get_bandwidth_traffic_volume(stream, buckets=50):
     return {BANDWIDTH_DATA: bandwidth_points, TRAFFIC_VOLUME_DATA: traffic_points, AVERAGE_BANDWIDTH: ave_bandwidth}
 
 
+class RollupTier:
+    """
+    Byte and packet counts of the traffic in each of the last
+    num_slots slots, each resolution seconds long, held in fixed size
+    ring buffers. Slot n covers the seconds [n * resolution,
+    (n + 1) * resolution) since the epoch, and is held at index
+    n % num_slots, until a later slot takes its place.
+    """
+
+    def __init__(self, resolution, num_slots):
+        self.resolution = resolution
+        self.num_slots = num_slots
+        self.slot_numbers = [-1] * num_slots
+        self.byte_counts = [0] * num_slots
+        self.packet_counts = [0] * num_slots
+        self.latest_slot = -1
+
+    def add(self, seconds, length):
+        """
+        Counts a packet of the provided length, sent the provided
+        number of seconds after the epoch. Packets older than the
+        slots the tier holds are ignored.
+        """
+        slot = int(seconds // self.resolution)
+        if slot <= self.latest_slot - self.num_slots:
+            return
+        index = slot % self.num_slots
+        if self.slot_numbers[index] != slot:
+            self.slot_numbers[index] = slot
+            self.byte_counts[index] = 0
+            self.packet_counts[index] = 0
+        self.byte_counts[index] += length
+        self.packet_counts[index] += 1
+        if slot > self.latest_slot:
+            self.latest_slot = slot
+
+    def get_first_slot(self):
+        """
+        Returns the number of the oldest slot the tier still holds.
+        """
+        return self.latest_slot - self.num_slots + 1
+
+    def get_counts(self, first_slot, last_slot):
+        """
+        Returns a (byte counts, packet counts) tuple of arrays of the
+        counts of the slots from first_slot to last_slot (inclusive),
+        which are zero for the slots the tier doesn't hold.
+        """
+        slots = np.arange(first_slot, last_slot + 1)
+        indices = slots % self.num_slots
+        held = np.array(self.slot_numbers)[indices] == slots
+        byte_counts = np.where(held, np.array(self.byte_counts)[indices], 0)
+        packet_counts = np.where(held,
+                np.array(self.packet_counts)[indices], 0)
+        return (byte_counts, packet_counts)
+
+class RollupStore:
+    """
+    Buffer listener (see PacketBuffer.add_listener) that counts the
+    bytes and packets captured each second, and rolls them up into
+    the coarser tiers of ROLLUP_TIERS, each of which takes a fixed
+    amount of memory. Packets evicted from the buffer stay counted,
+    so the store covers the whole capture, as far back as its
+    coarsest tier reaches.
+    """
+
+    def __init__(self, tiers=ROLLUP_TIERS):
+        self._lock = threading.Lock()
+        self.tiers = [RollupTier(resolution, num_slots)
+                for resolution, num_slots in tiers]
+        self.earliest_time = None
+        self.latest_time = None
+
+    def add_packet(self, packet):
+        """
+        Counts the provided packet in every tier.
+        """
+        timestamp = packet.timestamp
+        seconds = (timestamp - ROLLUP_EPOCH).total_seconds()
+        with self._lock:
+            for tier in self.tiers:
+                tier.add(seconds, packet.length)
+            if self.latest_time is None:
+                self.earliest_time = timestamp
+                self.latest_time = timestamp
+            elif timestamp < self.earliest_time:
+                self.earliest_time = timestamp
+            elif timestamp > self.latest_time:
+                self.latest_time = timestamp
+
+    def on_append(self, tsa_packet):
+        self.add_packet(tsa_packet)
+
+    def on_evict(self, tsa_packet):
+        pass
+
+    def get_tier(self, start_time):
+        """
+        Returns the finest tier that reaches back to the provided
+        time (give or take the slot the time falls in), or the
+        coarsest tier if none do.
+        """
+        seconds = (start_time - ROLLUP_EPOCH).total_seconds()
+        for tier in self.tiers:
+            if seconds // tier.resolution >= tier.get_first_slot() - 1:
+                return tier
+        return self.tiers[-1]
+
+    def get_bandwidth_traffic_volume(self, start_time=None, end_time=None,
+            buckets=50):
+        """
+        Calculates the bandwidth and traffic rate of the packets counted
+        from start_time to end_time (by default, from the earliest to
+        the latest packet counted), in the format returned by
+        get_bandwidth_traffic_volume.
+
+        The counts are read from the finest tier that still reaches back
+        to start_time, and summed into at most the provided number of
+        buckets, each a whole number of that tier's slots long, so the
+        cost depends on the tier sizes rather than on the length of the
+        window or the number of packets.
+        """
+        with self._lock:
+            if self.latest_time is None:
+                return {BANDWIDTH_DATA: [], TRAFFIC_VOLUME_DATA: [],
+                        AVERAGE_BANDWIDTH: 0}
+            if start_time is None:
+                start_time = self.earliest_time
+            if end_time is None:
+                end_time = self.latest_time
+
+            tier = self.get_tier(start_time)
+            resolution = tier.resolution
+            first_slot = max(int((start_time - ROLLUP_EPOCH).total_seconds()
+                    // resolution), tier.get_first_slot())
+            last_slot = int((end_time - ROLLUP_EPOCH).total_seconds()
+                    // resolution)
+            if last_slot < first_slot:
+                return {BANDWIDTH_DATA: [], TRAFFIC_VOLUME_DATA: [],
+                        AVERAGE_BANDWIDTH: 0}
+            (byte_counts, _) = tier.get_counts(first_slot, last_slot)
+
+        num_slots = last_slot - first_slot + 1
+        slots_per_bucket = max(-(-num_slots // buckets), 1)
+        num_buckets = -(-num_slots // slots_per_bucket)
+        byte_counts = np.concatenate((byte_counts, np.zeros(
+                num_buckets * slots_per_bucket - num_slots, dtype=np.int64)))
+        y_traffic_volume = byte_counts.reshape(num_buckets,
+                slots_per_bucket).sum(axis=1).tolist()
+
+        step_in_seconds = slots_per_bucket * resolution
+        step = timedelta(seconds=step_in_seconds)
+        first_time = ROLLUP_EPOCH + timedelta(seconds=first_slot * resolution)
+        x = [first_time + step * index + step/2
+                for index in range(num_buckets)]
+        y_bandwidth = [(sum_traffic * 8) / step_in_seconds
+                for sum_traffic in y_traffic_volume]
+
+        traffic_points = list(zip(x, y_traffic_volume))
+        bandwidth_points = list(zip(x, y_bandwidth))
+        ave_bandwidth = sum(y_bandwidth) / len(bandwidth_points)
 
+        return {BANDWIDTH_DATA: bandwidth_points, TRAFFIC_VOLUME_DATA: traffic_points, AVERAGE_BANDWIDTH: ave_bandwidth}
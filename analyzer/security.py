@@ -1,27 +1,118 @@
 """
 This module contains security related analysis functions
+
+During a live capture, SecurityDetector applies the same checks as
+the detection functions below to a sliding window of the capture as
+packets arrive, so that attacks are flagged as soon as they start,
+without rescanning the capture buffer.
 """
 
+import collections
+import threading
+
 ATTACK_BASE_THRESHOLD = 1000
 ATTACK_MULT_THRESHOLD = 5
 
-def get_syn_flood_attackers(stream):
+# SecurityDetector treats ATTACK_BASE_THRESHOLD as a
+# rate: that many packets per ATTACK_RATE_SECONDS
+ATTACK_RATE_SECONDS = 10
+
+# Kinds of attacks SecurityDetector raises alerts for
+SYN_FLOOD_ATTACKER = "SYN flood attacker"
+DDOS_VICTIM = "DDoS victim"
+REFLECTION_VICTIM = "Reflection victim"
+
+class SecurityCounters:
+    """
+    Per-host packet counts the detection functions below compare
+    against their thresholds, for a stream of packets. Packets may
+    be added and removed one at a time, so the counts can be kept up
+    to date as a capture buffer changes (see analyzer.aggregate).
+
+        syn_ack:  source IP -> (TCP SYNs sent, TCP ACKs sent)
+        synack_ack:  source IP -> (TCP SYN-ACKs sent, TCP ACKs sent)
+        dns_query_resp:  IP -> (DNS queries sent, DNS responses received)
+    """
+
+    def __init__(self):
+        self.syn_ack = {}
+        self.synack_ack = {}
+        self.dns_query_resp = {}
+
+    def add_packet(self, packet):
+        self._count_packet(packet, 1)
+
+    def remove_packet(self, packet):
+        self._count_packet(packet, -1)
+
+    def remove_counts(self, counters):
+        """
+        Subtracts the provided SecurityCounters from these.
+        """
+        for (counts, other_counts) in [(self.syn_ack, counters.syn_ack),
+                (self.synack_ack, counters.synack_ack),
+                (self.dns_query_resp, counters.dns_query_resp)]:
+            for addr, (first, second) in other_counts.items():
+                _add(counts, addr, -first, -second)
+
+    def copy(self):
+        counters = SecurityCounters()
+        counters.syn_ack = dict(self.syn_ack)
+        counters.synack_ack = dict(self.synack_ack)
+        counters.dns_query_resp = dict(self.dns_query_resp)
+        return counters
+
+    def _count_packet(self, packet, delta):
+        if packet.protocol == 'tcp':
+            src_addr = packet.src_addr
+            if packet.tcp_op == 'SYN':
+                _add(self.syn_ack, src_addr, delta, 0)
+            elif packet.tcp_op == 'SYN-ACK':
+                _add(self.synack_ack, src_addr, delta, 0)
+            elif packet.tcp_op == 'ACK':
+                _add(self.syn_ack, src_addr, 0, delta)
+                _add(self.synack_ack, src_addr, 0, delta)
+        if packet.application_type == 'dns':
+            if packet.dns_query_resp == 'query':
+                _add(self.dns_query_resp, packet.src_addr, delta, 0)
+            else:
+                _add(self.dns_query_resp, packet.dst_addr, 0, delta)
+
+def build_security_counters(stream):
+    """
+    Returns the SecurityCounters of the packets in the provided stream.
+    """
+    counters = SecurityCounters()
+    for packet in stream:
+        counters.add_packet(packet)
+    return counters
+
+def _add(counts, addr, first_delta, second_delta):
+    """
+    Adds the deltas to the pair of counts of the provided address,
+    dropping the address once both counts are back to zero.
+    """
+    (first, second) = counts.get(addr, (0, 0))
+    (first, second) = (first + first_delta, second + second_delta)
+    if first or second:
+        counts[addr] = (first, second)
+    else:
+        counts.pop(addr, None)
+
+def get_syn_flood_attackers(stream, counters=None):
     """
     Returns a list of tuples containing the IP addresses of
     suspected SYN flood perpretators, and the reason why
     they were suspected.
+
+    If the SecurityCounters of the stream are provided, they are
+    used instead of recalculated for efficiency.
     """
     # Get a dictionary relating all seen source IP addresses
     # to the number of TCP SYN and ACK packets they've sent
-    ip_to_syn_ack = {}
-    for packet in stream:
-        if packet.protocol == 'tcp':
-            src_addr = packet.src_addr
-            (syn, ack) = ip_to_syn_ack.get(src_addr, (0, 0))
-            if packet.tcp_op == 'SYN':
-                ip_to_syn_ack[src_addr] = (syn+1, ack)
-            elif packet.tcp_op == 'ACK':
-                ip_to_syn_ack[src_addr] = (syn, ack+1)
+    if counters is None:
+        counters = build_security_counters(stream)
+    ip_to_syn_ack = counters.syn_ack
 
     # Find hosts that have sent much more SYNs than ACKs
     syn_flood_attackers = []
@@ -32,23 +123,20 @@ def get_syn_flood_attackers(stream):
 
     return syn_flood_attackers
 
-def get_ddos_victims(stream):
+def get_ddos_victims(stream, counters=None):
     """
     Returns a list of tuples containing the IP addresses of
     suspected DDoS victims, and the reason why they were
     suspected.
+
+    If the SecurityCounters of the stream are provided, they are
+    used instead of recalculated for efficiency.
     """
     # Get a dictionary relating all seen source IP addresses to
     # the number of TCP SYN-ACK and ACK packets they've sent
-    ip_to_synack_ack = {}
-    for packet in stream:
-        if packet.protocol == 'tcp':
-            src_addr = packet.src_addr
-            (synack, ack) = ip_to_synack_ack.get(src_addr, (0, 0))
-            if packet.tcp_op == 'SYN-ACK':
-                ip_to_synack_ack[src_addr] = (synack+1, ack)
-            elif packet.tcp_op == 'ACK':
-                ip_to_synack_ack[src_addr] = (synack, ack+1)
+    if counters is None:
+        counters = build_security_counters(stream)
+    ip_to_synack_ack = counters.synack_ack
 
     # Find hosts that have sent much more SYN-ACKs than ACKs
     ddos_victims = []
@@ -59,26 +147,21 @@ def get_ddos_victims(stream):
 
     return ddos_victims
 
-def get_reflection_victims(stream):
+def get_reflection_victims(stream, counters=None):
     """
     Returns a list of tuples containing the IP addresses of
     suspected reflection attack victims, and the reason why
     they were suspected.
+
+    If the SecurityCounters of the stream are provided, they are
+    used instead of recalculated for efficiency.
     """
     # Get a dictionary relating all seen IP addrresses to
     # the number of DNS queries they've sent and number of
     # DNS responses they've received
-    ip_to_dns_query_resp = {}
-    for packet in stream:
-        if packet.application_type == 'dns':
-            if packet.dns_query_resp == 'query':
-                src_addr = packet.src_addr
-                (query, resp) = ip_to_dns_query_resp.get(src_addr, (0, 0))
-                ip_to_dns_query_resp[src_addr] = (query+1, resp)
-            else:
-                dst_addr = packet.dst_addr
-                (query, resp) = ip_to_dns_query_resp.get(dst_addr, (0, 0))
-                ip_to_dns_query_resp[dst_addr] = (query, resp+1)
+    if counters is None:
+        counters = build_security_counters(stream)
+    ip_to_dns_query_resp = counters.dns_query_resp
 
     # Find hosts that received much DNS responses than sent DNS queries
     reflection_victims = []
@@ -88,3 +171,139 @@ def get_reflection_victims(stream):
                 "Host has received much DNS responses than queried for"))
 
     return reflection_victims
+
+class SecurityDetector:
+    """
+    Buffer listener (see PacketBuffer.add_listener) that keeps the
+    SecurityCounters of the last window_seconds of the capture (by
+    packet timestamp), in buckets of bucket_seconds, and checks the
+    hosts whose counts change against the thresholds of the detection
+    functions above, with ATTACK_BASE_THRESHOLD taken as a rate (see
+    ATTACK_RATE_SECONDS).
+
+    A host is flagged as soon as the packet that takes it over the
+    thresholds is added, and stays flagged until its counts in the
+    window fall back under them. alert_callback, if provided, is
+    called with the kind of attack (e.g. SYN_FLOOD_ATTACKER), the
+    host's address, the reason, and the timestamp of the packet,
+    whenever a host is flagged. It is called while the capture buffer
+    is locked, so it should return quickly.
+    """
+
+    # (kind, counts attribute, index of the count of attack packets
+    # in the pair, reason) of each of the checks
+    CHECKS = [
+        (SYN_FLOOD_ATTACKER, 'syn_ack', 0,
+            "Host has sent much more SYNs than ACKs"),
+        (DDOS_VICTIM, 'synack_ack', 0,
+            "Host has sent much more SYN-ACKs than ACKs"),
+        (REFLECTION_VICTIM, 'dns_query_resp', 1,
+            "Host has received much DNS responses than queried for"),
+    ]
+
+    def __init__(self, window_seconds=ATTACK_RATE_SECONDS, bucket_seconds=1,
+            alert_callback=None):
+        self._lock = threading.Lock()
+        self.window_seconds = window_seconds
+        self.bucket_seconds = bucket_seconds
+        self.alert_callback = alert_callback
+        self._num_buckets = max(int(window_seconds // bucket_seconds), 1)
+        # Number of attack packets a host must send (or
+        # receive) within the window to be over the rate
+        self._base_threshold = ATTACK_BASE_THRESHOLD * window_seconds / \
+                ATTACK_RATE_SECONDS
+        # (bucket number, SecurityCounters) of each bucket of the
+        # window, oldest first, and the counters of the whole window
+        self._buckets = collections.deque()
+        self.window_counters = SecurityCounters()
+        # kind -> {address: (reason, time flagged)}
+        self._alerts = {kind: {} for (kind, _, _, _) in SecurityDetector.CHECKS}
+
+    def add_packet(self, packet):
+        """
+        Counts the provided packet in its bucket, dropping the buckets
+        that have left the window, and checks its hosts for attacks.
+        Packets older than the window are ignored.
+        """
+        timestamp = packet.timestamp
+        bucket_number = int(timestamp.timestamp() // self.bucket_seconds)
+        with self._lock:
+            if not self._buckets or bucket_number > self._buckets[-1][0]:
+                self._buckets.append((bucket_number, SecurityCounters()))
+                self._expire_buckets(bucket_number, timestamp)
+            counters = self._get_bucket(bucket_number)
+            if counters is None:
+                return
+
+            counters.add_packet(packet)
+            self.window_counters.add_packet(packet)
+            for addr in (packet.src_addr, packet.dst_addr):
+                self._check(addr, timestamp)
+
+    def on_append(self, tsa_packet):
+        self.add_packet(tsa_packet)
+
+    def on_evict(self, tsa_packet):
+        pass
+
+    def get_alerts(self, kind=None):
+        """
+        Returns a list of (kind, address, reason, time flagged) tuples
+        of the hosts currently flagged (for the provided kind only, if
+        provided), in the order they were flagged.
+        """
+        with self._lock:
+            alerts = [(alert_kind, addr, reason, flagged_time)
+                    for alert_kind, kind_alerts in self._alerts.items()
+                    if kind is None or alert_kind == kind
+                    for addr, (reason, flagged_time) in kind_alerts.items()]
+        return sorted(alerts, key=lambda alert: alert[3])
+
+    def _get_bucket(self, bucket_number):
+        """
+        Returns the SecurityCounters of the provided bucket, adding it if
+        it's missing (for late packets), or None if it has left the window.
+        """
+        if bucket_number <= self._buckets[-1][0] - self._num_buckets:
+            return None
+        index = len(self._buckets)
+        while index > 0 and self._buckets[index - 1][0] > bucket_number:
+            index -= 1
+        if index > 0 and self._buckets[index - 1][0] == bucket_number:
+            return self._buckets[index - 1][1]
+        counters = SecurityCounters()
+        self._buckets.insert(index, (bucket_number, counters))
+        return counters
+
+    def _expire_buckets(self, latest_bucket_number, timestamp):
+        """
+        Drops the buckets that have left the window, and checks
+        the hosts whose counts they held.
+        """
+        while self._buckets[0][0] <= latest_bucket_number - self._num_buckets:
+            (_, counters) = self._buckets.popleft()
+            self.window_counters.remove_counts(counters)
+            addrs = set(counters.syn_ack)
+            addrs.update(counters.synack_ack)
+            addrs.update(counters.dns_query_resp)
+            for addr in addrs:
+                self._check(addr, timestamp)
+
+    def _check(self, addr, timestamp):
+        """
+        Flags or unflags the provided host, for each kind of attack.
+        """
+        for (kind, counts_name, index, reason) in SecurityDetector.CHECKS:
+            (first, second) = getattr(self.window_counters,
+                    counts_name).get(addr, (0, 0))
+            (attack, other) = (first, second) if index == 0 else \
+                    (second, first)
+            alerts = self._alerts[kind]
+            if attack > self._base_threshold and \
+                    attack > other * ATTACK_MULT_THRESHOLD:
+                if addr not in alerts:
+                    alerts[addr] = (reason, timestamp)
+                    if self.alert_callback:
+                        self.alert_callback(kind, addr, reason, timestamp)
+            else:
+                alerts.pop(addr, None)
@@ -0,0 +1,67 @@
+"""
+Times analyzer.metrics.get_bandwidth_traffic_volume on synthetic
+streams of increasing size, and for increasing numbers of buckets,
+to check that its cost grows linearly with the number of packets and
+does not depend on the number of buckets.
+
+Run from the repository root:
+    python -m benchmarks.bandwidth
+"""
+
+from analyzer.metrics import get_bandwidth_traffic_volume
+from capturer.tsa_packet import TSAPacket
+
+from datetime import datetime, timedelta
+import random
+import time
+
+PACKET_COUNTS = [10000, 100000, 1000000]
+BUCKET_COUNTS = [25, 1000, 100000]
+REPEATS = 3
+
+def make_stream(num_packets, duration_seconds=3600):
+    """
+    Returns a list of num_packets TSAPackets with random time stamps
+    spread over duration_seconds, and random lengths.
+    """
+    start_time = datetime(2018, 1, 1)
+    offsets = sorted(random.uniform(0, duration_seconds)
+            for _ in range(num_packets))
+    return [TSAPacket({
+        'timestamp': start_time + timedelta(seconds=offset),
+        'ip_version': 'ipv4',
+        'src_addr': '10.0.0.1',
+        'dst_addr': '10.0.0.2',
+        'protocol': 'udp',
+        'src_port': 1234,
+        'dst_port': 53,
+        'application_type': 'none',
+        'length': random.randint(60, 1500),
+    }) for offset in offsets]
+
+def time_call(stream, buckets):
+    """
+    Returns the shortest time (in seconds) of REPEATS calls.
+    """
+    best_time = None
+    for _ in range(REPEATS):
+        start_time = time.perf_counter()
+        get_bandwidth_traffic_volume(stream, buckets=buckets)
+        elapsed = time.perf_counter() - start_time
+        if best_time is None or elapsed < best_time:
+            best_time = elapsed
+    return best_time
+
+def main():
+    random.seed(0)
+    print("%10s %10s %10s %14s" % ("packets", "buckets", "seconds",
+            "ns / packet"))
+    for num_packets in PACKET_COUNTS:
+        stream = make_stream(num_packets)
+        for buckets in BUCKET_COUNTS:
+            elapsed = time_call(stream, buckets)
+            print("%10d %10d %10.4f %14.1f" % (num_packets, buckets,
+                    elapsed, elapsed * 1e9 / num_packets))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Times analyzer.ip.aggregate_on_dns against the nested-loop alias
+merging it used before DomainAliases, on synthetic tables of IP
+addresses each used by many domains, for increasing numbers of
+domains. The domains either fall into separate groups of aliases
+(like the sites behind different CDNs), or are all aliases of each
+other (like the sites behind one CDN).
+
+The old merging is copied below as it was, other than for resolving
+domains with get_registered_domain (as aggregate_on_dns now does)
+rather than calling get_tld directly, so only the merging differs.
+It grows much faster than linearly, so it is only timed up to
+OLD_MAX_DOMAINS domains.
+
+Run from the repository root:
+    python -m benchmarks.domain_aliases
+"""
+
+from analyzer.domain_names import get_registered_domain
+from analyzer.ip import aggregate_on_dns, UNKNOWN
+
+import itertools
+import random
+import time
+
+DOMAIN_COUNTS = [250, 500, 1000, 2000, 5000, 20000]
+OLD_MAX_DOMAINS = 1000
+
+# Each address is used by DOMAINS_PER_IP domains, of a group of
+# GROUP_SIZE domains, or of all of them if group_size is None
+GROUP_SIZE = 50
+DOMAINS_PER_IP = 40
+
+def make_table(num_domains, group_size):
+    """
+    Returns (ip_values, ip_fqdns) dictionaries for num_domains domains,
+    with as many addresses, each used by DOMAINS_PER_IP domains of the
+    same group of group_size domains (or of any of them, if None).
+    """
+    ip_values = {}
+    ip_fqdns = {}
+    for index in range(num_domains):
+        ip = "10.%d.%d.%d" % (index >> 16, (index >> 8) & 0xFF, index & 0xFF)
+        if group_size is None:
+            group = range(num_domains)
+        else:
+            group_start = index - index % group_size
+            group = range(group_start, min(group_start + group_size,
+                    num_domains))
+        ip_values[ip] = random.randint(1, 1000)
+        ip_fqdns[ip] = ["www.site%d.com" % domain for domain in
+                random.sample(group, min(DOMAINS_PER_IP, len(group)))]
+    return (ip_values, ip_fqdns)
+
+def old_aggregate_on_dns(ip_values, ip_fqdns, is_numeric=True):
+    # Coalesce fqdn packet counts using ip values dict
+    fqdn_domain_values = {}
+    fqdn_domain_values[UNKNOWN] = 0 if is_numeric else []
+    fqdn_domain_aliases = {}
+    fqdn_domain_aliases[UNKNOWN] = {UNKNOWN}
+
+    for ip, value in ip_values.items():
+        fqdns = ip_fqdns.get(ip, None)
+
+        if fqdns:
+            domain_set = set()
+            for fqdn in fqdns:
+                domain_set.add(str(get_registered_domain(fqdn)))
+            domain_set = list(domain_set)
+            # Add domains to domain counts, only adding first entry if multiple
+            domain = domain_set[0]
+            if domain in fqdn_domain_values:
+                if is_numeric:
+                    fqdn_domain_values[domain] += value
+                else:
+                    fqdn_domain_values[domain].append(value)
+            else:
+                if is_numeric:
+                    fqdn_domain_values[domain] = value
+                else:
+                    fqdn_domain_values[domain] = [value]
+
+            # Add aliases for domains
+            for domain1 in domain_set:
+                if domain1 not in fqdn_domain_aliases:
+                    fqdn_domain_aliases[domain1] = {domain1}
+                for domain2 in domain_set:
+                    if domain2 not in fqdn_domain_aliases[domain1]:
+                        if (domain2 in fqdn_domain_aliases):
+                            for domain in fqdn_domain_aliases[domain2]:
+                                if domain != domain1:
+                                    if (domain in fqdn_domain_aliases):
+                                        fqdn_domain_aliases[domain] = fqdn_domain_aliases[domain].union(fqdn_domain_aliases[domain1])
+                                        fqdn_domain_aliases[domain1] = fqdn_domain_aliases[domain].union(fqdn_domain_aliases[domain1])
+                        fqdn_domain_aliases[domain1].add(domain2)
+
+        else:
+            if is_numeric:
+                fqdn_domain_values[UNKNOWN] += value
+            else:
+                fqdn_domain_values[UNKNOWN].append(value)
+
+    fqdn_alias_count = {}
+    for domain in fqdn_domain_values:
+        alias_list = list(fqdn_domain_aliases[domain])
+        alias_list.sort()
+        alias_name = ", ".join(alias_list)
+        if alias_name in fqdn_alias_count:
+            fqdn_alias_count[alias_name] += fqdn_domain_values[domain]
+        else:
+            fqdn_alias_count[alias_name] = fqdn_domain_values[domain]
+    return fqdn_alias_count
+
+def time_call(function, *args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    return (result, time.perf_counter() - start_time)
+
+def main():
+    random.seed(0)
+    print("%10s %10s %10s %12s %12s" % ("domains", "grouped", "labels",
+            "old s", "new s"))
+    for num_domains, group_size in itertools.product(DOMAIN_COUNTS,
+            [GROUP_SIZE, None]):
+        (ip_values, ip_fqdns) = make_table(num_domains, group_size)
+        # Warm the domain name cache both versions share
+        for fqdns in ip_fqdns.values():
+            for fqdn in fqdns:
+                get_registered_domain(fqdn)
+
+        (new_result, new_time) = time_call(aggregate_on_dns, ip_values,
+                ip_fqdns)
+        old_time = "-"
+        if num_domains <= OLD_MAX_DOMAINS:
+            (_, old_time) = time_call(old_aggregate_on_dns,
+                    ip_values, ip_fqdns)
+            old_time = "%.3f" % old_time
+        # Each group of aliases gets one label (other than UNKNOWN)
+        num_labels = len(new_result) - 1
+        print("%10d %10s %10d %12s %12.3f" % (num_domains,
+                "yes" if group_size else "no", num_labels, old_time,
+                new_time))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Times the Python side of reading a mixed capture with the tshark and
+pyshark readers, with and without the display filter pushdown (see
+capturer.capture_filters), to measure how much parsing work the
+pushdown saves.
+
+The capture is generated: copies of the frames the reader tests use
+(IPv4 and IPv6 TCP / UDP / DNS / HTTP, and a few frames the parser
+rejects), padded with further frames the parser rejects (ARP, ICMP
+echoes and TCP segments with neither SYN nor ACK set), so that about
+half of the frames can be dropped by tshark.
+
+If tshark isn't installed, only the parse time of the tshark reader
+is measured, on tshark output written out by hand for a similar mix of
+frames. The pushdown's display filter mirrors the parser's checks, so
+with pushdown, tshark would only output the rows the parser accepts.
+
+Run from the repository root:
+    python -m benchmarks.pushdown
+"""
+
+from capturer.capture_filters import DISPLAY_PARSEABLE
+from capturer.tsa_packet import TSAPacket, TSAPacketParseException
+from tests import pcap_fixture
+
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+# Copies of the mixed frames in the capture, for each reader
+# (pyshark dissects every packet, so it gets a smaller capture)
+TSHARK_COPIES = 2000
+PYSHARK_COPIES = 200
+
+# Copies of the hand-written rows parsed if tshark isn't installed,
+# and the number of times they are parsed (the best time is kept)
+SYNTHETIC_COPIES = 20000
+SYNTHETIC_REPEATS = 3
+
+def rejected_frames():
+    """
+    Returns frames the parser rejects, which the pushdown drops.
+    """
+    icmp_echo = struct.pack('>BBHHH', 8, 0, 0, 1, 1) + b'\x00' * 32
+    return [
+        pcap_fixture.arp(),
+        pcap_fixture.ipv4("10.0.0.1", "10.0.0.2", 1, icmp_echo),
+        pcap_fixture.ipv6("2001:db8::1", "2001:db8::2", 6,
+            pcap_fixture.tcp(40004, 443, 0x04)),
+        pcap_fixture.ipv4("10.0.0.1", "93.184.216.34", 6,
+            pcap_fixture.tcp(40005, 443, 0x01)),
+        pcap_fixture.arp(),
+        pcap_fixture.ipv4("10.0.0.2", "10.0.0.1", 1, icmp_echo),
+        pcap_fixture.ipv4("10.0.0.1", "93.184.216.34", 6,
+            pcap_fixture.tcp(40006, 443, 0x04)),
+    ]
+
+def make_capture(directory, num_copies):
+    """
+    Writes a mixed capture of num_copies copies of the
+    fixture frames, and returns its path and frame count.
+    """
+    cap_filename = os.path.join(directory, "mixed-%d.pcap" % num_copies)
+    frames = (pcap_fixture.mixed_frames() + rejected_frames()) * num_copies
+    pcap_fixture.write_pcap(cap_filename, frames)
+    return (cap_filename, len(frames))
+
+def parse_all(packets, parse_packet):
+    """
+    Parses each of the provided packets, and returns the number
+    parsed and the time (in seconds) spent in parse_packet.
+    """
+    num_parsed = 0
+    parse_time = 0
+    for packet in packets:
+        start_time = time.perf_counter()
+        try:
+            parse_packet(packet)
+            num_parsed += 1
+        except TSAPacketParseException:
+            pass
+        parse_time += time.perf_counter() - start_time
+    return (num_parsed, parse_time)
+
+def time_tshark(cap_filename, display_filter):
+    """
+    Returns the number of rows tshark output, the number parsed, the
+    time spent parsing them, and the total time of the read.
+    """
+    from capturer import tshark_reader
+    start_time = time.perf_counter()
+    rows = list(tshark_reader.iter_file_fields(cap_filename, display_filter))
+    (num_parsed, parse_time) = parse_all(rows,
+            TSAPacket.parse_tshark_fields)
+    return (len(rows), num_parsed, parse_time,
+            time.perf_counter() - start_time)
+
+def time_pyshark(cap_filename, display_filter):
+    """
+    Like time_tshark, for pyshark. The time pyshark spends decoding
+    tshark's output is only counted in the total.
+    """
+    from capturer import wireshark_proxy
+    counted = []
+    def counted_packets():
+        for packet in wireshark_proxy._iter_pyshark_file(cap_filename,
+                display_filter):
+            counted.append(None)
+            yield packet
+    start_time = time.perf_counter()
+    (num_parsed, parse_time) = parse_all(counted_packets(),
+            TSAPacket.parse_pyshark_packet)
+    return (len(counted), num_parsed, parse_time,
+            time.perf_counter() - start_time)
+
+def synthetic_rows():
+    """
+    Returns the tshark output for a mix of frames like that of
+    make_capture, half of which the parser rejects (ARP, ICMP echoes
+    and TCP segments with neither SYN nor ACK set).
+    """
+    tshark_fields = pcap_fixture.tshark_fields
+    return [
+        tshark_fields(0, 54, "eth:ethertype:ip:tcp", ip_src="10.0.0.1",
+            ip_dst="93.184.216.34", tcp_srcport="40000", tcp_dstport="443",
+            tcp_flags_syn="True", tcp_flags_ack="False"),
+        tshark_fields(1, 103, "eth:ethertype:ipv6:udp:dns",
+            ipv6_src="2001:db8::1", ipv6_dst="2001:db8::53",
+            udp_srcport="53000", udp_dstport="53",
+            dns_qry_name="example.com,example.org"),
+        tshark_fields(2, 119, "eth:ethertype:ipv6:udp:dns",
+            ipv6_src="2001:db8::53", ipv6_dst="2001:db8::1",
+            udp_srcport="53", udp_dstport="53000",
+            dns_qry_name="example.com", dns_resp_name="example.com",
+            dns_aaaa="2606:2800:220:1::1", dns_count_answers="1",
+            dns_resp_type="28", dns_resp_ttl="300"),
+        tshark_fields(3, 87, "eth:ethertype:ip:udp:dns", ip_src="10.0.0.53",
+            ip_dst="10.0.0.1", udp_srcport="53", udp_dstport="53001",
+            dns_qry_name="example.net", dns_resp_name="example.net",
+            dns_a="93.184.216.35", dns_count_answers="1",
+            dns_resp_type="1", dns_resp_ttl="60"),
+        tshark_fields(4, 91, "eth:ethertype:ip:tcp:http", ip_src="10.0.0.1",
+            ip_dst="93.184.216.34", tcp_srcport="40001", tcp_dstport="80",
+            tcp_flags_syn="False", tcp_flags_ack="True",
+            http_request_method="GET"),
+        tshark_fields(5, 74, "eth:ethertype:ipv6:tcp",
+            ipv6_src="2001:db8::1", ipv6_dst="2001:db8::2",
+            tcp_srcport="40003", tcp_dstport="22", tcp_flags_syn="True",
+            tcp_flags_ack="True"),
+        tshark_fields(6, 42, "eth:ethertype:arp"),
+        tshark_fields(7, 82, "eth:ethertype:ip:icmp:data",
+            ip_src="10.0.0.1", ip_dst="10.0.0.2"),
+        tshark_fields(8, 74, "eth:ethertype:ipv6:tcp",
+            ipv6_src="2001:db8::1", ipv6_dst="2001:db8::2",
+            tcp_srcport="40004", tcp_dstport="443", tcp_flags_syn="False",
+            tcp_flags_ack="False"),
+        tshark_fields(9, 42, "eth:ethertype:arp"),
+        tshark_fields(10, 82, "eth:ethertype:ip:icmp:data",
+            ip_src="10.0.0.2", ip_dst="10.0.0.1"),
+        tshark_fields(11, 54, "eth:ethertype:ip:tcp", ip_src="10.0.0.1",
+            ip_dst="93.184.216.34", tcp_srcport="40006", tcp_dstport="443",
+            tcp_flags_syn="False", tcp_flags_ack="False"),
+    ]
+
+def time_synthetic(rows):
+    """
+    Returns the number of the provided rows parsed, and the
+    shortest time spent parsing them of SYNTHETIC_REPEATS runs.
+    """
+    best_time = None
+    for _ in range(SYNTHETIC_REPEATS):
+        (num_parsed, parse_time) = parse_all(rows,
+                TSAPacket.parse_tshark_fields)
+        if best_time is None or parse_time < best_time:
+            best_time = parse_time
+    return (num_parsed, best_time)
+
+def main_synthetic():
+    rows = synthetic_rows() * SYNTHETIC_COPIES
+    pushed_down_rows = [row for row in rows
+            if _is_parsed(TSAPacket.parse_tshark_fields, row)]
+    print("%8s %9s %8s %8s %10s %12s" % ("reader", "pushdown", "rows",
+            "parsed", "parse s", "us / frame"))
+    for pushdown, pushdown_rows in [(False, rows), (True, pushed_down_rows)]:
+        (num_parsed, parse_time) = time_synthetic(pushdown_rows)
+        print("%8s %9s %8d %8d %10.3f %12.2f" % ("tshark",
+                "on" if pushdown else "off", len(pushdown_rows), num_parsed,
+                parse_time, parse_time * 1e6 / len(rows)))
+
+def _is_parsed(parse_packet, packet):
+    try:
+        parse_packet(packet)
+        return True
+    except TSAPacketParseException:
+        return False
+
+def main():
+    if shutil.which('tshark') is None:
+        print("tshark is not installed, so only the parse time of "
+                "hand-written tshark output is measured")
+        main_synthetic()
+        return
+
+    print("%8s %9s %8s %8s %8s %10s %10s" % ("reader", "pushdown",
+            "frames", "rows", "parsed", "parse s", "total s"))
+    with tempfile.TemporaryDirectory() as directory:
+        for reader, time_reader, num_copies in [
+                ('tshark', time_tshark, TSHARK_COPIES),
+                ('pyshark', time_pyshark, PYSHARK_COPIES)]:
+            (cap_filename, num_frames) = make_capture(directory, num_copies)
+            for pushdown in (False, True):
+                display_filter = DISPLAY_PARSEABLE if pushdown else None
+                (num_rows, num_parsed, parse_time, total_time) = \
+                        time_reader(cap_filename, display_filter)
+                print("%8s %9s %8d %8d %8d %10.3f %10.3f" % (reader,
+                        "on" if pushdown else "off", num_frames, num_rows,
+                        num_parsed, parse_time, total_time))
+
+if __name__ == "__main__":
+    main()
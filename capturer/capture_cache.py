@@ -0,0 +1,208 @@
+"""
+Persistent cache of the packets parsed from a capture file, so that
+reopening the same file does not require parsing it again.
+
+The packets are stored column by column (see ColumnarTSAStream), in
+a binary file laid out as follows:
+    CACHE_MAGIC
+    header length (4 byte little endian unsigned integer)
+    header (JSON): cache key, dictionaries, and the dtype, offset
+        and length of each array
+    arrays, each starting at a multiple of ARRAY_ALIGNMENT bytes
+The file is memory mapped when loaded, and the arrays are used in
+place, without being read into memory up front.
+
+A cache file is only used if its key matches the capture file (its
+size, modification time and SHA-256 hash) and the settings it was
+parsed with (parser version, reader and filters).
+"""
+
+from capturer.tsa_packet import PARSER_VERSION
+from capturer.tsa_stream import ColumnarTSAStream
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+CACHE_MAGIC = b"TSACACHE"
+CACHE_FORMAT_VERSION = 2
+CACHE_SUFFIX = ".tsacache"
+
+ARRAY_ALIGNMENT = 64
+
+# Number of packets encoded into each ColumnarTSAStream while writing
+WRITER_CHUNK_SIZE = 100000
+
+class CaptureCacheException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+class CacheWriter:
+    """
+    Collects the packets parsed from a capture file, in a compact
+    columnar form, until they are written out with write.
+    """
+
+    def __init__(self):
+        self._streams = []
+        self._pending = []
+
+    def add(self, tsa_packet):
+        self._pending.append(tsa_packet)
+        if len(self._pending) >= WRITER_CHUNK_SIZE:
+            self._encode_pending()
+
+    def extend(self, tsa_packets):
+        for tsa_packet in tsa_packets:
+            self.add(tsa_packet)
+
+    def write(self, cache_filename, key):
+        """
+        Writes the collected packets to the provided cache file,
+        with the provided cache key (see get_cache_key).
+        """
+        self._encode_pending()
+        stream = ColumnarTSAStream.concatenate(self._streams)
+        write_cache(cache_filename, key, stream)
+
+    def _encode_pending(self):
+        if self._pending:
+            self._streams.append(ColumnarTSAStream.from_packets(self._pending))
+            self._pending = []
+
+def get_cache_filename(cap_filename, cache_directory=None):
+    """
+    Returns the path of the cache file for the provided capture file:
+    next to it, or in cache_directory if one is provided.
+    """
+    if not cache_directory:
+        return cap_filename + CACHE_SUFFIX
+    return os.path.join(cache_directory,
+            os.path.basename(cap_filename) + CACHE_SUFFIX)
+
+def get_cache_key(cap_filename, reader, display_filter, file_hash=None):
+    """
+    Returns the cache key of the provided capture file, when read with
+    the provided reader and display filter. The SHA-256 hash of the
+    file is computed unless it is provided.
+    """
+    stat = os.stat(cap_filename)
+    return {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': file_hash or hash_file(cap_filename),
+        'parser_version': PARSER_VERSION,
+        'reader': reader,
+        'display_filter': display_filter,
+    }
+
+def hash_file(filename):
+    """
+    Returns the hex SHA-256 digest of the contents of the provided file.
+    """
+    file_hash = hashlib.sha256()
+    with open(filename, 'rb') as hash_input:
+        for block in iter(lambda: hash_input.read(1024 * 1024), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+def read_cache(cache_filename, cap_filename, reader, display_filter):
+    """
+    Returns a ColumnarTSAStream of the packets in the provided cache
+    file, whose columns are views of the memory mapped file. Returns
+    None if the cache file does not exist, or its key does not match
+    the provided capture file, reader and display filter.
+
+    Raises CaptureCacheException if the cache file is corrupt.
+    """
+    if not os.path.exists(cache_filename):
+        return None
+    with open(cache_filename, 'rb') as cache_file:
+        if os.fstat(cache_file.fileno()).st_size == 0:
+            raise CaptureCacheException("Cache file is empty")
+        buf = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+    header = _read_header(buf)
+
+    # Check the parts of the key that are cheap to compute first,
+    # so the capture file is only hashed if they match
+    key = get_cache_key(cap_filename, reader, display_filter,
+            file_hash=header['key'].get('sha256'))
+    if header['key'] != key or \
+            header['key']['sha256'] != hash_file(cap_filename):
+        return None
+
+    arrays = {}
+    for name, (dtype, offset, count) in header['arrays'].items():
+        if offset + count * np.dtype(dtype).itemsize > len(buf):
+            raise CaptureCacheException("Cache file is truncated")
+        arrays[name] = np.frombuffer(buf, dtype=dtype, count=count,
+                offset=offset)
+    return ColumnarTSAStream.from_arrays(arrays, header['dictionaries'])
+
+def write_cache(cache_filename, key, stream):
+    """
+    Writes the provided ColumnarTSAStream to the provided cache file,
+    with the provided cache key. The file is replaced atomically, so
+    readers never see a partially written cache.
+    """
+    (arrays, dictionaries) = stream.to_arrays()
+    header = {
+        'format': CACHE_FORMAT_VERSION,
+        'key': key,
+        'dictionaries': dictionaries,
+        'arrays': {},
+    }
+
+    # The array offsets depend on the header length, which depends on
+    # the offsets, so lay the arrays out relative to the end of the
+    # header first, then shift them by the aligned header length
+    relative_offset = 0
+    for name, array in sorted(arrays.items()):
+        header['arrays'][name] = [array.dtype.str, relative_offset, len(array)]
+        relative_offset = _align(relative_offset + array.nbytes)
+    header_bytes = json.dumps(header).encode()
+    data_start = _align(len(CACHE_MAGIC) + 4 + len(header_bytes) + 64)
+    for entry in header['arrays'].values():
+        entry[1] += data_start
+    header_bytes = json.dumps(header).encode()
+    if len(CACHE_MAGIC) + 4 + len(header_bytes) > data_start:
+        raise CaptureCacheException("Cache header grew while being laid out")
+
+    directory = os.path.dirname(os.path.abspath(cache_filename))
+    (fd, temp_filename) = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as cache_file:
+            cache_file.write(CACHE_MAGIC)
+            cache_file.write(struct.pack('<I', len(header_bytes)))
+            cache_file.write(header_bytes)
+            for name, array in sorted(arrays.items()):
+                cache_file.seek(header['arrays'][name][1])
+                cache_file.write(np.ascontiguousarray(array).tobytes())
+        # mkstemp creates the file readable by its owner only
+        os.chmod(temp_filename, 0o644)
+        os.replace(temp_filename, cache_filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
+
+def _read_header(buf):
+    magic_length = len(CACHE_MAGIC)
+    if len(buf) < magic_length + 4 or buf[:magic_length] != CACHE_MAGIC:
+        raise CaptureCacheException("Not a capture cache file")
+    (header_length,) = struct.unpack_from('<I', buf, magic_length)
+    try:
+        header = json.loads(buf[magic_length + 4:
+                magic_length + 4 + header_length].decode())
+    except ValueError:
+        raise CaptureCacheException("Cache file header is corrupt")
+    if header.get('format') != CACHE_FORMAT_VERSION:
+        raise CaptureCacheException("Unsupported cache format version")
+    return header
+
+def _align(offset):
+    return (offset + ARRAY_ALIGNMENT - 1) // ARRAY_ALIGNMENT * ARRAY_ALIGNMENT
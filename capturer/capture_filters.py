@@ -0,0 +1,125 @@
+"""
+Builds the BPF capture filters and tshark display filters applied to
+pyshark captures, so that packets TSAPacket.parse_pyshark_packet would
+reject are dropped by libpcap / tshark before they reach Python.
+
+The filters are conservative: they may let through packets the parser
+still rejects, but never drop a packet it would accept (other than
+those excluded by the user filters in the settings file).
+"""
+
+from capturer.utils import split_cdl
+from settings import get_setting
+
+import ipaddress
+
+# BPF filter for the packets the parser can accept: IPv4 or IPv6. It
+# is applied to untagged and VLAN tagged packets by build_bpf_filter.
+# The transport layer isn't tested, as the TCP / UDP header tshark
+# takes may be behind IPv6 extension headers, in a fragment, in a
+# tunnel, or quoted by an ICMP error, none of which BPF can follow.
+# Truncation can't be tested in BPF either (it only sees the captured
+# bytes), so both are left to the display filter.
+BPF_PARSEABLE = "ip or ip6"
+
+# Display filter mirroring each check in TSAPacket.parse_pyshark_packet
+DISPLAY_PARSEABLE = " and ".join([
+    "frame.cap_len == frame.len",
+    "(ip or ipv6)",
+    "((tcp and (tcp.flags.syn == 1 or tcp.flags.ack == 1)) or "
+            "(not tcp and udp))",
+    "not (dns and not dns.qry.name)",
+    "not (http and not dns and not (http.request.method or "
+            "http.response.code))",
+])
+
+class CaptureFilterException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+def get_exclude_subnets():
+    """
+    Returns a list of the ip_network objects in the ExcludeSubnets
+    setting. Raises CaptureFilterException if any are invalid.
+    """
+    setting = get_setting('filter', 'ExcludeSubnets')
+    subnets = []
+    for subnet in split_cdl(setting) if setting.strip() else []:
+        try:
+            subnets.append(ipaddress.ip_network(subnet, strict=False))
+        except ValueError:
+            raise CaptureFilterException("Invalid subnet '%s' in the " \
+                    "ExcludeSubnets setting" % subnet)
+    return subnets
+
+def build_bpf_filter():
+    """
+    Returns the BPF capture filter to apply to live captures, built
+    from the parser's criteria and the user filters in the settings
+    file, or None if pushdown is disabled and there are no user filters.
+
+    The vlan keyword shifts the offsets every test after it is made at,
+    so with pushdown enabled, the user filters are repeated in separate
+    branches for untagged and VLAN tagged packets.
+    """
+    clauses = []
+    for subnet in get_exclude_subnets():
+        clauses.append("not net %s" % subnet)
+    extra_filter = get_setting('filter', 'CaptureFilter').strip()
+    if extra_filter:
+        clauses.append(extra_filter)
+    if get_setting('filter', 'EnablePushdown', 'bool'):
+        return "(%s) or (%s)" % (_join([BPF_PARSEABLE] + clauses),
+                _join(["vlan", BPF_PARSEABLE] + clauses))
+    return _join(clauses)
+
+def build_display_filter(base_filter=None):
+    """
+    Returns the tshark display filter to apply to captures, built
+    from the parser's criteria and the user filters in the settings
+    file, or None if there is nothing to filter. If base_filter is
+    provided, it is combined with the result.
+    """
+    clauses = [base_filter] if base_filter else []
+    if get_setting('filter', 'EnablePushdown', 'bool'):
+        clauses.append(DISPLAY_PARSEABLE)
+    for subnet in get_exclude_subnets():
+        field = "ip.addr" if subnet.version == 4 else "ipv6.addr"
+        clauses.append("not %s == %s" % (field, subnet))
+    extra_filter = get_setting('filter', 'DisplayFilter').strip()
+    if extra_filter:
+        clauses.append(extra_filter)
+    return _join(clauses)
+
+def build_packet_predicate():
+    """
+    Returns a SubnetFilter for the ExcludeSubnets setting, or None if
+    it is empty. Used for packets read without tshark, so the same
+    packets are kept either way.
+    """
+    subnets = get_exclude_subnets()
+    return SubnetFilter(subnets) if subnets else None
+
+class SubnetFilter:
+    """
+    Callable that accepts a TSAPacket, and returns False if either of
+    its addresses is in one of the provided subnets (True otherwise).
+    Picklable, so it can be sent to parser worker processes.
+    """
+
+    def __init__(self, subnets):
+        self.subnets = subnets
+
+    def __call__(self, tsa_packet):
+        for addr in (tsa_packet.src_addr, tsa_packet.dst_addr):
+            ip_addr = ipaddress.ip_address(addr)
+            if any(ip_addr in subnet for subnet in self.subnets):
+                return False
+        return True
+
+def _join(clauses):
+    if not clauses:
+        return None
+    if len(clauses) == 1:
+        return clauses[0]
+    return " and ".join("(%s)" % clause for clause in clauses)
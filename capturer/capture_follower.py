@@ -0,0 +1,176 @@
+"""
+Follows a directory of rotating capture files written by an external
+capturer (e.g. tcpdump -G or dumpcap -b), reading the new records of
+the file currently being written as they appear, and moving on to
+the next file once the capturer has rotated to it.
+
+Progress is recorded in a checkpoint file, so that a restarted
+follower resumes where it left off, rather than reading the
+directory again from the start.
+"""
+
+from capturer import pcap_reader
+from capturer.pcap_reader import Chunk
+
+import fnmatch
+import json
+import os
+
+class CaptureFollower:
+    """
+    Reads the capture files in a directory whose names match the
+    provided glob pattern, in name order (which both tcpdump and
+    dumpcap name rotated files in).
+
+    Each call to poll returns the packets written since the last call.
+    Records the native reader could not decode are collected by frame
+    number for each file, and returned once the file is complete, so
+    that they can be parsed with pyshark. The packets after the first
+    of them in a file are not returned by poll, but left to be parsed
+    again along with them, so that they can be merged in frame order.
+    """
+
+    def __init__(self, directory, pattern="*.pcap*", checkpoint_filename=None):
+        self.directory = directory
+        self.pattern = pattern
+        self.checkpoint_filename = checkpoint_filename
+        # Name of the file being read, the Chunk to resume reading it
+        # from, and the frames in it that still need to be parsed
+        # with pyshark
+        self.current_file = None
+        self.resume_chunk = None
+        self.fallback_frames = []
+        if checkpoint_filename:
+            self._load_checkpoint()
+
+    def poll(self, rejections=None, is_included=None):
+        """
+        Reads the records written since the last call, and returns a
+        (tsa_packets, completed_files) tuple, where tsa_packets is a
+        list of the packets decoded (in file order), and completed_files
+        is a list of (path, fallback_frames) tuples for each file that
+        was finished, with the numbers of the frames in that file that
+        could not be decoded natively. If there are any, the packets of
+        that file from the first of them on are left out of tsa_packets,
+        and polling stops at the end of that file, so that the caller
+        can place them after tsa_packets and before the next file's.
+
+        rejections and is_included are passed through to
+        CaptureFile.parse.
+        """
+        tsa_packets = []
+        completed_files = []
+        while True:
+            filenames = self._list_files()
+            if self.current_file is None or \
+                    self.current_file not in filenames:
+                # Start with the oldest file, or the first one after the
+                # checkpointed file if it has since been deleted
+                later_files = [x for x in filenames if self.current_file
+                        is None or x > self.current_file]
+                if not later_files:
+                    break
+                self._start_file(later_files[0])
+
+            # Check for a newer file before reading, so that nothing
+            # written to this file before the rotation can be missed
+            is_rotated = filenames[-1] != self.current_file
+            self._read_current(tsa_packets, rejections, is_included)
+            if not is_rotated:
+                break
+            completed_files.append((self._current_path(),
+                    self.fallback_frames))
+            next_index = filenames.index(self.current_file) + 1
+            self._start_file(filenames[next_index])
+            if completed_files[-1][1]:
+                break
+
+        if self.checkpoint_filename:
+            self._save_checkpoint()
+        return (tsa_packets, completed_files)
+
+    def _list_files(self):
+        return sorted(x for x in os.listdir(self.directory)
+                if fnmatch.fnmatch(x, self.pattern) and
+                os.path.isfile(os.path.join(self.directory, x)))
+
+    def _current_path(self):
+        return os.path.join(self.directory, self.current_file)
+
+    def _start_file(self, filename):
+        self.current_file = filename
+        self.resume_chunk = None
+        self.fallback_frames = []
+
+    def _read_current(self, tsa_packets, rejections, is_included):
+        """
+        Reads the complete records written to the current file since
+        it was last read, and appends the decoded packets to tsa_packets,
+        up to the first record of the file that could not be decoded.
+        """
+        try:
+            capture_file = pcap_reader.open_capture(self._current_path())
+        except pcap_reader.PcapFormatException:
+            # The capturer has not written the file header yet (or the
+            # file is not a capture file, in which case it is skipped
+            # once the capturer moves on to the next file)
+            return
+        new_packets = []
+        new_fallback_frames = []
+        try:
+            chunk = self.resume_chunk
+            if chunk is not None:
+                if capture_file.size <= chunk.start:
+                    return
+                chunk = chunk._replace(end=capture_file.size)
+            for frame_number, tsa_packet in capture_file.parse(chunk,
+                    rejections, is_included):
+                if tsa_packet is None:
+                    new_fallback_frames.append(frame_number)
+                elif not (self.fallback_frames or new_fallback_frames):
+                    new_packets.append(tsa_packet)
+            resume_chunk = capture_file.resume_point(chunk)
+        except pcap_reader.PcapFormatException:
+            # Only advance past records that were all read successfully
+            return
+        finally:
+            capture_file.close()
+
+        tsa_packets.extend(new_packets)
+        self.fallback_frames.extend(new_fallback_frames)
+        self.resume_chunk = resume_chunk
+
+    def _load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_filename):
+            return
+        with open(self.checkpoint_filename) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        self.current_file = checkpoint['file']
+        self.fallback_frames = checkpoint['fallback_frames']
+        chunk = checkpoint['chunk']
+        self.resume_chunk = Chunk(chunk['start'], chunk['start'],
+                chunk['frame_offset'], chunk['endian'],
+                [tuple(x) for x in chunk['interfaces']])
+
+    def _save_checkpoint(self):
+        """
+        Writes the current file and offset to the checkpoint file.
+        The file is replaced atomically, so a crash while writing it
+        leaves the previous checkpoint intact.
+        """
+        if self.current_file is None or self.resume_chunk is None:
+            return
+        checkpoint = {
+            'file': self.current_file,
+            'fallback_frames': self.fallback_frames,
+            'chunk': {
+                'start': self.resume_chunk.start,
+                'frame_offset': self.resume_chunk.frame_offset,
+                'endian': self.resume_chunk.endian,
+                'interfaces': self.resume_chunk.interfaces,
+            },
+        }
+        temp_filename = self.checkpoint_filename + ".tmp"
+        with open(temp_filename, 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+        os.replace(temp_filename, self.checkpoint_filename)
@@ -0,0 +1,104 @@
+"""
+Merges the packets captured on several interfaces into a single
+stream, in timestamp order, without the copies of a packet that
+appear on more than one interface (e.g. because of port mirroring).
+"""
+
+import collections
+import heapq
+import itertools
+
+class CaptureMerger:
+    """
+    Reorders the packets added to it from several interfaces.
+
+    Packets are held back until merge_delay seconds (of wall clock
+    time) have passed since their timestamp, so that packets captured
+    at the same time on slower interfaces can be sorted in before them.
+    pop_ready then returns them in timestamp order.
+
+    A packet is dropped as a duplicate if a packet with the same
+    field values, captured on a different interface, was released
+    less than duplicate_window seconds before it.
+    """
+
+    def __init__(self, merge_delay, duplicate_window):
+        self.merge_delay = merge_delay
+        self.duplicate_window = duplicate_window
+        # (timestamp, insertion number, interface, tsa_packet) tuples
+        self._heap = []
+        self._counter = itertools.count()
+        # Duplicate key -> (timestamp, interface) of the last packet
+        # released with that key, and the (timestamp, key) pairs of
+        # the entries in release order, so they can be expired
+        self._recent = {}
+        self._recent_order = collections.deque()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, interface, tsa_packet):
+        """
+        Adds a packet captured on the provided interface.
+        """
+        heapq.heappush(self._heap, (tsa_packet.timestamp.timestamp(),
+                next(self._counter), interface, tsa_packet))
+
+    def next_ready_time(self):
+        """
+        Returns the wall clock time at which the oldest held packet
+        will be released, or None if no packets are held.
+        """
+        if not self._heap:
+            return None
+        return self._heap[0][0] + self.merge_delay
+
+    def pop_ready(self, now, duplicates=None):
+        """
+        Returns a list of (interface, tsa_packet) tuples of the held
+        packets that are ready to be released at wall clock time now,
+        in timestamp order. If a duplicates dictionary is provided,
+        the number of duplicates dropped on each interface is added
+        to it.
+        """
+        ready = []
+        heap = self._heap
+        while heap and heap[0][0] + self.merge_delay <= now:
+            (timestamp, _, interface, tsa_packet) = heapq.heappop(heap)
+            if self._is_duplicate(timestamp, interface, tsa_packet):
+                if duplicates is not None:
+                    duplicates[interface] = duplicates.get(interface, 0) + 1
+                continue
+            ready.append((interface, tsa_packet))
+        return ready
+
+    def _is_duplicate(self, timestamp, interface, tsa_packet):
+        recent = self._recent
+        recent_order = self._recent_order
+        while recent_order and \
+                recent_order[0][0] < timestamp - self.duplicate_window:
+            (old_timestamp, old_key) = recent_order.popleft()
+            if recent.get(old_key, (None,))[0] == old_timestamp:
+                del recent[old_key]
+
+        key = _duplicate_key(tsa_packet)
+        entry = recent.get(key)
+        if entry and entry[1] != interface and \
+                timestamp - entry[0] <= self.duplicate_window:
+            return True
+        recent[key] = (timestamp, interface)
+        recent_order.append((timestamp, key))
+        return False
+
+def _duplicate_key(tsa_packet):
+    """
+    Returns a tuple of the packet fields that copies of
+    the same packet captured on different interfaces share.
+    """
+    names = tsa_packet.dns_query_names
+    return (tsa_packet.src_addr, tsa_packet.dst_addr, tsa_packet.protocol,
+            tsa_packet.src_port, tsa_packet.dst_port, tsa_packet.tcp_op,
+            tsa_packet.length, tsa_packet.application_type,
+            tsa_packet.dns_query_resp, tuple(names) if names else None,
+            tsa_packet.dns_resp_ip, tsa_packet.http_method,
+            tsa_packet.http_status)
@@ -0,0 +1,246 @@
+"""
+Resolves the GeoIP country and p0f security info of the IP addresses
+seen in the capture in the background, and publishes them in a shared
+IP attribute table, so that analysis never blocks on either lookup.
+
+While the module is initialized, get_country_name and
+get_security_info only read the table, and return PENDING (or a
+security info dictionary whose fields are all PENDING) for
+addresses that have not been resolved yet. Otherwise, they look
+the address up directly, blocking until the lookup is done.
+
+This module should be initialized via the init_module method,
+after the wireshark proxy has been initialized.
+"""
+
+from capturer import geoip_proxy, p0f_proxy, telemetry, wireshark_proxy
+from settings import get_setting
+
+import queue
+import threading
+import time
+
+# Value of the attributes that are not resolved yet
+PENDING = "Pending"
+
+# Fields of the dictionaries returned by get_security_info
+SECURITY_INFO_FIELDS = ['os_name', 'os_full_name', 'app_name',
+        'app_full_name', 'language', 'link_type', 'num_hops', 'uptime']
+
+# IP address -> (country name, security info, time resolved). The
+# security info is UNRESOLVED if p0f could not be queried, in which
+# case the address is queued again the next time it is asked for.
+ip_attributes = {}
+UNRESOLVED = object()
+
+# Addresses waiting to be resolved, and the set of addresses
+# queued (or being resolved), so they are only queued once
+pending_queue = None
+pending_ips = set()
+
+# Lock guarding ip_attributes and pending_ips
+attributes_lock = threading.Lock()
+
+# Thread watching the capture for new addresses, and
+# the threads resolving the addresses it queues
+watcher_thread = None
+worker_threads = []
+
+# Set to stop the background threads
+stop_event = None
+
+def init_module():
+    """
+    Starts the background threads that watch the capture
+    for new addresses and resolve them.
+    """
+    global pending_queue, watcher_thread, worker_threads, stop_event
+    if watcher_thread:
+        raise RuntimeError("Attempted to double initialize enrichment module")
+
+    pending_queue = queue.Queue()
+    stop_event = threading.Event()
+    for _ in range(max(get_setting('enrichment', 'Workers', 'int'), 1)):
+        worker_thread = threading.Thread(target=_resolve_pending, daemon=True)
+        worker_thread.start()
+        worker_threads.append(worker_thread)
+    watcher_thread = threading.Thread(target=_watch_capture, daemon=True)
+    watcher_thread.start()
+    telemetry.register_collector(_collect_metrics)
+
+def cleanup():
+    """
+    Stops the background threads and returns
+    the module to its uninitialized state.
+    """
+    global pending_queue, watcher_thread, worker_threads, stop_event
+    if stop_event:
+        stop_event.set()
+        telemetry.unregister_collector(_collect_metrics)
+    for thread in [watcher_thread] + worker_threads:
+        if thread:
+            thread.join()
+    pending_queue = None
+    watcher_thread = None
+    worker_threads = []
+    stop_event = None
+    with attributes_lock:
+        ip_attributes.clear()
+        pending_ips.clear()
+
+def get_country_name(ip_addr):
+    """
+    Returns the name of the country the provided IP address maps
+    to in the geoip db, None if it doesn't map to one, or PENDING
+    if it has not been resolved yet.
+    """
+    if not watcher_thread:
+        return geoip_proxy.get_country_name(ip_addr)
+    attributes = _get_attributes(ip_addr)
+    return attributes[0] if attributes else PENDING
+
+def get_country_names(ip_addrs):
+    """
+    Returns a dictionary relating each of the provided IP addresses
+    to its country name, as returned by get_country_name. If the
+    module is not initialized, they are looked up in one batch.
+    """
+    if not watcher_thread:
+        return geoip_proxy.get_country_names(ip_addrs)
+    return {ip_addr: get_country_name(ip_addr) for ip_addr in ip_addrs}
+
+def get_security_info(ip_addr):
+    """
+    Returns the security info p0f has for the provided IP address
+    (see p0f_proxy.get_security_info), None if it has none, or a
+    dictionary with every field set to PENDING if it has not been
+    resolved yet.
+    """
+    if not watcher_thread:
+        return p0f_proxy.get_security_info(ip_addr)
+    attributes = _get_attributes(ip_addr)
+    if not attributes or attributes[1] is UNRESOLVED:
+        return {field: PENDING for field in SECURITY_INFO_FIELDS}
+    return attributes[1]
+
+def get_pending_count():
+    """
+    Returns the number of addresses waiting to be resolved.
+    """
+    with attributes_lock:
+        return len(pending_ips)
+
+def _collect_metrics():
+    """
+    Telemetry collector reporting the size of the attribute
+    table, and the number of addresses waiting to be resolved.
+    """
+    with attributes_lock:
+        return {
+            ('enrichment_table_entries', ()): len(ip_attributes),
+            ('enrichment_pending_addresses', ()): len(pending_ips),
+        }
+
+def _get_attributes(ip_addr):
+    """
+    Returns the table entry of the provided address, or None if it
+    has not been resolved yet, in which case it is queued to be
+    (as it is if its security info is UNRESOLVED).
+    """
+    with attributes_lock:
+        attributes = ip_attributes.get(ip_addr)
+    if attributes is None or attributes[1] is UNRESOLVED:
+        _enqueue([ip_addr])
+    return attributes
+
+def _enqueue(ip_addrs):
+    """
+    Queues the provided addresses to be resolved, other than those
+    already queued, and those fully resolved less than RefreshSeconds
+    ago.
+    """
+    refresh_time = time.time() - get_setting('enrichment',
+            'RefreshSeconds', 'int')
+    with attributes_lock:
+        for ip_addr in ip_addrs:
+            if ip_addr in pending_ips:
+                continue
+            attributes = ip_attributes.get(ip_addr)
+            if attributes and attributes[2] > refresh_time and \
+                    attributes[1] is not UNRESOLVED:
+                continue
+            pending_ips.add(ip_addr)
+            pending_queue.put(ip_addr)
+
+def _watch_capture():
+    """
+    Polls the capture for new packets, and queues their addresses.
+    Entries of addresses that have not been seen for twice the
+    RefreshSeconds setting are dropped from the table, so that it
+    doesn't grow without bound during a long capture.
+    """
+    poll_seconds = get_setting('enrichment', 'PollSeconds', 'int')
+    refresh_seconds = get_setting('enrichment', 'RefreshSeconds', 'int')
+    next_seq = 0
+    while not stop_event.is_set():
+        (tsa_stream, next_seq, _) = wireshark_proxy.read_packets_since(
+                next_seq)
+        ip_addrs = {}
+        for tsa_packet in tsa_stream:
+            ip_addrs[tsa_packet.src_addr] = None
+            ip_addrs[tsa_packet.dst_addr] = None
+        _enqueue(ip_addrs)
+
+        expiry_time = time.time() - 2 * refresh_seconds
+        with attributes_lock:
+            expired = [ip_addr for ip_addr, attributes in
+                    ip_attributes.items() if attributes[2] < expiry_time]
+            for ip_addr in expired:
+                del ip_attributes[ip_addr]
+        stop_event.wait(poll_seconds)
+
+def _resolve_pending():
+    """
+    Resolves queued addresses, in batches of up to BatchSize,
+    and publishes the results in the attribute table.
+    """
+    batch_size = get_setting('enrichment', 'BatchSize', 'int')
+    while not stop_event.is_set():
+        try:
+            ip_addrs = [pending_queue.get(timeout=1)]
+        except queue.Empty:
+            continue
+        while len(ip_addrs) < batch_size:
+            try:
+                ip_addrs.append(pending_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            _resolve_batch(ip_addrs)
+        except Exception as e:
+            print("Failed to resolve addresses: %s" % e)
+        finally:
+            # Addresses left unresolved are queued again the next
+            # time they are asked for
+            with attributes_lock:
+                pending_ips.difference_update(ip_addrs)
+
+def _resolve_batch(ip_addrs):
+    """
+    Looks up the provided addresses, and publishes the results in the
+    attribute table. If p0f can't be queried, their security info is
+    published as UNRESOLVED, rather than as no info, so that they are
+    looked up again instead of waiting for the next refresh.
+    """
+    try:
+        security_infos = p0f_proxy.get_security_info_batch(ip_addrs)
+    except (OSError, p0f_proxy.P0fException) as e:
+        print("Failed to look up security info: %s" % e)
+        security_infos = {ip_addr: UNRESOLVED for ip_addr in ip_addrs}
+    country_names = geoip_proxy.get_country_names(ip_addrs)
+    resolved_time = time.time()
+    with attributes_lock:
+        for ip_addr in ip_addrs:
+            ip_attributes[ip_addr] = (country_names[ip_addr],
+                    security_infos.get(ip_addr), resolved_time)
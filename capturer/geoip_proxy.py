@@ -3,26 +3,67 @@ This module serves as a proxy for geoip database reader.
 
 This module should be initialized via the init_module
 method before its other methods are used.
+
+The database is memory mapped rather than read into memory, and
+lookup results (including addresses that are not in the database)
+are kept in an LRU cache. Private, loopback and link-local addresses
+are never in the database, so they are not looked up at all.
+
+Many addresses can be looked up at once with get_country_names,
+which searches a flattened copy of the database (see geoip_ranges)
+if the EnableRangeTable setting is on.
 """
 
+from capturer import geoip_ranges, telemetry
+from capturer.utils import LRUCache
 from settings import get_setting
 
+import ipaddress
+import threading
+import time
+
 import geoip2.database
 import geoip2.errors
+import maxminddb
 
 # GEOIP Reader object for country lookup requests
 geoip_db_reader = None
 
+# Flattened copy of the database (a geoip_ranges.RangeTable), for
+# looking up many addresses at once
+range_table = None
+
+# Cache of country names (or None, for addresses
+# not in the database) by IP address
+country_cache = None
+
+# Number of lookups answered without the database, and number of
+# database lookups made and the total time they took (in seconds)
+num_local_lookups = 0
+num_db_lookups = 0
+db_lookup_time = 0.0
+stats_lock = threading.Lock()
+
+# Marks addresses missing from the cache, since None
+# is cached for addresses not in the database
+_NOT_CACHED = object()
+
 def init_module():
     """
     Initializes the geoip database reader.
     """
-    global geoip_db_reader
+    global geoip_db_reader, country_cache, range_table
     if geoip_db_reader:
         raise RuntimeError("Attempted to double initialize geoip module")
 
     database_path = get_setting('geoip', 'DatabaseFilePath')
-    geoip_db_reader = geoip2.database.Reader(database_path)
+    geoip_db_reader = geoip2.database.Reader(database_path,
+            mode=maxminddb.MODE_MMAP)
+    country_cache = LRUCache(get_setting('geoip', 'CacheMaxEntries', 'int')
+            or None)
+    telemetry.register_collector(_collect_cache_metrics)
+    if get_setting('geoip', 'EnableRangeTable', 'bool'):
+        range_table = geoip_ranges.load_range_table(database_path)
 
     # Ensure the reader is properly initialized
     try:
@@ -31,18 +72,96 @@ def init_module():
         pass
 
 def cleanup():
-    global geoip_db_reader
+    global geoip_db_reader, country_cache, range_table
+    global num_local_lookups, num_db_lookups, db_lookup_time
     if geoip_db_reader:
+        geoip_db_reader.close()
         geoip_db_reader = None
+        telemetry.unregister_collector(_collect_cache_metrics)
+    country_cache = None
+    range_table = None
+    with stats_lock:
+        num_local_lookups = 0
+        num_db_lookups = 0
+        db_lookup_time = 0.0
 
 def get_country_name(ip_addr):
     """
     Takes in an ip address (string) and returns the
     country name (string) it maps to in the geoip db.
     """
-    global geoip_db_reader
-    try:
-        name = geoip_db_reader.country(ip_addr).country.name
+    global num_local_lookups, num_db_lookups, db_lookup_time
+    name = country_cache.get(ip_addr, _NOT_CACHED)
+    if name is not _NOT_CACHED:
         return name
-    except geoip2.errors.AddressNotFoundError:
+
+    address = ipaddress.ip_address(ip_addr)
+    if address.is_private or address.is_loopback or address.is_link_local:
+        with stats_lock:
+            num_local_lookups += 1
+        name = None
+    else:
+        start_time = time.perf_counter()
+        try:
+            name = geoip_db_reader.country(ip_addr).country.name
+        except geoip2.errors.AddressNotFoundError:
+            name = None
+        lookup_time = time.perf_counter() - start_time
+        with stats_lock:
+            num_db_lookups += 1
+            db_lookup_time += lookup_time
+        telemetry.observe('geoip_lookup_seconds', lookup_time)
+
+    country_cache.put(ip_addr, name)
+    return name
+
+def get_country_names(ip_addrs):
+    """
+    Takes in an iterable of ip addresses (strings) and returns a
+    dictionary relating each to the country name (string) it maps
+    to in the geoip db, or None if it doesn't map to one.
+    """
+    ip_addrs = list(ip_addrs)
+    if range_table is None:
+        return {ip_addr: get_country_name(ip_addr) for ip_addr in ip_addrs}
+
+    ip_countries = {}
+    names = range_table.get_country_names(ip_addrs)
+    for ip_addr, name in zip(ip_addrs, names):
+        if name == geoip_ranges.MIXED:
+            name = get_country_name(ip_addr)
+        ip_countries[ip_addr] = name
+    return ip_countries
+
+def get_cache_stats():
+    """
+    Returns a dictionary of the lookup cache's counters (see
+    LRUCache.get_stats), plus the number of misses answered
+    without the database (local_lookups), the number of database
+    lookups (db_lookups), and their mean latency in seconds
+    (mean_db_lookup_time). Returns None if the module is not
+    initialized.
+    """
+    if not geoip_db_reader:
         return None
+    stats = country_cache.get_stats()
+    with stats_lock:
+        stats['local_lookups'] = num_local_lookups
+        stats['db_lookups'] = num_db_lookups
+        stats['mean_db_lookup_time'] = db_lookup_time / num_db_lookups \
+                if num_db_lookups else 0
+    return stats
+
+def _collect_cache_metrics():
+    """
+    Telemetry collector reporting the lookup cache's counters.
+    """
+    stats = get_cache_stats()
+    if stats is None:
+        return {}
+    return {
+        ('geoip_cache_hits_total', ()): stats['hits'],
+        ('geoip_cache_misses_total', ()): stats['misses'],
+        ('geoip_cache_entries', ()): stats['size'],
+        ('geoip_local_lookups_total', ()): stats['local_lookups'],
+    }
@@ -0,0 +1,286 @@
+"""
+Flattens the search tree of a MaxMind (.mmdb) country database into
+sorted arrays of address ranges, so that whole arrays of addresses can
+be mapped to countries at once with numpy.searchsorted, instead of
+walking the tree for each address.
+
+IPv4 addresses are encoded as uint32 integers. IPv6 addresses are
+encoded as the uint64 integer of their upper 64 bits, which decides
+their country for all networks no longer than /64 (which are all the
+networks in the database, other than the IPv4 subtree it maps into
+::/96). Those /64 networks whose country depends on the lower bits are
+marked MIXED in the table, and must be looked up in the database.
+
+The arrays are saved next to the database (see RANGE_TABLE_SUFFIX)
+the first time it is flattened, and loaded from there afterwards.
+
+Data records are decoded with maxminddb's Decoder, which is not part
+of its documented API (Decoder(buffer, pointer_base) and decode(offset)
+returning a (value, next offset) tuple, as of the pinned 1.3.0). If it
+can't be imported, each record is instead found with Reader.get on the
+first address of a network that points to it.
+"""
+
+import ipaddress
+import os
+import socket
+
+import maxminddb
+import numpy as np
+
+try:
+    from maxminddb.decoder import Decoder
+except ImportError:
+    Decoder = None
+
+RANGE_TABLE_SUFFIX = ".ranges.npz"
+
+# Bump this when the layout of the saved arrays changes
+RANGE_TABLE_VERSION = 1
+
+# Country ids of addresses not in the database, and of IPv6
+# addresses whose country can't be determined from the table
+NOT_FOUND = -1
+MIXED = -2
+
+# Size of the separator between the search tree and the data section
+DATA_SECTION_SEPARATOR_SIZE = 16
+
+class RangeTable:
+    """
+    Sorted, non-overlapping [start, end] address ranges, and the id
+    of the country of each (an index into country_names).
+    """
+
+    def __init__(self, ipv4_ranges, ipv6_ranges, country_names):
+        (self.ipv4_starts, self.ipv4_ends, self.ipv4_ids) = ipv4_ranges
+        (self.ipv6_starts, self.ipv6_ends, self.ipv6_ids) = ipv6_ranges
+        self.country_names = country_names
+
+    def lookup_ipv4(self, addresses):
+        """
+        Returns an array of the country ids of the provided
+        array of uint32 encoded IPv4 addresses.
+        """
+        return _lookup(self.ipv4_starts, self.ipv4_ends, self.ipv4_ids,
+                np.asarray(addresses, dtype=np.uint32))
+
+    def lookup_ipv6(self, addresses):
+        """
+        Returns an array of the country ids of the provided array
+        of IPv6 addresses, encoded as uint64 upper 64 bits.
+        """
+        return _lookup(self.ipv6_starts, self.ipv6_ends, self.ipv6_ids,
+                np.asarray(addresses, dtype=np.uint64))
+
+    def get_country_names(self, ip_addrs):
+        """
+        Returns a list of the country name of each of the provided IP
+        addresses (strings), or None for those not in the database,
+        and MIXED for IPv6 addresses that must be looked up in it.
+        """
+        ipv4_indices = []
+        ipv4_addresses = []
+        ipv6_indices = []
+        ipv6_addresses = []
+        for index, ip_addr in enumerate(ip_addrs):
+            if ':' in ip_addr:
+                ipv6_indices.append(index)
+                ipv6_addresses.append(int.from_bytes(socket.inet_pton(
+                        socket.AF_INET6, ip_addr)[:8], 'big'))
+            else:
+                ipv4_indices.append(index)
+                ipv4_addresses.append(int.from_bytes(socket.inet_aton(
+                        ip_addr), 'big'))
+
+        names = [None] * len(ip_addrs)
+        lookups = [(ipv4_indices, self.lookup_ipv4(ipv4_addresses)),
+                (ipv6_indices, self.lookup_ipv6(ipv6_addresses))]
+        for indices, country_ids in lookups:
+            for index, country_id in zip(indices, country_ids.tolist()):
+                if country_id == MIXED:
+                    names[index] = MIXED
+                elif country_id != NOT_FOUND:
+                    names[index] = self.country_names[country_id]
+        return names
+
+def load_range_table(database_path):
+    """
+    Returns the RangeTable of the provided database, loaded from
+    its saved arrays if they are up to date, or built from the
+    database (and saved for next time) if they are not.
+    """
+    table_path = database_path + RANGE_TABLE_SUFFIX
+    key = _get_key(database_path)
+    if os.path.exists(table_path):
+        with np.load(table_path) as arrays:
+            if arrays['key'].tolist() == key:
+                return RangeTable(
+                        (arrays['ipv4_starts'], arrays['ipv4_ends'],
+                            arrays['ipv4_ids']),
+                        (arrays['ipv6_starts'], arrays['ipv6_ends'],
+                            arrays['ipv6_ids']),
+                        arrays['country_names'].tolist())
+
+    table = build_range_table(database_path)
+    temp_path = table_path + ".tmp.npz"
+    try:
+        np.savez(temp_path, key=np.array(key, dtype=np.int64),
+                ipv4_starts=table.ipv4_starts, ipv4_ends=table.ipv4_ends,
+                ipv4_ids=table.ipv4_ids, ipv6_starts=table.ipv6_starts,
+                ipv6_ends=table.ipv6_ends, ipv6_ids=table.ipv6_ids,
+                country_names=np.array(table.country_names, dtype=str))
+        os.replace(temp_path, table_path)
+    except OSError as e:
+        # The table still works, it just has to be rebuilt next time
+        print("Failed to save GeoIP range table: %s" % e)
+    return table
+
+def build_range_table(database_path):
+    """
+    Returns the RangeTable of the provided database, built by walking
+    every path of its search tree.
+    """
+    reader = maxminddb.open_database(database_path, maxminddb.MODE_MMAP)
+    try:
+        return _build_range_table(reader, database_path)
+    finally:
+        reader.close()
+
+def _build_range_table(reader, database_path):
+    metadata = reader.metadata()
+    with open(database_path, 'rb') as database_file:
+        buf = database_file.read()
+
+    node_count = metadata.node_count
+    (left, right) = _read_nodes(buf, node_count, metadata.record_size)
+    search_tree_size = metadata.node_byte_size * node_count
+    if Decoder is not None:
+        decoder = Decoder(buf, search_tree_size + DATA_SECTION_SEPARATOR_SIZE)
+
+    def decode(data_offset, address):
+        if Decoder is not None:
+            return decoder.decode(data_offset)[0]
+        return reader.get(str(address))
+
+    # Data section offset -> country id, and country name -> country id
+    country_ids = {}
+    name_ids = {}
+    def get_country_id(record, address):
+        data_offset = record - node_count + search_tree_size
+        if data_offset not in country_ids:
+            data = decode(data_offset, address) or {}
+            name = data.get('country', {}).get('names', {}).get('en')
+            if name is None:
+                country_ids[data_offset] = NOT_FOUND
+            else:
+                country_ids[data_offset] = name_ids.setdefault(name,
+                        len(name_ids))
+        return country_ids[data_offset]
+
+    # IPv4 addresses are found under ::/96 in IPv6 databases
+    ipv4_root = 0
+    if metadata.ip_version == 6:
+        for _ in range(96):
+            if ipv4_root >= node_count:
+                break
+            ipv4_root = left[ipv4_root]
+    ipv4_ranges = _walk(ipv4_root, 32, left, right, node_count,
+            lambda record, start: get_country_id(record,
+                ipaddress.IPv4Address(start)))
+    if metadata.ip_version == 6:
+        ipv6_ranges = _walk(0, 64, left, right, node_count,
+                lambda record, start: get_country_id(record,
+                    ipaddress.IPv6Address(start << 64)))
+    else:
+        ipv6_ranges = _walk(node_count, 64, left, right, node_count,
+                get_country_id)
+
+    return RangeTable(_to_arrays(ipv4_ranges, np.uint32),
+            _to_arrays(ipv6_ranges, np.uint64), list(name_ids))
+
+def _get_key(database_path):
+    stat = os.stat(database_path)
+    return [RANGE_TABLE_VERSION, stat.st_size, stat.st_mtime_ns]
+
+def _read_nodes(buf, node_count, record_size):
+    """
+    Returns lists of the left and right records of each search tree
+    node (see the MaxMind DB format spec, "Search Tree Section").
+    """
+    node_size = record_size // 4
+    nodes = np.frombuffer(buf, dtype=np.uint8, count=node_count * node_size)
+    nodes = nodes.reshape(node_count, node_size).astype(np.uint32)
+    if record_size == 24:
+        left = (nodes[:, 0] << 16) | (nodes[:, 1] << 8) | nodes[:, 2]
+        right = (nodes[:, 3] << 16) | (nodes[:, 4] << 8) | nodes[:, 5]
+    elif record_size == 28:
+        left = ((nodes[:, 3] & 0xF0) << 20) | (nodes[:, 0] << 16) | \
+                (nodes[:, 1] << 8) | nodes[:, 2]
+        right = ((nodes[:, 3] & 0x0F) << 24) | (nodes[:, 4] << 16) | \
+                (nodes[:, 5] << 8) | nodes[:, 6]
+    elif record_size == 32:
+        left = (nodes[:, 0] << 24) | (nodes[:, 1] << 16) | \
+                (nodes[:, 2] << 8) | nodes[:, 3]
+        right = (nodes[:, 4] << 24) | (nodes[:, 5] << 16) | \
+                (nodes[:, 6] << 8) | nodes[:, 7]
+    else:
+        raise ValueError("Unsupported record size %d" % record_size)
+    return (left.tolist(), right.tolist())
+
+def _walk(root, num_bits, left, right, node_count, get_country_id):
+    """
+    Returns a sorted list of the [start, end, country id] ranges
+    of the num_bits bit addresses under the provided node, with
+    adjacent ranges of the same country merged. Networks longer than
+    num_bits bits are given the country id MIXED.
+    """
+    ranges = []
+    # (record, depth, prefix) tuples, with the
+    # right child pushed first, so that ranges are
+    # produced in address order
+    stack = [(root, 0, 0)]
+    while stack:
+        (record, depth, prefix) = stack.pop()
+        if record < node_count and depth < num_bits:
+            stack.append((right[record], depth + 1, (prefix << 1) | 1))
+            stack.append((left[record], depth + 1, prefix << 1))
+            continue
+
+        start = prefix << (num_bits - depth)
+        if record < node_count:
+            country_id = MIXED
+        elif record == node_count:
+            country_id = NOT_FOUND
+        else:
+            country_id = get_country_id(record, start)
+        if country_id == NOT_FOUND:
+            continue
+        end = start + (1 << (num_bits - depth)) - 1
+        if ranges and ranges[-1][2] == country_id and \
+                ranges[-1][1] + 1 == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end, country_id])
+    return ranges
+
+def _to_arrays(ranges, dtype):
+    if not ranges:
+        return (np.zeros(0, dtype=dtype), np.zeros(0, dtype=dtype),
+                np.zeros(0, dtype=np.int32))
+    (starts, ends, ids) = zip(*ranges)
+    return (np.array(starts, dtype=dtype), np.array(ends, dtype=dtype),
+            np.array(ids, dtype=np.int32))
+
+def _lookup(starts, ends, ids, addresses):
+    """
+    Returns the id of the range each address is in, or
+    NOT_FOUND for the addresses that aren't in one.
+    """
+    indices = np.searchsorted(starts, addresses, side='right') - 1
+    found = indices >= 0
+    indices[~found] = 0
+    if len(starts):
+        found &= addresses <= ends[indices]
+        return np.where(found, ids[indices], NOT_FOUND)
+    return np.full(len(addresses), NOT_FOUND, dtype=np.int32)
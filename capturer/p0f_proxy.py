@@ -3,29 +3,150 @@ This module serves as a proxy for the p0f capturer / database.
 
 This module should be initialized via either of the init methods
 before its other methods are used.
+
+Lookups are made over a single connection to the p0f API socket,
+which is kept open between queries, and their results are cached
+(see the [p0f] cache settings). Hosts p0f has not fingerprinted yet
+are cached too, for a shorter time, so that they are not queried
+again for every packet.
 """
 
-from p0f import P0f, P0fException
+from capturer import telemetry
+from capturer.utils import LRUCache
 from settings import get_setting
 
 import os
+import socket
+import struct
 import subprocess
 import sys
+import threading
+
+# Seconds to wait for p0f to answer a query
+API_TIMEOUT = 1
 
-# p0f database containing current
-# security data for all seen hosts
+# Client connected to the API socket of the
+# p0f process, which holds the security data
+# for all seen hosts
 p0f_db = None
 
 # Background process where p0f will run
 background_proc = None
 
+# Cache of processed security info (or None, for
+# hosts p0f has no data on) by IP address
+info_cache = None
+
+# Number of cache hits that were for hosts p0f has no data on, and
+# the lock guarding it, as lookups are made from several threads
+num_negative_hits = 0
+negative_hits_lock = threading.Lock()
+
+# Marks addresses missing from the cache, since
+# None is cached for hosts p0f has no data on
+_NOT_CACHED = object()
+
+class P0fException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+class P0fClient:
+    """
+    Client for the p0f API (see p0f's docs/README, section 4).
+    A single connection to the API socket is used for all queries,
+    and reopened if p0f closes it.
+    """
+
+    QUERY_MAGIC = 0x50304601
+    RESPONSE_MAGIC = 0x50304602
+
+    STATUS_BAD_QUERY = 0x00
+    STATUS_OK = 0x10
+    STATUS_NO_MATCH = 0x20
+
+    QUERY_FORMAT = struct.Struct("=IB16s")
+    RESPONSE_FORMAT = struct.Struct("=IIIIIIIIIhBB32s32s32s32s32s32s")
+    RESPONSE_FIELDS = ['magic', 'status', 'first_seen', 'last_seen',
+            'total_conn', 'uptime_min', 'up_mod_days', 'last_nat',
+            'last_chg', 'distance', 'bad_sw', 'os_match_q', 'os_name',
+            'os_flavor', 'http_name', 'http_flavor', 'link_type', 'language']
+
+    def __init__(self, socket_path, timeout=API_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.num_queries = 0
+        self._sock = None
+        self._lock = threading.Lock()
+
+    def get_info(self, host_ip):
+        """
+        Returns the raw p0f data for the provided IP address as a
+        dictionary (keyed by RESPONSE_FIELDS, with the string fields
+        as null padded bytes), or None if p0f has no data on the host.
+
+        Raises P0fException if the query fails.
+        """
+        if ':' in host_ip:
+            query = self.QUERY_FORMAT.pack(self.QUERY_MAGIC, 6,
+                    socket.inet_pton(socket.AF_INET6, host_ip))
+        else:
+            query = self.QUERY_FORMAT.pack(self.QUERY_MAGIC, 4,
+                    socket.inet_pton(socket.AF_INET, host_ip))
+
+        with self._lock:
+            self.num_queries += 1
+            try:
+                response = self._send(query)
+            except (OSError, P0fException):
+                # p0f closes idle connections, so retry once on a new one
+                self._close()
+                response = self._send(query)
+
+        raw_info = dict(zip(self.RESPONSE_FIELDS,
+                self.RESPONSE_FORMAT.unpack(response)))
+        if raw_info['magic'] != self.RESPONSE_MAGIC:
+            raise P0fException("Invalid response magic from p0f")
+        if raw_info['status'] == self.STATUS_NO_MATCH:
+            return None
+        if raw_info['status'] != self.STATUS_OK:
+            raise P0fException("p0f rejected the query for %s" % host_ip)
+        return raw_info
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _send(self, query):
+        if self._sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            self._sock = sock
+        self._sock.sendall(query)
+        response = b""
+        while len(response) < self.RESPONSE_FORMAT.size:
+            data = self._sock.recv(self.RESPONSE_FORMAT.size - len(response))
+            if not data:
+                raise P0fException("p0f closed the API connection")
+            response += data
+        return response
+
+    def _close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
 def _init_p0f(flag, value):
     """
     Helper function for the init methods: performs most
     of the work for setting up background process and
     API socket database hook.
     """
-    global p0f_db, background_proc
+    global p0f_db, background_proc, info_cache
     if p0f_db:
         raise RuntimeError("Attempted to double initialize p0f proxy.")
 
@@ -36,7 +157,9 @@ def _init_p0f(flag, value):
     background_proc = subprocess.Popen(["p0f", "-f", database_path,
         "-s", socket_path, flag, value], stdout=open(os.devnull, 'w'),
         stderr=subprocess.STDOUT, close_fds=True)
-    p0f_db = P0f(socket_path)
+    p0f_db = P0fClient(socket_path)
+    info_cache = LRUCache(get_setting('p0f', 'CacheMaxEntries', 'int') or None)
+    telemetry.register_collector(_collect_cache_metrics)
 
 def init_from_file(cap_filename):
     """
@@ -58,12 +181,17 @@ def cleanup():
     Stops any background processes / threads and
     returns the module to its uninitialized state.
     """
-    global p0f_db, background_proc
+    global p0f_db, background_proc, info_cache, num_negative_hits
     if p0f_db:
+        p0f_db.close()
         p0f_db = None
+        telemetry.unregister_collector(_collect_cache_metrics)
     if background_proc:
         background_proc.kill()
         background_proc = None
+    info_cache = None
+    with negative_hits_lock:
+        num_negative_hits = 0
 
 def get_security_info(host_ip):
     """
@@ -82,68 +210,128 @@ def get_security_info(host_ip):
         num_hops:  network distance in packet hops
         uptime:  estimated uptime of the system (in minutes)
     """
-    global p0f_db
     if not p0f_db:
         return None
+    return get_security_info_batch([host_ip])[host_ip]
 
-    try:
-        raw_info = p0f_db.get_info(host_ip)
-        results = {}
+def get_security_info_batch(host_ips):
+    """
+    Returns a dictionary relating each of the provided IP addresses
+    to its security information (as returned by get_security_info),
+    or None if its host has not been seen yet.
 
-        # Perform some processing on the string fields
-        os_name_raw = raw_info['os_name'].decode('utf8')
-        os_flavor_raw = raw_info['os_flavor'].decode('utf8')
-        if os_name_raw[0] != "\0":
-            os_name = os_name_raw.rstrip(" \0")
-            os_full_name = (os_name + " " + os_flavor_raw).rstrip(" \0")
-        else:
-            os_name = None
-            os_full_name = None
-
-        http_name_raw = raw_info['http_name'].decode('utf8')
-        http_flavor_raw = raw_info['http_name'].decode('utf8')
-        if http_name_raw[0] != "\0":
-            app_name = http_name_raw.rstrip(" \0")
-            app_full_name = (app_name + " " + http_flavor_raw).rstrip(" \0")
-        else:
-            app_name = None
-            app_full_name = None
+    Addresses that are not cached are all looked up over the
+    same p0f API connection.
+    """
+    global num_negative_hits
+    if not p0f_db:
+        return {host_ip: None for host_ip in host_ips}
 
-        language_raw = raw_info['language'].decode('utf8')
-        if language_raw[0] != "\0":
-            language = language_raw.rstrip(" \0")
-        else:
-            language = None
+    positive_ttl = get_setting('p0f', 'CacheTTLSeconds', 'int')
+    negative_ttl = get_setting('p0f', 'NegativeCacheTTLSeconds', 'int')
+    results = {}
+    for host_ip in host_ips:
+        if host_ip in results:
+            continue
+        info = info_cache.get(host_ip, _NOT_CACHED)
+        if info is None:
+            with negative_hits_lock:
+                num_negative_hits += 1
+        elif info is _NOT_CACHED:
+            raw_info = p0f_db.get_info(host_ip)
+            info = _process_raw_info(raw_info) if raw_info else None
+            info_cache.put(host_ip, info,
+                    positive_ttl if info else negative_ttl)
+        results[host_ip] = info
+    return results
 
-        link_type_raw = raw_info['link_type'].decode('utf8')
-        if link_type_raw[0] != "\0":
-            link_type = str(link_type_raw).rstrip(" \0")
-        else:
-            link_type = language
+def get_cache_stats():
+    """
+    Returns a dictionary of the lookup cache's counters (see
+    LRUCache.get_stats), plus the number of hits that were for
+    hosts p0f has no data on (negative_hits), and the number of
+    queries sent to p0f (queries). Returns None if the module is
+    not initialized.
+    """
+    if not p0f_db:
+        return None
+    stats = info_cache.get_stats()
+    with negative_hits_lock:
+        stats['negative_hits'] = num_negative_hits
+    stats['queries'] = p0f_db.num_queries
+    return stats
 
-        # Perform some processing on the integer fields
-        if raw_info['distance'] and int(raw_info['distance']) != -1:
-            num_hops = int(raw_info['distance'])
-        else:
-            num_hops = None
+def _collect_cache_metrics():
+    """
+    Telemetry collector reporting the lookup cache's counters.
+    """
+    stats = get_cache_stats()
+    if stats is None:
+        return {}
+    return {
+        ('p0f_cache_hits_total', ()): stats['hits'],
+        ('p0f_cache_negative_hits_total', ()): stats['negative_hits'],
+        ('p0f_cache_misses_total', ()): stats['misses'],
+        ('p0f_cache_entries', ()): stats['size'],
+        ('p0f_queries_total', ()): stats['queries'],
+    }
 
-        if raw_info['uptime_min'] and int(raw_info['uptime_min']) != 0:
-            uptime = int(raw_info['uptime_min'])
-        else:
-            uptime = None
-
-        # Combine the processed results into a dict and return it
-        processed_info = {
-            'os_name': os_name,
-            'os_full_name': os_full_name,
-            'app_name': app_name,
-            'app_full_name': app_full_name,
-            'language': language,
-            'link_type': link_type,
-            'num_hops': num_hops,
-            'uptime': uptime,
-        }
-        return processed_info
-
-    except KeyError:
-        return None
+def _process_raw_info(raw_info):
+    """
+    Converts the raw p0f data returned by P0fClient.get_info
+    into the dictionary returned by get_security_info.
+    """
+    # Perform some processing on the string fields
+    os_name_raw = raw_info['os_name'].decode('utf8')
+    os_flavor_raw = raw_info['os_flavor'].decode('utf8')
+    if os_name_raw[0] != "\0":
+        os_name = os_name_raw.rstrip(" \0")
+        os_full_name = (os_name + " " + os_flavor_raw).rstrip(" \0")
+    else:
+        os_name = None
+        os_full_name = None
+
+    http_name_raw = raw_info['http_name'].decode('utf8')
+    http_flavor_raw = raw_info['http_name'].decode('utf8')
+    if http_name_raw[0] != "\0":
+        app_name = http_name_raw.rstrip(" \0")
+        app_full_name = (app_name + " " + http_flavor_raw).rstrip(" \0")
+    else:
+        app_name = None
+        app_full_name = None
+
+    language_raw = raw_info['language'].decode('utf8')
+    if language_raw[0] != "\0":
+        language = language_raw.rstrip(" \0")
+    else:
+        language = None
+
+    link_type_raw = raw_info['link_type'].decode('utf8')
+    if link_type_raw[0] != "\0":
+        link_type = str(link_type_raw).rstrip(" \0")
+    else:
+        link_type = language
+
+    # Perform some processing on the integer fields
+    if raw_info['distance'] and int(raw_info['distance']) != -1:
+        num_hops = int(raw_info['distance'])
+    else:
+        num_hops = None
+
+    if raw_info['uptime_min'] and int(raw_info['uptime_min']) != 0:
+        uptime = int(raw_info['uptime_min'])
+    else:
+        uptime = None
+
+    # Combine the processed results into a dict and return it
+    processed_info = {
+        'os_name': os_name,
+        'os_full_name': os_full_name,
+        'app_name': app_name,
+        'app_full_name': app_full_name,
+        'language': language,
+        'link_type': link_type,
+        'num_hops': num_hops,
+        'uptime': uptime,
+    }
+    return processed_info
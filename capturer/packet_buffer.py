@@ -0,0 +1,367 @@
+"""
+Defines the ring buffer the wireshark proxy stores captured packets in,
+and the on-disk store packets evicted from it can be spilled to.
+"""
+
+import collections
+import glob
+import itertools
+import os
+import pickle
+import sys
+import threading
+import zlib
+
+class PacketBuffer:
+    """
+    Thread safe, bounded buffer of the most recently captured TSAPackets.
+
+    Every packet placed into the buffer is given a sequence number, one
+    higher than that of the packet placed before it. Consumers can
+    remember the sequence number they have read up to, and use
+    read_since to fetch only the packets captured after it.
+
+    The buffer retains packets subject to any combination of limits:
+        maxlen:  maximum number of packets
+        max_age:  maximum age of a packet (in seconds), measured from
+                  the timestamp of the newest packet in the buffer
+        max_bytes:  maximum estimated memory use of the packets
+    Once a limit is exceeded, the packets with the lowest sequence
+    numbers are evicted. If a SpillStore is provided, evicted packets
+    are written to it, and can still be read back with read_tail and
+    read_range.
+
+    Listeners (see add_listener) are told about every packet placed
+    into the buffer and every packet removed from it, so that they
+    can maintain results derived from its contents incrementally.
+
+    All methods may be called while another thread is appending
+    packets: reads always return a consistent snapshot.
+    """
+
+    def __init__(self, maxlen=None, max_age=None, max_bytes=None,
+            spill_store=None):
+        self._lock = threading.Lock()
+        self._packets = collections.deque()
+        self._next_seq = 0
+        self._num_bytes = 0
+        self._num_evicted = 0
+        self.maxlen = maxlen
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.spill_store = spill_store
+        self._listeners = []
+
+    def __len__(self):
+        return len(self._packets)
+
+    @property
+    def next_seq(self):
+        """
+        Sequence number the next packet placed into the buffer will get.
+        """
+        return self._next_seq
+
+    @property
+    def num_bytes(self):
+        """
+        Estimated memory use of the packets in the buffer (in bytes).
+        """
+        return self._num_bytes
+
+    @property
+    def num_evicted(self):
+        """
+        Number of packets evicted by the retention limits so far
+        (whether or not they were spilled). Packets removed by
+        clear or close are not counted.
+        """
+        return self._num_evicted
+
+    def add_listener(self, listener):
+        """
+        Registers a listener, whose on_append method is called with
+        each packet placed into the buffer, and whose on_evict method
+        is called with each packet removed from it (oldest first).
+        Both are called while the buffer is locked, so they should
+        return quickly, and must not call back into the buffer.
+
+        on_append is first called with each packet already in the
+        buffer, so the listener starts out in step with its contents.
+        """
+        with self._lock:
+            for tsa_packet in self._packets:
+                listener.on_append(tsa_packet)
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """
+        Unregisters a listener registered with add_listener.
+        """
+        with self._lock:
+            self._listeners.remove(listener)
+
+    def append(self, tsa_packet):
+        """
+        Places a packet into the buffer, and returns its sequence number.
+        """
+        with self._lock:
+            self._append(tsa_packet)
+            return self._next_seq - 1
+
+    def extend(self, tsa_packets):
+        """
+        Places each of the provided packets into the buffer, in order.
+        """
+        with self._lock:
+            for tsa_packet in tsa_packets:
+                self._append(tsa_packet)
+
+    def clear(self):
+        """
+        Evicts every packet from the buffer, without spilling them.
+        Sequence numbers keep counting up from where they were.
+        """
+        with self._lock:
+            for listener in self._listeners:
+                for tsa_packet in self._packets:
+                    listener.on_evict(tsa_packet)
+            self._packets.clear()
+            self._num_bytes = 0
+
+    def close(self):
+        """
+        Clears the buffer, and deletes any spilled packets.
+        """
+        self.clear()
+        if self.spill_store:
+            self.spill_store.clear()
+
+    def read_tail(self, num_packets=None):
+        """
+        Returns a list of the last num_packets packets captured (or all
+        packets in the buffer, if num_packets is None), oldest first.
+        If more packets are asked for than are in the buffer, the rest
+        are read back from the spill store (if there is one).
+        """
+        with self._lock:
+            if num_packets is None:
+                return list(self._packets)
+            if num_packets <= len(self._packets):
+                return self._read_last(num_packets)
+            tsa_packets = list(self._packets)
+            if self.spill_store:
+                oldest_seq = self._next_seq - len(self._packets)
+                num_spilled = num_packets - len(tsa_packets)
+                tsa_packets = self.spill_store.read(
+                        start_seq=oldest_seq - num_spilled) + tsa_packets
+            return tsa_packets
+
+    def read_since(self, seq):
+        """
+        Returns a (tsa_packets, next_seq, oldest_seq) tuple, where
+        tsa_packets is a list of the packets in the buffer with a
+        sequence number of seq or higher (oldest first), next_seq is
+        the sequence number to pass to the next call, and oldest_seq
+        is the sequence number of the oldest packet still in the buffer.
+
+        Every packet numbered below oldest_seq has been evicted, so if
+        oldest_seq is greater than seq, (oldest_seq - seq) packets were
+        missed since the last read.
+        """
+        with self._lock:
+            oldest_seq = self._next_seq - len(self._packets)
+            num_new = self._next_seq - max(seq, oldest_seq)
+            tsa_packets = self._read_last(num_new) if num_new > 0 else []
+            return (tsa_packets, self._next_seq, oldest_seq)
+
+    def read_range(self, start_time=None, end_time=None):
+        """
+        Returns a list of all captured packets with a timestamp in
+        [start_time, end_time), including those in the spill store.
+        Either bound may be None, in which case it is not applied.
+        """
+        def in_range(tsa_packet):
+            return (start_time is None or tsa_packet.timestamp >= start_time) \
+                    and (end_time is None or tsa_packet.timestamp < end_time)
+
+        with self._lock:
+            tsa_packets = []
+            if self.spill_store:
+                tsa_packets = self.spill_store.read(start_time=start_time,
+                        end_time=end_time)
+            tsa_packets.extend(filter(in_range, self._packets))
+            return tsa_packets
+
+    def _read_last(self, num_packets):
+        """
+        Returns a list of the last num_packets packets in the buffer.
+        Walks the buffer from the newest end, so the cost only depends
+        on num_packets. The caller must hold the lock.
+        """
+        tsa_packets = list(itertools.islice(reversed(self._packets),
+                num_packets))
+        tsa_packets.reverse()
+        return tsa_packets
+
+    def _append(self, tsa_packet):
+        """
+        Places a packet into the buffer. The caller must hold the lock.
+        """
+        self._packets.append(tsa_packet)
+        self._num_bytes += estimate_packet_size(tsa_packet)
+        self._next_seq += 1
+        for listener in self._listeners:
+            listener.on_append(tsa_packet)
+        self._enforce_limits()
+
+    def _enforce_limits(self):
+        """
+        Evicts packets until the buffer is within all of its limits.
+        The caller must hold the lock.
+        """
+        packets = self._packets
+        while len(packets) > 1 and self._over_limit():
+            tsa_packet = packets.popleft()
+            self._num_bytes -= estimate_packet_size(tsa_packet)
+            self._num_evicted += 1
+            for listener in self._listeners:
+                listener.on_evict(tsa_packet)
+            if self.spill_store:
+                oldest_seq = self._next_seq - len(packets) - 1
+                self.spill_store.add(oldest_seq, tsa_packet)
+
+    def _over_limit(self):
+        packets = self._packets
+        if self.maxlen and len(packets) > self.maxlen:
+            return True
+        if self.max_bytes and self._num_bytes > self.max_bytes:
+            return True
+        if self.max_age:
+            age = packets[-1].timestamp - packets[0].timestamp
+            if age.total_seconds() > self.max_age:
+                return True
+        return False
+
+
+class SpillStore:
+    """
+    Store for packets evicted from a PacketBuffer.
+
+    Packets are collected in memory until segment_size of them have
+    been added, then written out together as a compressed segment file
+    in the provided directory. If max_segments is provided, the oldest
+    segments are deleted once there are more than that many.
+    """
+
+    SEGMENT_PATTERN = "tsa-segment-*.bin"
+
+    def __init__(self, directory, segment_size=10000, max_segments=None):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        # (first_seq, last_seq, first_time, last_time, path)
+        # tuple for each segment written, oldest first
+        self._segments = collections.deque()
+        self._pending = []
+        self._pending_first_seq = None
+        self._segment_number = 0
+
+        # Segments left behind by a previous run can't be read
+        # back consistently, so start with an empty directory
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory,
+                SpillStore.SEGMENT_PATTERN)):
+            os.remove(path)
+
+    def add(self, seq, tsa_packet):
+        """
+        Adds an evicted packet, with the provided sequence number.
+        """
+        if self._pending and \
+                seq != self._pending_first_seq + len(self._pending):
+            # Segments hold consecutive sequence numbers only
+            self._write_segment()
+        if not self._pending:
+            self._pending_first_seq = seq
+        self._pending.append(tsa_packet)
+        if len(self._pending) >= self.segment_size:
+            self._write_segment()
+
+    def read(self, start_seq=None, start_time=None, end_time=None):
+        """
+        Returns a list of the spilled packets with a sequence number
+        of start_seq or higher, and a timestamp in [start_time,
+        end_time), oldest first. Bounds that are None are not applied.
+        """
+        tsa_packets = []
+        for (first_seq, last_seq, first_time, last_time,
+                path) in list(self._segments):
+            if start_seq is not None and last_seq < start_seq:
+                continue
+            if start_time is not None and last_time < start_time:
+                continue
+            if end_time is not None and first_time >= end_time:
+                continue
+            with open(path, 'rb') as segment_file:
+                segment = pickle.loads(zlib.decompress(segment_file.read()))
+            tsa_packets.extend(self._select(segment, first_seq,
+                    start_seq, start_time, end_time))
+        if self._pending:
+            tsa_packets.extend(self._select(self._pending,
+                    self._pending_first_seq, start_seq, start_time,
+                    end_time))
+        return tsa_packets
+
+    def clear(self):
+        """
+        Deletes every spilled packet.
+        """
+        for segment in self._segments:
+            if os.path.exists(segment[-1]):
+                os.remove(segment[-1])
+        self._segments.clear()
+        self._pending = []
+
+    @staticmethod
+    def _select(segment, first_seq, start_seq, start_time, end_time):
+        if start_seq is not None and start_seq > first_seq:
+            segment = segment[start_seq - first_seq:]
+        return [x for x in segment if
+                (start_time is None or x.timestamp >= start_time) and
+                (end_time is None or x.timestamp < end_time)]
+
+    def _write_segment(self):
+        timestamps = [x.timestamp for x in self._pending]
+        path = os.path.join(self.directory, SpillStore.SEGMENT_PATTERN.replace(
+                "*", "%08d" % self._segment_number))
+        with open(path, 'wb') as segment_file:
+            segment_file.write(zlib.compress(pickle.dumps(self._pending,
+                    pickle.HIGHEST_PROTOCOL)))
+
+        self._segments.append((self._pending_first_seq,
+                self._pending_first_seq + len(self._pending) - 1,
+                min(timestamps), max(timestamps), path))
+        self._segment_number += 1
+        self._pending = []
+
+        while self.max_segments and len(self._segments) > self.max_segments:
+            os.remove(self._segments.popleft()[-1])
+
+def estimate_packet_size(tsa_packet):
+    """
+    Returns a rough estimate of the memory (in bytes) used
+    by a TSAPacket and the field values it references.
+    """
+    size = sys.getsizeof(tsa_packet) + sys.getsizeof(tsa_packet.timestamp) + \
+            sys.getsizeof(tsa_packet.src_addr) + \
+            sys.getsizeof(tsa_packet.dst_addr)
+    if tsa_packet.dns_query_names:
+        size += sys.getsizeof(tsa_packet.dns_query_names) + \
+                sum(map(sys.getsizeof, tsa_packet.dns_query_names))
+    if tsa_packet.dns_resp_ip:
+        size += sys.getsizeof(tsa_packet.dns_resp_ip)
+    if tsa_packet.dns_resp_ips:
+        size += sys.getsizeof(tsa_packet.dns_resp_ips) + \
+                sum(map(sys.getsizeof, tsa_packet.dns_resp_ips))
+    return size
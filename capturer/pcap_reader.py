@@ -0,0 +1,826 @@
+"""
+Native reader for .pcap and .pcapng capture files.
+
+Walks the record headers of the capture file directly (over an mmap)
+and decodes the Ethernet / IP / TCP / UDP / DNS / HTTP data needed
+for a TSAPacket from the raw bytes, without running tshark.
+
+Records this reader cannot decode itself (unsupported link types,
+IP fragments, tunnelled or malformed packets, ...) are reported to
+the caller by frame number, so they can be parsed with pyshark.
+"""
+
+from capturer.tsa_packet import TSAPacket, TSAPacketParseException
+from capturer.utils import min_dns_ttl
+from datetime import datetime
+
+import collections
+import mmap
+import socket
+import struct
+
+# Link layer header types (see http://www.tcpdump.org/linktypes.html)
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+RAW_IP_LINKTYPES = (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6, 12, 14)
+
+# Ethertypes
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+VLAN_ETHERTYPES = (0x8100, 0x88A8, 0x9100)
+NON_IP_ETHERTYPES = (0x0806, 0x8035, 0x88CC, 0x888E, 0x88F7, 0x8808)
+
+# IP protocol numbers
+IPPROTO_ICMP = 1
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+IPPROTO_ICMPV6 = 58
+IPPROTO_NONE = 59
+TUNNEL_IPPROTOS = (4, 41, 47)
+IPV6_EXTENSION_HEADERS = (0, 43, 60)
+IPV6_FRAGMENT_HEADER = 44
+IPV6_AUTH_HEADER = 51
+
+# ICMP types whose payload embeds the offending IP packet
+ICMP_ERROR_TYPES = (3, 4, 5, 11, 12)
+
+# TCP flags
+TCP_FLAG_SYN = 0x02
+TCP_FLAG_ACK = 0x10
+
+# Ports tshark dissects DNS and HTTP on by default
+DNS_PORT = 53
+HTTP_PORTS = (80, 3128, 3132, 5985, 8080, 8088, 11371)
+
+HTTP_METHODS = (b'GET', b'POST', b'HEAD', b'PUT', b'DELETE', b'OPTIONS',
+                b'TRACE', b'CONNECT', b'PATCH', b'PROPFIND', b'PROPPATCH',
+                b'MKCOL', b'COPY', b'MOVE', b'LOCK', b'UNLOCK', b'SEARCH',
+                b'NOTIFY', b'SUBSCRIBE', b'UNSUBSCRIBE', b'M-SEARCH')
+
+# DNS resource record types
+DNS_TYPE_A = 1
+DNS_TYPE_AAAA = 28
+
+# pcap file magic numbers, and the timestamp resolution they imply
+PCAP_MAGICS = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1000000),
+    b'\xa1\xb2\xc3\xd4': ('>', 1000000),
+    b'\x4d\x3c\xb2\xa1': ('<', 1000000000),
+    b'\xa1\xb2\x3c\x4d': ('>', 1000000000),
+}
+
+# pcapng block types
+PCAPNG_SECTION_HEADER = 0x0A0D0D0A
+PCAPNG_INTERFACE_DESCRIPTION = 0x00000001
+PCAPNG_OBSOLETE_PACKET = 0x00000002
+PCAPNG_SIMPLE_PACKET = 0x00000003
+PCAPNG_ENHANCED_PACKET = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_OPTION_TSRESOL = 9
+PCAPNG_PACKET_BLOCKS = (PCAPNG_ENHANCED_PACKET, PCAPNG_OBSOLETE_PACKET,
+                        PCAPNG_SIMPLE_PACKET)
+
+def open_capture(cap_filename):
+    """
+    Opens the provided .pcap / .pcapng file, and returns a
+    CaptureFile for it.
+
+    Raises PcapFormatException if the file is in neither format.
+    """
+    return CaptureFile(cap_filename)
+
+class CaptureFile:
+    """
+    Read-only, memory mapped view of a .pcap or .pcapng file.
+
+    Iterating over a CaptureFile yields a (frame_number, result)
+    tuple for each record in the file, where result is the parsed
+    TSAPacket, or None if the record could not be decoded natively.
+    Records that were decoded but rejected (i.e. for which the parser
+    raised a TSAPacketParseException) are skipped.
+
+    The file may also be split into record aligned Chunks (see split),
+    which can be parsed independently of each other.
+    """
+
+    def __init__(self, cap_filename):
+        self._file = open(cap_filename, 'rb')
+        try:
+            self._buf = mmap.mmap(self._file.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            self._file.close()
+            raise PcapFormatException("Capture file is empty")
+
+        magic = self._buf[:4]
+        if magic in PCAP_MAGICS:
+            self.format = 'pcap'
+        elif len(self._buf) >= 12 and struct.unpack_from('<I',
+                self._buf, 0)[0] == PCAPNG_SECTION_HEADER:
+            self.format = 'pcapng'
+        else:
+            self.close()
+            raise PcapFormatException("File is neither a pcap " +
+                    "nor a pcapng file")
+
+    def __iter__(self):
+        return self.parse()
+
+    @property
+    def size(self):
+        """
+        Size of the file (in bytes), as of when it was opened.
+        """
+        return len(self._buf)
+
+    def close(self):
+        if self._buf:
+            self._buf.close()
+            self._buf = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def parse(self, chunk=None, rejections=None, is_included=None,
+            start_frame=None):
+        """
+        Yields a (frame_number, result) tuple for each record in the
+        provided chunk (or the whole file, if no chunk is provided),
+        as described in the class description.
+
+        If a rejections dictionary is provided, the number of records
+        rejected for each reason is added to it. If is_included is
+        provided, decoded packets it returns False for are rejected
+        too, with the reason "excluded". If start_frame is provided,
+        records numbered below it are skipped without being decoded.
+        """
+        for (frame_number, timestamp, link_type, offset, captured_length,
+                length) in self.records(chunk):
+            if start_frame is not None and frame_number < start_frame:
+                continue
+            try:
+                tsa_packet = decode_packet(self._buf, offset,
+                        captured_length, length, link_type, timestamp)
+                if is_included is not None and not is_included(tsa_packet):
+                    raise TSAPacketParseException("Packet excluded by the "
+                            "packet filter", "excluded")
+                yield (frame_number, tsa_packet)
+            except TSAPacketParseException as e:
+                if rejections is not None:
+                    rejections[e.reason] = rejections.get(e.reason, 0) + 1
+                continue
+            except UnsupportedPacketException:
+                yield (frame_number, None)
+
+    def records(self, chunk=None):
+        """
+        Yields a (frame_number, timestamp, link_type, offset,
+        captured_length, length) tuple for each packet record in the
+        provided chunk (or the whole file, if no chunk is provided),
+        where offset is the position of the packet data in the file,
+        and timestamp is in seconds since the epoch.
+
+        Raises PcapFormatException if the file is corrupt.
+        """
+        if chunk is None:
+            chunk = self._whole_file()
+        if self.format == 'pcap':
+            return self._pcap_records(chunk)
+        else:
+            return self._pcapng_records(chunk)
+
+    def split(self, num_chunks):
+        """
+        Splits the file into at most num_chunks Chunks of roughly
+        equal size, by walking the record headers. Parsing each of the
+        returned chunks in order yields the same records as parsing
+        the whole file.
+
+        Raises PcapFormatException if the file is corrupt.
+        """
+        whole_file = self._whole_file()
+        target_size = max(1, (len(self._buf) - whole_file.start) //
+                max(1, num_chunks))
+        chunks = []
+        chunk_start = whole_file
+
+        if self.format == 'pcap':
+            frame_number = 0
+            for record_offset in self._pcap_record_offsets(whole_file):
+                if record_offset - chunk_start.start >= target_size:
+                    chunks.append(chunk_start._replace(end=record_offset))
+                    chunk_start = chunk_start._replace(start=record_offset,
+                            frame_offset=frame_number)
+                frame_number += 1
+
+        else:
+            # Only split before packet blocks, so the section state
+            # at the start of each chunk is not affected by the split
+            frame_number = 0
+            for (block_offset, block_type, _, endian,
+                    interfaces) in self._pcapng_blocks(whole_file):
+                if block_type not in PCAPNG_PACKET_BLOCKS:
+                    continue
+                if block_offset - chunk_start.start >= target_size:
+                    chunks.append(chunk_start._replace(end=block_offset))
+                    chunk_start = Chunk(block_offset, whole_file.end,
+                            frame_number, endian, list(interfaces))
+                frame_number += 1
+
+        chunks.append(chunk_start)
+        return chunks
+
+    def resume_point(self, chunk=None):
+        """
+        Returns the Chunk to continue reading the file from, after all
+        of the complete records in the provided chunk (or the whole
+        file, if no chunk is provided) have been read. It starts after
+        the last complete record, and ends at the end of the file.
+
+        Used to read a file that is still being written: once more of
+        the file has been written, reopen it, and parse the returned
+        chunk (with its end moved to the new end of the file).
+
+        Raises PcapFormatException if the file is corrupt.
+        """
+        if chunk is None:
+            chunk = self._whole_file()
+        offset = chunk.start
+        frame_number = chunk.frame_offset
+        endian = chunk.endian
+        interfaces = list(chunk.interfaces)
+
+        if self.format == 'pcap':
+            record_header = struct.Struct(chunk.endian + 'IIII')
+            for record_offset in self._pcap_record_offsets(chunk):
+                captured_length = record_header.unpack_from(self._buf,
+                        record_offset)[2]
+                offset = record_offset + 16 + captured_length
+                frame_number += 1
+        else:
+            for (block_offset, block_type, block_length, endian,
+                    interfaces) in self._pcapng_blocks(chunk):
+                offset = block_offset + block_length
+                if block_type in PCAPNG_PACKET_BLOCKS:
+                    frame_number += 1
+            interfaces = list(interfaces)
+
+        return Chunk(offset, len(self._buf), frame_number, endian, interfaces)
+
+    def _whole_file(self):
+        """
+        Returns the Chunk covering all of the records in the file.
+        """
+        buf = self._buf
+        if self.format == 'pcapng':
+            return Chunk(0, len(buf), 0, '<', [])
+
+        if len(buf) < 24:
+            raise PcapFormatException("Truncated pcap file header")
+        (endian, resolution) = PCAP_MAGICS[buf[:4]]
+        link_type = struct.unpack_from(endian + 'I', buf, 20)[0] & 0xFFFF
+        return Chunk(24, len(buf), 0, endian, [(link_type, resolution)])
+
+    def _pcap_record_offsets(self, chunk):
+        """
+        Yields the offset of each complete record header in the
+        provided chunk of a pcap file.
+        """
+        buf = self._buf
+        end = chunk.end
+        record_header = struct.Struct(chunk.endian + 'IIII')
+
+        offset = chunk.start
+        while offset + 16 <= end:
+            captured_length = record_header.unpack_from(buf, offset)[2]
+            if offset + 16 + captured_length > end:
+                # Last record was cut off (e.g. capture still running)
+                break
+            yield offset
+            offset += 16 + captured_length
+
+    def _pcap_records(self, chunk):
+        buf = self._buf
+        (link_type, resolution) = chunk.interfaces[0]
+        record_header = struct.Struct(chunk.endian + 'IIII')
+
+        frame_number = chunk.frame_offset
+        for offset in self._pcap_record_offsets(chunk):
+            (ts_sec, ts_frac, captured_length, length) = \
+                    record_header.unpack_from(buf, offset)
+            frame_number += 1
+            yield (frame_number, ts_sec + ts_frac / resolution, link_type,
+                    offset + 16, captured_length, length)
+
+    def _pcapng_blocks(self, chunk):
+        """
+        Yields a (offset, block_type, block_length, endian, interfaces)
+        tuple for each complete block in the provided chunk of a pcapng
+        file, where endian and interfaces are the byte order and list of
+        (link_type, resolution) tuples of the enclosing section.
+        """
+        buf = self._buf
+        end = chunk.end
+        endian = chunk.endian
+        interfaces = list(chunk.interfaces)
+
+        offset = chunk.start
+        while offset + 12 <= end:
+            block_type = struct.unpack_from(endian + 'I', buf, offset)[0]
+
+            if block_type == PCAPNG_SECTION_HEADER:
+                # Each section may use a different byte order, and
+                # has its own set of interfaces
+                magic = struct.unpack_from('<I', buf, offset + 8)[0]
+                endian = '<' if magic == PCAPNG_BYTE_ORDER_MAGIC else '>'
+                interfaces = []
+
+            block_length = struct.unpack_from(endian + 'I', buf,
+                    offset + 4)[0]
+            if block_length < 12 or block_length % 4:
+                raise PcapFormatException("Corrupt pcapng block " +
+                        "at offset %d" % offset)
+            if offset + block_length > end:
+                break
+
+            if block_type == PCAPNG_INTERFACE_DESCRIPTION:
+                link_type = struct.unpack_from(endian + 'H', buf,
+                        offset + 8)[0]
+                resolution = _pcapng_tsresol(buf, endian, offset + 16,
+                        offset + block_length - 4)
+                interfaces.append((link_type, resolution))
+
+            yield (offset, block_type, block_length, endian, interfaces)
+            offset += block_length
+
+    def _pcapng_records(self, chunk):
+        buf = self._buf
+
+        frame_number = chunk.frame_offset
+        for (offset, block_type, block_length, endian,
+                interfaces) in self._pcapng_blocks(chunk):
+            if block_type not in PCAPNG_PACKET_BLOCKS:
+                continue
+            body = offset + 8
+
+            if block_type == PCAPNG_SIMPLE_PACKET:
+                # Simple packet blocks carry no timestamp
+                (link_type, _) = interfaces[0]
+                length = struct.unpack_from(endian + 'I', buf, body)[0]
+                captured_length = min(length, block_length - 16)
+                frame_number += 1
+                yield (frame_number, 0.0, link_type, body + 4,
+                        captured_length, length)
+                continue
+
+            if block_type == PCAPNG_ENHANCED_PACKET:
+                (if_id, ts_high, ts_low, captured_length, length) = \
+                        struct.unpack_from(endian + 'IIIII', buf, body)
+            else:
+                (if_id, _, ts_high, ts_low, captured_length, length) = \
+                        struct.unpack_from(endian + 'HHIIII', buf, body)
+            if if_id >= len(interfaces):
+                raise PcapFormatException("Packet block references " +
+                        "unknown interface %d" % if_id)
+            (link_type, resolution) = interfaces[if_id]
+            frame_number += 1
+            yield (frame_number, ((ts_high << 32) | ts_low) / resolution,
+                    link_type, body + 20, captured_length, length)
+
+# Record aligned section of a capture file. Contains the start and end
+# offsets of the section, the number of frames that precede it in the
+# file, and the byte order and interfaces in effect at its start.
+Chunk = collections.namedtuple('Chunk',
+        ['start', 'end', 'frame_offset', 'endian', 'interfaces'])
+
+def parse_chunk(cap_filename, chunk, keep_last=None, is_included=None):
+    """
+    Parses the provided chunk of the provided capture file. Intended
+    to be run in a worker process, so only picklable values are used.
+
+    Returns a (num_packets, tsa_packets, fallback_frames, rejections)
+    tuple, where num_packets is the number of packets parsed,
+    tsa_packets the list of parsed TSAPackets (only the last keep_last,
+    if provided), fallback_frames the numbers of the frames that could
+    not be decoded natively, and rejections a dictionary relating
+    rejection reasons to the number of records rejected for them.
+    is_included is passed through to CaptureFile.parse.
+    """
+    num_packets = 0
+    tsa_packets = collections.deque(maxlen=keep_last)
+    fallback_frames = []
+    rejections = {}
+    capture_file = open_capture(cap_filename)
+    try:
+        for frame_number, tsa_packet in capture_file.parse(chunk,
+                rejections, is_included):
+            if tsa_packet:
+                num_packets += 1
+                tsa_packets.append(tsa_packet)
+            else:
+                fallback_frames.append(frame_number)
+    finally:
+        capture_file.close()
+
+    return (num_packets, list(tsa_packets), fallback_frames, rejections)
+
+def _pcapng_tsresol(buf, endian, offset, end):
+    """
+    Returns the timestamp resolution (in units per second) declared
+    by the options of a pcapng interface description block.
+    """
+    while offset + 4 <= end:
+        (code, length) = struct.unpack_from(endian + 'HH', buf, offset)
+        if code == 0:
+            break
+        if code == PCAPNG_OPTION_TSRESOL and length >= 1:
+            tsresol = buf[offset + 4]
+            if tsresol & 0x80:
+                return 2 ** (tsresol & 0x7F)
+            return 10 ** tsresol
+        offset += 4 + ((length + 3) & ~3)
+    return 1000000
+
+### PACKET DECODING ###
+
+def decode_packet(buf, offset, captured_length, length, link_type,
+        timestamp):
+    """
+    Decodes the raw packet data at buf[offset:offset+captured_length]
+    and returns a TSAPacket created from it, mirroring the checks done
+    by TSAPacket.parse_pyshark_packet.
+
+    Raises TSAPacketParseException if the packet should be rejected,
+    or UnsupportedPacketException if it cannot be decoded natively.
+    """
+    if captured_length != length:
+        raise TSAPacketParseException("Failed to capture entire packet",
+                "truncated")
+    end = offset + captured_length
+
+    init_data = {}
+    init_data['timestamp'] = datetime.fromtimestamp(timestamp)
+
+    # Extract network layer data
+    (ip_offset, ip_version) = _decode_link_layer(buf, offset, end,
+            link_type)
+    if ip_version == 4:
+        (transport_proto, transport_offset, end) = _decode_ipv4(buf,
+                ip_offset, end, init_data)
+    else:
+        (transport_proto, transport_offset, end) = _decode_ipv6(buf,
+                ip_offset, end, init_data)
+
+    # Extract transport layer data
+    if transport_proto == IPPROTO_TCP:
+        payload_offset = _decode_tcp(buf, transport_offset, end, init_data)
+    elif transport_proto == IPPROTO_UDP:
+        payload_offset = _decode_udp(buf, transport_offset, end, init_data)
+    else:
+        raise TSAPacketParseException("Packet missing transport layer " +
+                "(TCP or UDP)", "no_transport")
+
+    # Extract application layer data (if any)
+    src_port = init_data['src_port']
+    dst_port = init_data['dst_port']
+    if DNS_PORT in (src_port, dst_port) and payload_offset < end:
+        if init_data['protocol'] == "tcp":
+            payload_offset = _strip_dns_tcp_length(buf, payload_offset, end)
+        _decode_dns(buf, payload_offset, end, init_data)
+    elif init_data['protocol'] == "tcp" and payload_offset < end and \
+            (src_port in HTTP_PORTS or dst_port in HTTP_PORTS) and \
+            _decode_http(buf, payload_offset, end, init_data):
+        pass
+    else:
+        init_data['application_type'] = "none"
+
+    # Extract packet length (in bytes)
+    init_data['length'] = length
+
+    return TSAPacket(init_data)
+
+def _decode_link_layer(buf, offset, end, link_type):
+    """
+    Strips the link layer header, and returns the offset of the IP
+    header along with the IP version (4 or 6) of the packet.
+    """
+    if link_type == LINKTYPE_ETHERNET:
+        _require(buf, offset, end, 14)
+        ethertype = struct.unpack_from('>H', buf, offset + 12)[0]
+        offset += 14
+        while ethertype in VLAN_ETHERTYPES:
+            _require(buf, offset, end, 4)
+            ethertype = struct.unpack_from('>H', buf, offset + 2)[0]
+            offset += 4
+        ip_version = _ethertype_to_ip_version(ethertype)
+
+    elif link_type == LINKTYPE_LINUX_SLL:
+        _require(buf, offset, end, 16)
+        ethertype = struct.unpack_from('>H', buf, offset + 14)[0]
+        offset += 16
+        ip_version = _ethertype_to_ip_version(ethertype)
+
+    elif link_type == LINKTYPE_LINUX_SLL2:
+        _require(buf, offset, end, 20)
+        ethertype = struct.unpack_from('>H', buf, offset)[0]
+        offset += 20
+        ip_version = _ethertype_to_ip_version(ethertype)
+
+    elif link_type in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        # The address family header is in host byte order, so
+        # look at the IP header itself to find out the version
+        _require(buf, offset, end, 5)
+        offset += 4
+        ip_version = buf[offset] >> 4
+
+    elif link_type in RAW_IP_LINKTYPES:
+        _require(buf, offset, end, 1)
+        ip_version = buf[offset] >> 4
+
+    else:
+        raise UnsupportedPacketException("Unsupported link type %d" %
+                link_type)
+
+    if ip_version not in (4, 6):
+        raise TSAPacketParseException("Packet missing required IP layer",
+                "no_ip")
+    return (offset, ip_version)
+
+def _ethertype_to_ip_version(ethertype):
+    if ethertype == ETHERTYPE_IPV4:
+        return 4
+    elif ethertype == ETHERTYPE_IPV6:
+        return 6
+    elif ethertype <= 1500 or ethertype in NON_IP_ETHERTYPES:
+        # 802.3 length field, ARP, LLDP, EAPOL, ...
+        return None
+    else:
+        # MPLS, PPPoE, ... may still carry an IP packet
+        raise UnsupportedPacketException("Unsupported ethertype 0x%04x" %
+                ethertype)
+
+def _decode_ipv4(buf, offset, end, init_data):
+    """
+    Decodes an IPv4 header into init_data, and returns the transport
+    protocol, transport header offset and end of the IP payload.
+    """
+    _require(buf, offset, end, 20)
+    header_length = (buf[offset] & 0x0F) * 4
+    (total_length, frag) = struct.unpack_from('>HxxH', buf, offset + 2)
+    protocol = buf[offset + 9]
+    _require(buf, offset, end, max(header_length, 20))
+
+    init_data['ip_version'] = "ipv4"
+    init_data['src_addr'] = "%d.%d.%d.%d" % tuple(buf[offset+12:offset+16])
+    init_data['dst_addr'] = "%d.%d.%d.%d" % tuple(buf[offset+16:offset+20])
+
+    # Fragments need tshark's IP reassembly
+    if frag & 0x3FFF:
+        raise UnsupportedPacketException("Fragmented IPv4 packet")
+
+    payload_offset = offset + header_length
+    end = min(end, offset + total_length)
+    _check_embedded_protocol(buf, protocol, payload_offset, end)
+    return (protocol, payload_offset, end)
+
+def _decode_ipv6(buf, offset, end, init_data):
+    """
+    Decodes an IPv6 header (and its extension headers) into init_data,
+    and returns the transport protocol, transport header offset and
+    end of the IP payload.
+    """
+    _require(buf, offset, end, 40)
+    payload_length = struct.unpack_from('>H', buf, offset + 4)[0]
+    protocol = buf[offset + 6]
+
+    init_data['ip_version'] = "ipv6"
+    init_data['src_addr'] = socket.inet_ntop(socket.AF_INET6,
+            buf[offset+8:offset+24])
+    init_data['dst_addr'] = socket.inet_ntop(socket.AF_INET6,
+            buf[offset+24:offset+40])
+
+    payload_offset = offset + 40
+    if payload_length:
+        end = min(end, payload_offset + payload_length)
+    while protocol in IPV6_EXTENSION_HEADERS or \
+            protocol == IPV6_AUTH_HEADER:
+        _require(buf, payload_offset, end, 2)
+        next_protocol = buf[payload_offset]
+        if protocol == IPV6_AUTH_HEADER:
+            payload_offset += (buf[payload_offset + 1] + 2) * 4
+        else:
+            payload_offset += (buf[payload_offset + 1] + 1) * 8
+        protocol = next_protocol
+    if protocol == IPV6_FRAGMENT_HEADER:
+        raise UnsupportedPacketException("Fragmented IPv6 packet")
+
+    _check_embedded_protocol(buf, protocol, payload_offset, end)
+    return (protocol, payload_offset, end)
+
+def _check_embedded_protocol(buf, protocol, offset, end):
+    """
+    Raises UnsupportedPacketException for IP payloads that tshark
+    would dissect another IP / transport layer out of (tunnels and
+    ICMP error messages).
+    """
+    if protocol in TUNNEL_IPPROTOS:
+        raise UnsupportedPacketException("Tunnelled IP packet")
+    if protocol == IPPROTO_ICMP and offset < end and \
+            buf[offset] in ICMP_ERROR_TYPES:
+        raise UnsupportedPacketException("ICMP error message")
+    if protocol == IPPROTO_ICMPV6 and offset < end and buf[offset] < 128:
+        raise UnsupportedPacketException("ICMPv6 error message")
+
+def _decode_tcp(buf, offset, end, init_data):
+    """
+    Decodes a TCP header into init_data, and returns the
+    offset of the TCP payload.
+    """
+    _require(buf, offset, end, 20)
+    (src_port, dst_port) = struct.unpack_from('>HH', buf, offset)
+    header_length = (buf[offset + 12] >> 4) * 4
+    flags = buf[offset + 13]
+
+    init_data['protocol'] = "tcp"
+    init_data['src_port'] = src_port
+    init_data['dst_port'] = dst_port
+
+    is_syn = bool(flags & TCP_FLAG_SYN)
+    is_ack = bool(flags & TCP_FLAG_ACK)
+    if is_syn and is_ack:
+        init_data['tcp_op'] = "SYN-ACK"
+    elif is_syn:
+        init_data['tcp_op'] = "SYN"
+    elif is_ack:
+        init_data['tcp_op'] = "ACK"
+    else:
+        raise TSAPacketParseException("TCP Packet was neither a SYN, " +
+                "ACK, nor SYN-ACK operation", "tcp_op")
+
+    return offset + max(header_length, 20)
+
+def _decode_udp(buf, offset, end, init_data):
+    """
+    Decodes a UDP header into init_data, and returns the
+    offset of the UDP payload.
+    """
+    _require(buf, offset, end, 8)
+    (src_port, dst_port) = struct.unpack_from('>HH', buf, offset)
+
+    init_data['protocol'] = "udp"
+    init_data['src_port'] = src_port
+    init_data['dst_port'] = dst_port
+
+    return offset + 8
+
+def _strip_dns_tcp_length(buf, offset, end):
+    """
+    Skips the length prefix of a DNS message sent over TCP.
+    """
+    _require(buf, offset, end, 2)
+    message_length = struct.unpack_from('>H', buf, offset)[0]
+    if offset + 2 + message_length > end:
+        # Message spans multiple segments, and needs reassembly
+        raise UnsupportedPacketException("Segmented DNS message")
+    return offset + 2
+
+def _decode_dns(buf, offset, end, init_data):
+    """
+    Decodes a DNS message into init_data.
+    """
+    _require(buf, offset, end, 12)
+    (question_count, answer_count, authority_count, additional_count) = \
+            struct.unpack_from('>HHHH', buf, offset + 4)
+    init_data['application_type'] = "dns"
+
+    position = offset + 12
+    query_names = []
+    for _ in range(question_count):
+        (name, position) = _read_dns_name(buf, offset, position, end)
+        query_names.append(name)
+        position += 4
+    if not query_names:
+        raise TSAPacketParseException("DNS Packet missing query " +
+                "names field", "dns_no_query")
+    init_data['dns_query_names'] = query_names
+
+    # tshark reports a response name for every resource record,
+    # regardless of the section (or QR flag) it appeared in
+    if not (answer_count or authority_count or additional_count):
+        init_data['dns_query_resp'] = "query"
+        return
+    init_data['dns_query_resp'] = "response"
+
+    a_addrs = []
+    aaaa_addrs = []
+    ttls = []
+    for _ in range(answer_count):
+        (_, position) = _read_dns_name(buf, offset, position, end)
+        _require(buf, position, end, 10)
+        (rr_type, ttl, rdata_length) = struct.unpack_from('>HxxIH', buf,
+                position)
+        position += 10
+        _require(buf, position, end, rdata_length)
+        ttls.append(ttl)
+        if rr_type == DNS_TYPE_A and rdata_length == 4:
+            a_addrs.append("%d.%d.%d.%d" % tuple(buf[position:position+4]))
+        elif rr_type == DNS_TYPE_AAAA and rdata_length == 16:
+            aaaa_addrs.append(socket.inet_ntop(socket.AF_INET6,
+                    buf[position:position+16]))
+        position += rdata_length
+
+    if aaaa_addrs:
+        init_data['dns_resp_ip'] = aaaa_addrs[0]
+    elif a_addrs:
+        init_data['dns_resp_ip'] = a_addrs[0]
+    if a_addrs or aaaa_addrs:
+        init_data['dns_resp_ips'] = a_addrs + aaaa_addrs
+        init_data['dns_resp_ttl'] = min_dns_ttl(ttls)
+
+def _read_dns_name(buf, message_offset, position, end):
+    """
+    Reads the (possibly compressed) domain name at the provided
+    position, and returns it along with the position after it.
+    """
+    labels = []
+    next_position = None
+    jumps = 0
+    while True:
+        _require(buf, position, end, 1)
+        label_length = buf[position]
+        if label_length == 0:
+            position += 1
+            break
+        elif label_length & 0xC0 == 0xC0:
+            _require(buf, position, end, 2)
+            pointer = struct.unpack_from('>H', buf, position)[0] & 0x3FFF
+            if next_position is None:
+                next_position = position + 2
+            position = message_offset + pointer
+            jumps += 1
+            if jumps > 64:
+                raise UnsupportedPacketException("DNS name pointer loop")
+        elif label_length & 0xC0:
+            raise UnsupportedPacketException("Unknown DNS label type")
+        else:
+            _require(buf, position + 1, end, label_length)
+            label = buf[position+1:position+1+label_length]
+            labels.append(label.decode('ascii', 'backslashreplace'))
+            position += 1 + label_length
+
+    name = ".".join(labels) if labels else "<Root>"
+    return (name, next_position if next_position is not None else position)
+
+def _decode_http(buf, offset, end, init_data):
+    """
+    Decodes the start line of an HTTP message into init_data.
+
+    Returns False if the segment does not start an HTTP message (e.g.
+    it continues a message body), in which case nothing is decoded.
+    """
+    line_end = buf.find(b'\r\n', offset, end)
+    first_line = buf[offset:line_end if line_end != -1 else end]
+
+    if first_line.startswith(b'HTTP/'):
+        init_data['application_type'] = "http"
+        status = first_line[9:12]
+        if not status.isdigit():
+            raise TSAPacketParseException("HTTP Packet contained neither " +
+                    "request nor response data", "http_no_message")
+        init_data['http_req_resp'] = "response"
+        init_data['http_status'] = int(status)
+        return True
+
+    method = first_line.split(b' ', 1)[0]
+    if method in HTTP_METHODS and len(method) < len(first_line):
+        init_data['application_type'] = "http"
+        init_data['http_req_resp'] = "request"
+        init_data['http_method'] = method.decode('ascii')
+        return True
+
+    return False
+
+def _require(buf, offset, end, length):
+    """
+    Raises UnsupportedPacketException if there are less than
+    length bytes left in the packet at the provided offset.
+    """
+    if offset + length > end:
+        raise UnsupportedPacketException("Truncated or malformed packet")
+
+
+class PcapFormatException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+class UnsupportedPacketException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
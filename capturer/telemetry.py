@@ -0,0 +1,184 @@
+"""
+This module collects counters describing the health of the capture
+pipeline (packets seen, parsed, rejected, evicted, capture latency),
+and exposes them as a dictionary or in Prometheus text format.
+
+Metrics are identified by a name and an optional set of labels, e.g.
+increment('packets_rejected', reason='no_ip'). All functions may be
+called from any thread.
+"""
+
+import threading
+
+# Prefix added to every metric name in the Prometheus output
+METRIC_PREFIX = "tsa_"
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10]
+
+# Descriptions of the metrics recorded by the capturer layer
+METRIC_HELP = {
+    'capture_packets_seen_total': "Packets received from tshark or read "
+            "from a capture file",
+    'capture_packets_parsed_total': "Packets successfully parsed into "
+            "TSAPackets",
+    'capture_packets_rejected_total': "Packets rejected by the parser, "
+            "by reason",
+    'capture_packets_evicted_total': "Packets evicted from the packet buffer",
+    'capture_interface_packets_total': "Packets parsed on each captured "
+            "interface",
+    'capture_interface_dropped_total': "Packets dropped on each captured "
+            "interface because the merge queue was full",
+    'capture_interface_duplicates_total': "Packets dropped on each captured "
+            "interface as copies of packets seen on another interface",
+    'capture_latency_seconds': "Time from a packet being captured to it "
+            "being placed into the packet buffer",
+    'buffer_packets': "Packets currently held in the packet buffer",
+    'buffer_bytes': "Estimated memory used by the packet buffer",
+    'p0f_cache_hits_total': "p0f lookups answered from the cache",
+    'p0f_cache_negative_hits_total': "p0f lookups answered from the cache "
+            "for hosts p0f has no data on",
+    'p0f_cache_misses_total': "p0f lookups not answered from the cache",
+    'p0f_cache_entries': "Hosts currently held in the p0f lookup cache",
+    'p0f_queries_total': "Queries sent to the p0f API",
+    'geoip_cache_hits_total': "GeoIP lookups answered from the cache",
+    'geoip_cache_misses_total': "GeoIP lookups not answered from the cache",
+    'geoip_cache_entries': "Addresses currently held in the GeoIP lookup "
+            "cache",
+    'geoip_local_lookups_total': "GeoIP lookups of private, loopback or "
+            "link-local addresses, answered without the database",
+    'geoip_lookup_seconds': "Time taken by each GeoIP database lookup",
+    'enrichment_table_entries': "Addresses in the IP attribute table",
+    'enrichment_pending_addresses': "Addresses waiting to have their "
+            "attributes resolved",
+}
+
+_lock = threading.Lock()
+
+# (name, labels) -> value, where labels is a sorted tuple of (key, value)
+_counters = {}
+
+# (name, labels) -> [bucket counts..., count, sum, max]
+_histograms = {}
+
+# Functions called on every read, returning {(name, labels): value}
+# dictionaries of gauges computed on demand
+_collectors = []
+
+def increment(name, value=1, **labels):
+    """
+    Adds value to the counter with the provided name and labels.
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, value, **labels):
+    """
+    Records a sample of value in the histogram with the
+    provided name and labels.
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = [0] * (len(LATENCY_BUCKETS) + 2) + [value]
+            _histograms[key] = histogram
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram[index] += 1
+        histogram[-3] += 1
+        histogram[-2] += value
+        histogram[-1] = max(histogram[-1], value)
+
+def register_collector(collector):
+    """
+    Registers a function that returns a dictionary relating (name,
+    labels) tuples to the current value of a gauge. It is called
+    every time the metrics are read.
+    """
+    with _lock:
+        if collector not in _collectors:
+            _collectors.append(collector)
+
+def unregister_collector(collector):
+    with _lock:
+        if collector in _collectors:
+            _collectors.remove(collector)
+
+def reset():
+    """
+    Resets every counter and histogram to zero.
+    """
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+def get_metrics():
+    """
+    Returns a dictionary relating metric names to dictionaries, which
+    relate label tuples (sorted (key, value) tuples, empty for metrics
+    without labels) to the metric's value. Histogram values are
+    dictionaries with the fields:
+        count:  number of samples recorded
+        sum:  sum of the samples
+        max:  largest sample
+        buckets:  list of (upper bound, cumulative count) tuples
+    """
+    metrics = {}
+    with _lock:
+        collectors = list(_collectors)
+        for (name, labels), value in _counters.items():
+            metrics.setdefault(name, {})[labels] = value
+        for (name, labels), histogram in _histograms.items():
+            metrics.setdefault(name, {})[labels] = {
+                'count': histogram[-3],
+                'sum': histogram[-2],
+                'max': histogram[-1],
+                'buckets': list(zip(LATENCY_BUCKETS, histogram[:-3])),
+            }
+    for collector in collectors:
+        for (name, labels), value in collector().items():
+            metrics.setdefault(name, {})[labels] = value
+    return metrics
+
+def format_prometheus():
+    """
+    Returns the current metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for name, values in sorted(get_metrics().items()):
+        full_name = METRIC_PREFIX + name
+        is_histogram = any(isinstance(x, dict) for x in values.values())
+        if name in METRIC_HELP:
+            lines.append("# HELP %s %s" % (full_name, METRIC_HELP[name]))
+        if is_histogram:
+            metric_type = "histogram"
+        elif name.endswith("_total"):
+            metric_type = "counter"
+        else:
+            metric_type = "gauge"
+        lines.append("# TYPE %s %s" % (full_name, metric_type))
+
+        for labels, value in sorted(values.items()):
+            if not is_histogram:
+                lines.append("%s%s %s" % (full_name, _format_labels(labels),
+                        value))
+                continue
+            for bound, count in value['buckets']:
+                lines.append("%s_bucket%s %d" % (full_name,
+                        _format_labels(labels + (('le', bound),)), count))
+            lines.append("%s_bucket%s %d" % (full_name,
+                    _format_labels(labels + (('le', "+Inf"),)),
+                    value['count']))
+            lines.append("%s_sum%s %s" % (full_name, _format_labels(labels),
+                    value['sum']))
+            lines.append("%s_count%s %d" % (full_name, _format_labels(labels),
+                    value['count']))
+    return "\n".join(lines) + "\n"
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace('\\',
+            '\\\\').replace('"', '\\"')) for key, value in labels)
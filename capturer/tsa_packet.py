@@ -1,16 +1,25 @@
-from capturer.utils import split_cdl
+from capturer.utils import min_dns_ttl, split_cdl
 from datetime import datetime
 
-class TSAPacket(dict):
+# Version of the rules the parse methods (and capturer.pcap_reader)
+# follow. Must be incremented whenever a change to them alters the
+# packets produced from the same input, so that cached parse results
+# are not reused.
+PARSER_VERSION = 3
+
+class TSAPacket:
     """
     Condensed representation of a packet containing only the fields
     necessary for our analyzer.
 
-    This class subclasses dict, and thus any operators on dictionaries
-    will also work on a TSAPacket. Packet fields may be accessed
-    through dictionary syntax (e.g. tsa_packet['src_addr']), or with
-    dot syntax (e.g. tsa_packet.src_addr). Some fields only appear in
-    certain packets, and will have a value of None if it was not present.
+    Packet fields are stored in slots rather than a per-packet dict,
+    which keeps both memory use and attribute access cheap when many
+    packets are held at once. Packet fields may be accessed through
+    dot syntax (e.g. tsa_packet.src_addr), or with dictionary syntax
+    (e.g. tsa_packet['src_addr']), and the read-only dictionary methods
+    (keys, values, items, get, ...) are also supported. Some fields
+    only appear in certain packets, and will have a value of None if
+    it was not present. Only the fields in FIELDS can be set.
 
     A TSAPacket may either be initialized directly, with a dictionary
     containing the expected packet values, or via one of the defined
@@ -29,6 +38,10 @@ class TSAPacket(dict):
         dns_query_resp: 'query' | 'response' (if DNS packet)
         dns_query_names:  List of URLs being queried (if DNS packet)
         dns_resp_ip: response ip address (if DNS response with answer)
+        dns_resp_ips:  List of the addresses of the A answers, then the
+            AAAA answers (if DNS response with A or AAAA answers)
+        dns_resp_ttl:  smallest TTL of the answers, in seconds (if DNS
+            response with A or AAAA answers)
         http_req_resp:  'request' | 'response' (if HTTP packet)
         http_method:  'GET' | 'PUT' | 'POST' | ... (if HTTP request)
         http_status:  response status code (if HTTP response)
@@ -38,11 +51,25 @@ class TSAPacket(dict):
     FIELDS = ['timestamp', 'ip_version', 'src_addr', 'dst_addr', 'protocol',
               'src_port', 'dst_port', 'tcp_op', 'application_type',
               'dns_query_resp', 'dns_query_names', 'dns_resp_ip',
-              'http_req_resp', 'http_method', 'http_status', 'length']
+              'dns_resp_ips', 'dns_resp_ttl', 'http_req_resp', 'http_method',
+              'http_status', 'length']
 
     REQUIRED_FIELDS = ['timestamp', 'ip_version', 'src_addr', 'dst_addr',
                        'protocol', 'src_port', 'dst_port', 'application_type', 'length']
 
+    # Possible values of the categorical fields. A value's index in
+    # its tuple may be used as a compact enum code for that value.
+    CATEGORIES = {
+        'ip_version': ('ipv4', 'ipv6'),
+        'protocol': ('tcp', 'udp'),
+        'tcp_op': ('SYN', 'ACK', 'SYN-ACK'),
+        'application_type': ('dns', 'http', 'none'),
+        'dns_query_resp': ('query', 'response'),
+        'http_req_resp': ('request', 'response'),
+    }
+
+    __slots__ = FIELDS
+
     def __init__(self, init_data):
         """
         Initializes a TSAPacket from a python dictionary.
@@ -50,44 +77,84 @@ class TSAPacket(dict):
         Raises IncompleteInitDataException if any required fields are
         missing in the provided dictionary.
         """
-        for field in TSAPacket.FIELDS:
-            if field in init_data:
-                self[field] = init_data[field]
-            elif field in TSAPacket.REQUIRED_FIELDS:
+        for field in TSAPacket.REQUIRED_FIELDS:
+            if field not in init_data:
                 raise IncompleteInitDataException("Missing required " +
                         "field: %s." % field)
-            else:
-                self[field] = None
+        for field, set_slot in _SLOT_SETTERS:
+            set_slot(self, init_data.get(field))
 
     def __repr__(self):
         field_list = []
         for field in TSAPacket.FIELDS:
-            field_value = self[field]
+            field_value = getattr(self, field)
             if field_value:
-                field_list.append("\t%s: %s" % (field, self[field]))
+                field_list.append("\t%s: %s" % (field, field_value))
         return "TSA Packet: {\n%s\n}" % "\n".join(field_list)
 
-    ### METHODS TO ALLOW OBJECT DOT SYNTAX ###
+    def __eq__(self, other):
+        if not isinstance(other, TSAPacket):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field)
+                for field in TSAPacket.FIELDS)
 
-    def __getattr__(self, name):
-        if name in self:
-            return self[name]
-        else:
-            raise AttributeError("No such attribute: " + name)
+    __hash__ = None
+
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in TSAPacket.FIELDS)
 
-    def __setattr__(self, name, value):
-        self[name] = value
+    def __setstate__(self, state):
+        for field, value in zip(TSAPacket.FIELDS, state):
+            setattr(self, field, value)
 
     def __delattr__(self, name):
         if name in TSAPacket.REQUIRED_FIELDS:
             raise AttributeError("Attempted to delete required field: " + name)
-        elif name in TSAPacket.FIELDS:
-            self[name] = None
-        elif name in self:
-            del self[name]
+        elif name in _FIELD_SET:
+            setattr(self, name, None)
         else:
             raise AttributeError("No such attribute: " + name)
 
+    ### METHODS TO ALLOW DICTIONARY SYNTAX ###
+
+    def __getitem__(self, key):
+        if key not in _FIELD_SET:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in _FIELD_SET:
+            raise KeyError("Key '" + key + "' is not a valid TSAPacket field")
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in _FIELD_SET:
+            raise KeyError(key)
+        self.__delattr__(key)
+
+    def __contains__(self, key):
+        return key in _FIELD_SET
+
+    def __iter__(self):
+        return iter(TSAPacket.FIELDS)
+
+    def __len__(self):
+        return len(TSAPacket.FIELDS)
+
+    def keys(self):
+        return list(TSAPacket.FIELDS)
+
+    def values(self):
+        return [getattr(self, field) for field in TSAPacket.FIELDS]
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in TSAPacket.FIELDS]
+
+    def get(self, key, default=None):
+        if key not in _FIELD_SET:
+            return default
+        return getattr(self, key)
+
     ### PARSING METHODS ###
 
     @staticmethod
@@ -100,21 +167,26 @@ class TSAPacket(dict):
         """
         if not packet.__dict__.get('layers'):
             raise TSAPacketParseException("Provided packet is not in " +
-                    "expected pyshark packet format")
+                    "expected pyshark packet format", "bad_format")
         if packet.captured_length != packet.length:
-            raise TSAPacketParseException("Failed to capture entire packet")
+            raise TSAPacketParseException("Failed to capture entire packet",
+                    "truncated")
 
         init_data = {}
         sniff_time_float = float(packet.sniff_timestamp)
         init_data['timestamp'] = datetime.fromtimestamp(sniff_time_float)
 
-        # Extract network layer data
-        if 'ip' in packet:
-            init_data['ip_version'] = "ipv" + str(packet.ip.version)
-            init_data['src_addr'] = packet.ip.src
-            init_data['dst_addr'] = packet.ip.dst
+        # Extract network layer data (from the outermost IP layer)
+        ip_layers = [layer for layer in packet.layers
+                if layer.layer_name in _IP_LAYER_VERSIONS]
+        if ip_layers:
+            init_data['ip_version'] = _IP_LAYER_VERSIONS[
+                    ip_layers[0].layer_name]
+            init_data['src_addr'] = ip_layers[0].src
+            init_data['dst_addr'] = ip_layers[0].dst
         else:
-            raise TSAPacketParseException("Packet missing required IP layer")
+            raise TSAPacketParseException("Packet missing required IP layer",
+                    "no_ip")
 
         # Extract transport layer data
         if 'tcp' in packet:
@@ -132,7 +204,7 @@ class TSAPacket(dict):
                 init_data['tcp_op'] = "ACK"
             else:
                 raise TSAPacketParseException("TCP Packet was neither a SYN, " +
-                        "ACK, nor SYN-ACK operation")
+                        "ACK, nor SYN-ACK operation", "tcp_op")
 
         elif 'udp' in packet:
             init_data['protocol'] = "udp"
@@ -141,22 +213,29 @@ class TSAPacket(dict):
 
         else:
             raise TSAPacketParseException("Packet missing transport layer " +
-                    "(TCP or UDP)")
+                    "(TCP or UDP)", "no_transport")
 
         # Extract application layer data (if any)
         if 'dns' in packet:
             init_data['application_type'] = "dns"
             if 'qry_name' in packet.dns.field_names:
-                init_data['dns_query_names'] = split_cdl(packet.dns.qry_name)
+                init_data['dns_query_names'] = _get_all_values(packet.dns,
+                        'qry_name')
             else:
                 raise TSAPacketParseException("DNS Packet missing query " +
-                        "names field")
+                        "names field", "dns_no_query")
             if 'resp_name' in packet.dns.field_names:
                 init_data['dns_query_resp'] = "response"
                 if 'a' in packet.dns.field_names:
                     init_data['dns_resp_ip'] = packet.dns.a
                 if 'aaaa' in packet.dns.field_names:
                     init_data['dns_resp_ip'] = packet.dns.aaaa
+                if 'count_answers' in packet.dns.field_names:
+                    _add_answers(init_data, int(packet.dns.count_answers),
+                            _get_all_values(packet.dns, 'resp_type'),
+                            _get_all_values(packet.dns, 'a'),
+                            _get_all_values(packet.dns, 'aaaa'),
+                            _get_all_values(packet.dns, 'resp_ttl'))
             else:
                 init_data['dns_query_resp'] = "query"
 
@@ -170,7 +249,7 @@ class TSAPacket(dict):
                 init_data["http_status"] = int(packet.http.response_code)
             else:
                 raise TSAPacketParseException("HTTP Packet contained neither " +
-                        "request nor response data")
+                        "request nor response data", "http_no_message")
 
         else:
             init_data['application_type'] = "none"
@@ -180,11 +259,191 @@ class TSAPacket(dict):
 
         return TSAPacket(init_data)
 
+    # Fields extracted by tshark for parse_tshark_fields, in order
+    TSHARK_FIELDS = ['frame.time_epoch', 'frame.len', 'frame.cap_len',
+                     'frame.protocols', 'ip.src', 'ip.dst', 'ipv6.src',
+                     'ipv6.dst',
+                     'tcp.srcport', 'tcp.dstport', 'tcp.flags.syn',
+                     'tcp.flags.ack', 'udp.srcport', 'udp.dstport',
+                     'dns.qry.name', 'dns.resp.name', 'dns.a', 'dns.aaaa',
+                     'dns.count.answers', 'dns.resp.type', 'dns.resp.ttl',
+                     'http.request.method', 'http.response.code']
+
+    # Fields of TSHARK_FIELDS whose every occurrence is used (the
+    # others only use the first, as pyshark attributes return)
+    TSHARK_ALL_OCCURRENCE_FIELDS = ['dns.qry.name', 'dns.a', 'dns.aaaa',
+                                    'dns.resp.type', 'dns.resp.ttl']
+
+    @staticmethod
+    def parse_tshark_fields(values):
+        """
+        Accepts a list of the values of TSHARK_FIELDS for a packet, as
+        output by tshark -T fields (with every occurrence of each field,
+        separated by commas), and returns a TSAPacket created from it.
+        Empty strings represent fields that are not present.
+
+        Applies the same rules as parse_pyshark_packet, so the
+        same packets are accepted, with the same field values.
+
+        Raises TSAPacketParseException if parsing fails.
+        """
+        if len(values) != len(TSAPacket.TSHARK_FIELDS):
+            raise TSAPacketParseException("Provided values do not match " +
+                    "the expected tshark fields", "bad_format")
+        values = [value if field in _TSHARK_ALL_OCCURRENCE_SET else
+                  value.split(',', 1)[0] for field, value in
+                  zip(TSAPacket.TSHARK_FIELDS, values)]
+        (time_epoch, length, cap_len, protocols, ip_src, ip_dst, ipv6_src,
+                ipv6_dst, tcp_srcport, tcp_dstport, tcp_syn, tcp_ack, udp_srcport,
+                udp_dstport, dns_qry_name, dns_resp_name, dns_a, dns_aaaa,
+                dns_count_answers, dns_resp_type, dns_resp_ttl,
+                http_method, http_code) = values
+        if cap_len != length:
+            raise TSAPacketParseException("Failed to capture entire packet",
+                    "truncated")
+
+        init_data = {}
+        init_data['timestamp'] = datetime.fromtimestamp(float(time_epoch))
+        layers = protocols.split(':')
+
+        # Extract network layer data (from the outermost IP layer)
+        ip_layers = [layer for layer in layers if layer in _IP_LAYER_VERSIONS]
+        if ip_layers and ip_layers[0] == 'ip':
+            init_data['ip_version'] = "ipv4"
+            init_data['src_addr'] = ip_src
+            init_data['dst_addr'] = ip_dst
+        elif ip_layers:
+            init_data['ip_version'] = "ipv6"
+            init_data['src_addr'] = ipv6_src
+            init_data['dst_addr'] = ipv6_dst
+        else:
+            raise TSAPacketParseException("Packet missing required IP layer",
+                    "no_ip")
+
+        # Extract transport layer data
+        if 'tcp' in layers:
+            init_data['protocol'] = "tcp"
+            init_data['src_port'] = int(tcp_srcport)
+            init_data['dst_port'] = int(tcp_dstport)
+
+            # Newer versions of tshark output booleans as True / False
+            is_syn = tcp_syn in ('1', 'True')
+            is_ack = tcp_ack in ('1', 'True')
+            if is_syn and is_ack:
+                init_data['tcp_op'] = "SYN-ACK"
+            elif is_syn:
+                init_data['tcp_op'] = "SYN"
+            elif is_ack:
+                init_data['tcp_op'] = "ACK"
+            else:
+                raise TSAPacketParseException("TCP Packet was neither a SYN, " +
+                        "ACK, nor SYN-ACK operation", "tcp_op")
+
+        elif 'udp' in layers:
+            init_data['protocol'] = "udp"
+            init_data['src_port'] = int(udp_srcport)
+            init_data['dst_port'] = int(udp_dstport)
+
+        else:
+            raise TSAPacketParseException("Packet missing transport layer " +
+                    "(TCP or UDP)", "no_transport")
+
+        # Extract application layer data (if any)
+        if 'dns' in layers:
+            init_data['application_type'] = "dns"
+            if dns_qry_name:
+                init_data['dns_query_names'] = split_cdl(dns_qry_name)
+            else:
+                raise TSAPacketParseException("DNS Packet missing query " +
+                        "names field", "dns_no_query")
+            if dns_resp_name:
+                init_data['dns_query_resp'] = "response"
+                if dns_a:
+                    init_data['dns_resp_ip'] = dns_a.split(',', 1)[0]
+                if dns_aaaa:
+                    init_data['dns_resp_ip'] = dns_aaaa.split(',', 1)[0]
+                if dns_count_answers:
+                    _add_answers(init_data, int(dns_count_answers),
+                            _split_occurrences(dns_resp_type),
+                            _split_occurrences(dns_a),
+                            _split_occurrences(dns_aaaa),
+                            _split_occurrences(dns_resp_ttl))
+            else:
+                init_data['dns_query_resp'] = "query"
+
+        elif 'http' in layers:
+            init_data['application_type'] = "http"
+            if http_method:
+                init_data['http_req_resp'] = "request"
+                init_data['http_method'] = http_method
+            elif http_code:
+                init_data['http_req_resp'] = "response"
+                init_data["http_status"] = int(http_code)
+            else:
+                raise TSAPacketParseException("HTTP Packet contained neither " +
+                        "request nor response data", "http_no_message")
+
+        else:
+            init_data['application_type'] = "none"
+
+        # Extract packet length (in bytes)
+        init_data['length'] = int(length)
+
+        return TSAPacket(init_data)
+
+
+_FIELD_SET = frozenset(TSAPacket.FIELDS)
+_IP_LAYER_VERSIONS = {'ip': "ipv4", 'ipv6': "ipv6"}
+_TSHARK_ALL_OCCURRENCE_SET = frozenset(TSAPacket.TSHARK_ALL_OCCURRENCE_FIELDS)
+_SLOT_SETTERS = [(field, getattr(TSAPacket, field).__set__)
+                 for field in TSAPacket.FIELDS]
+
+# DNS resource record types of A and AAAA answers
+_DNS_TYPE_A = 1
+_DNS_TYPE_AAAA = 28
+
+def _add_answers(init_data, answer_count, rr_types, a_addrs, aaaa_addrs,
+        ttls):
+    """
+    Adds the dns_resp_ips and dns_resp_ttl fields to init_data, given
+    the number of answers of a DNS response, and the types, A and AAAA
+    addresses, and TTLs of all of its resource records (in order, as
+    tshark reports them for every section, the answers first).
+    """
+    answer_types = [int(rr_type) for rr_type in rr_types[:answer_count]]
+    resp_ips = a_addrs[:answer_types.count(_DNS_TYPE_A)] + \
+            aaaa_addrs[:answer_types.count(_DNS_TYPE_AAAA)]
+    if resp_ips:
+        init_data['dns_resp_ips'] = resp_ips
+        init_data['dns_resp_ttl'] = min_dns_ttl(ttls[:answer_count])
+
+def _get_all_values(layer, field_name):
+    """
+    Returns a list of the values of every occurrence of
+    the provided field in the provided pyshark layer.
+    """
+    if field_name not in layer.field_names:
+        return []
+    return [field.show for field in layer.get_field(field_name).all_fields]
+
+def _split_occurrences(value):
+    """
+    Returns a list of the occurrences of a tshark field, from
+    its value as output with every occurrence (see _iter_fields
+    in capturer.tshark_reader).
+    """
+    return value.split(',') if value else []
 
 class IncompleteInitDataException(Exception):
     def __init__(self, message):
         Exception.__init__(self, message)
 
 class TSAPacketParseException(Exception):
-    def __init__(self, message):
+    """
+    Raised when a packet is rejected by a parser. The reason attribute
+    holds a short identifier of the check that failed, which can be
+    used to break rejections down by cause.
+    """
+    def __init__(self, message, reason="unknown"):
         Exception.__init__(self, message)
+        self.reason = reason
@@ -1,4 +1,9 @@
 from capturer.tsa_packet import TSAPacket
+from datetime import datetime, timedelta
+
+import numpy as np
+
+NANOSECONDS_IN_SECONDS = 1000000000
 
 class TSAStream:
     """
@@ -99,3 +104,435 @@ class TSAStream:
                         " TSAPacket field")
             filtered_list = filter(lambda x: x[key] == value, filtered_list)
         return TSAStream(filtered_list)
+
+
+class ColumnarTSAStream:
+    """
+    Column oriented representation of a stream of TSAPackets.
+
+    Each TSAPacket field is stored as a NumPy array with one entry per
+    packet, rather than as a list of packet objects:
+        timestamp:  int64 nanoseconds since the epoch
+        length, ports, http_status, dns_resp_ttl:  integers (-1 if missing)
+        src_addr, dst_addr, dns_resp_ip:  int32 ids into a dictionary
+            of IP addresses shared by the three columns (-1 if missing)
+        categorical fields:  int8 codes into the values of that field
+            (see TSAPacket.CATEGORIES) (-1 if missing)
+        dns_query_names, dns_resp_ips:  object arrays of lists (None
+            if missing)
+
+    Supports the same querying methods as TSAStream. TSAPackets are
+    only created when they are asked for (e.g. via get_packets).
+    """
+
+    TIMESTAMP_FIELDS = ['timestamp']
+    INTEGER_FIELDS = {'length': np.int32, 'src_port': np.int32,
+                      'dst_port': np.int32, 'http_status': np.int16,
+                      'dns_resp_ttl': np.int32}
+    ADDRESS_FIELDS = ['src_addr', 'dst_addr', 'dns_resp_ip']
+    CATEGORICAL_FIELDS = ['ip_version', 'protocol', 'tcp_op',
+                          'application_type', 'dns_query_resp',
+                          'http_req_resp', 'http_method']
+    OBJECT_FIELDS = ['dns_query_names', 'dns_resp_ips']
+
+    # Names of the (counts, ids) arrays the object fields
+    # are stored as by to_arrays
+    OBJECT_ARRAYS = {'dns_query_names': ('dns_query_counts', 'dns_query_ids'),
+                     'dns_resp_ips': ('dns_resp_ip_counts', 'dns_resp_ip_ids')}
+
+    def __init__(self, columns, addresses, categories):
+        """
+        Initializes a ColumnarTSAStream from already encoded columns.
+        Use from_packets to build one from a list of TSAPackets.
+        """
+        self._columns = columns
+        self._addresses = addresses
+        self._categories = categories
+        self._packets = None
+
+    @staticmethod
+    def from_packets(tsa_packets):
+        """
+        Returns a ColumnarTSAStream containing the provided TSAPackets.
+        """
+        tsa_packets = list(tsa_packets)
+        addresses = _Dictionary()
+        categories = {}
+        for field in ColumnarTSAStream.CATEGORICAL_FIELDS:
+            categories[field] = _Dictionary(
+                    TSAPacket.CATEGORIES.get(field, ()))
+
+        columns = {}
+        columns['timestamp'] = np.fromiter(
+                (_datetime_to_ns(x.timestamp) for x in tsa_packets),
+                dtype=np.int64, count=len(tsa_packets))
+        for field, dtype in ColumnarTSAStream.INTEGER_FIELDS.items():
+            columns[field] = np.fromiter(
+                    (_null_to_minus_one(x[field]) for x in tsa_packets),
+                    dtype=dtype, count=len(tsa_packets))
+        for field in ColumnarTSAStream.ADDRESS_FIELDS:
+            columns[field] = np.fromiter(
+                    (addresses.encode(x[field]) for x in tsa_packets),
+                    dtype=np.int32, count=len(tsa_packets))
+        for field in ColumnarTSAStream.CATEGORICAL_FIELDS:
+            dictionary = categories[field]
+            columns[field] = np.fromiter(
+                    (dictionary.encode(x[field]) for x in tsa_packets),
+                    dtype=np.int8, count=len(tsa_packets))
+        for field in ColumnarTSAStream.OBJECT_FIELDS:
+            column = np.empty(len(tsa_packets), dtype=object)
+            column[:] = [x[field] for x in tsa_packets]
+            columns[field] = column
+
+        return ColumnarTSAStream(columns, addresses, categories)
+
+    def __len__(self):
+        return len(self._columns['timestamp'])
+
+    def __repr__(self):
+        return repr(TSAStream(self.get_packets()))
+
+    ### METHODS TO ALLOW LIST INDEXING SYNTAX ###
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._take(index)
+        return self._decode_packet(index)
+
+    def __iter__(self):
+        return iter(self.get_packets())
+
+    ### STREAM METHODS ###
+
+    def get_packets(self, sort_key=None, include_missing=False):
+        """
+        Returns a list of TSAPackets in the stream.
+
+        If sort_key is provided, the packets are sorted by their
+        values for that key. Raises KeyError if the provided key
+        is not a valid TSAPacket field.
+
+        If include_missing is True, packets that are missing the
+        field specified by sort_key are included in the returned
+        list, at the end. Otherwise, they are omitted.
+        """
+        if self._packets is None:
+            self._packets = [self._decode_packet(index)
+                             for index in range(len(self))]
+        if not sort_key:
+            return self._packets
+
+        values = self.get_values_for_key(sort_key)
+        order = sorted(range(len(values)),
+                key=lambda x: (values[x] is None, values[x]))
+        if not include_missing:
+            order = filter(lambda x: values[x] is not None, order)
+        return [self._packets[index] for index in order]
+
+    def get_values_for_key(self, key):
+        """
+        Returns a list of values for the provided key - one for
+        each packet in the stream.
+
+        Raises KeyError if the provided key is not a valid
+        TSAPacket field.
+        """
+        if key not in TSAPacket.FIELDS:
+            raise KeyError("Key '" + key + "' is not a valid TSAPacket field")
+        column = self._columns[key]
+        if key in ColumnarTSAStream.TIMESTAMP_FIELDS:
+            return [_ns_to_datetime(x) for x in column.tolist()]
+        elif key in ColumnarTSAStream.INTEGER_FIELDS:
+            return [x if x >= 0 else None for x in column.tolist()]
+        elif key in ColumnarTSAStream.ADDRESS_FIELDS:
+            return self._addresses.decode_array(column).tolist()
+        elif key in ColumnarTSAStream.CATEGORICAL_FIELDS:
+            return self._categories[key].decode_array(column).tolist()
+        else:
+            return column.tolist()
+
+    def filter(self, filter_dict):
+        """
+        Returns a ColumnarTSAStream containing only packets whose
+        values match those in the provided dict, for all keys in
+        the dict.
+
+        Raises KeyError if any of the keys in the dict is not
+        a valid TSAPacket field.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for key, value in filter_dict.items():
+            if key not in TSAPacket.FIELDS:
+                raise KeyError("Key '" + key + "' is not a valid " +
+                        " TSAPacket field")
+            mask &= self._match(key, value)
+        return self._take(mask)
+
+    ### COLUMN METHODS ###
+
+    def get_column(self, key):
+        """
+        Returns the encoded NumPy array holding the values of the
+        provided key (see the class description for the encodings).
+
+        Raises KeyError if the provided key is not a valid
+        TSAPacket field.
+        """
+        if key not in TSAPacket.FIELDS:
+            raise KeyError("Key '" + key + "' is not a valid TSAPacket field")
+        return self._columns[key]
+
+    def get_dictionary(self, key):
+        """
+        Returns the list of values that the ids in the column for the
+        provided (address or categorical) key refer to.
+
+        Raises KeyError if the key is not dictionary encoded.
+        """
+        if key in ColumnarTSAStream.ADDRESS_FIELDS:
+            return list(self._addresses.values)
+        elif key in ColumnarTSAStream.CATEGORICAL_FIELDS:
+            return list(self._categories[key].values)
+        raise KeyError("Key '" + key + "' is not dictionary encoded")
+
+    def sorted_by_timestamp(self):
+        """
+        Returns a ColumnarTSAStream of the packets in this stream, in
+        timestamp order. Packets with equal timestamps keep their order.
+        """
+        return self._take(np.argsort(self._columns['timestamp'],
+                kind='mergesort'))
+
+    @staticmethod
+    def concatenate(streams):
+        """
+        Returns a ColumnarTSAStream containing the packets of each of
+        the provided streams, in order. The ids of the dictionary
+        encoded columns are remapped onto new shared dictionaries.
+        """
+        streams = list(streams)
+        if not streams:
+            return ColumnarTSAStream.from_packets([])
+        addresses = _Dictionary()
+        categories = {}
+        for field in ColumnarTSAStream.CATEGORICAL_FIELDS:
+            categories[field] = _Dictionary(
+                    TSAPacket.CATEGORIES.get(field, ()))
+
+        columns = {}
+        for field in streams[0]._columns:
+            parts = []
+            for stream in streams:
+                column = stream._columns[field]
+                if field in ColumnarTSAStream.ADDRESS_FIELDS:
+                    column = _remap(column, stream._addresses, addresses)
+                elif field in ColumnarTSAStream.CATEGORICAL_FIELDS:
+                    column = _remap(column, stream._categories[field],
+                            categories[field])
+                parts.append(column)
+            columns[field] = np.concatenate(parts)
+        return ColumnarTSAStream(columns, addresses, categories)
+
+    ### SERIALIZATION METHODS ###
+
+    def to_arrays(self):
+        """
+        Returns an (arrays, dictionaries) tuple describing the stream
+        with fixed width NumPy arrays and lists of strings only, so it
+        can be written out without pickling. arrays relates names to
+        arrays, and dictionaries relates names to lists of values.
+
+        The variable length dns_query_names column is stored as
+        dns_query_counts (the number of names of each packet, -1 if
+        missing), and dns_query_ids (the concatenated ids of the names,
+        into the dns_query_names dictionary). Likewise, dns_resp_ips is
+        stored as dns_resp_ip_counts and dns_resp_ip_ids (see
+        OBJECT_ARRAYS).
+        """
+        arrays = {}
+        for field, column in self._columns.items():
+            if field not in ColumnarTSAStream.OBJECT_FIELDS:
+                arrays[field] = column
+
+        dictionaries = {'addresses': self._addresses.values}
+        for field, (counts_name, ids_name) in \
+                ColumnarTSAStream.OBJECT_ARRAYS.items():
+            dictionary = _Dictionary()
+            counts = np.full(len(self), -1, dtype=np.int32)
+            ids = []
+            for index, values in enumerate(self._columns[field]):
+                if values is not None:
+                    counts[index] = len(values)
+                    ids.extend(dictionary.encode(x) for x in values)
+            arrays[counts_name] = counts
+            arrays[ids_name] = np.array(ids, dtype=np.int32)
+            dictionaries[field] = dictionary.values
+        for field, dictionary in self._categories.items():
+            dictionaries[field] = dictionary.values
+        return (arrays, dictionaries)
+
+    @staticmethod
+    def from_arrays(arrays, dictionaries):
+        """
+        Returns a ColumnarTSAStream from the output of to_arrays. The
+        provided arrays are used as columns without being copied, so
+        they may be (read only) views of a memory mapped file.
+        """
+        columns = {}
+        for field in ColumnarTSAStream.TIMESTAMP_FIELDS + \
+                list(ColumnarTSAStream.INTEGER_FIELDS) + \
+                ColumnarTSAStream.ADDRESS_FIELDS + \
+                ColumnarTSAStream.CATEGORICAL_FIELDS:
+            columns[field] = arrays[field]
+        addresses = _Dictionary(dictionaries['addresses'])
+        categories = {}
+        for field in ColumnarTSAStream.CATEGORICAL_FIELDS:
+            categories[field] = _Dictionary(dictionaries[field])
+
+        for field, (counts_name, ids_name) in \
+                ColumnarTSAStream.OBJECT_ARRAYS.items():
+            values = dictionaries[field]
+            counts = arrays[counts_name]
+            ids = arrays[ids_name].tolist()
+            column = np.empty(len(counts), dtype=object)
+            position = 0
+            for index in np.flatnonzero(counts >= 0).tolist():
+                count = int(counts[index])
+                column[index] = [values[x] for x in
+                                 ids[position:position + count]]
+                position += count
+            columns[field] = column
+
+        return ColumnarTSAStream(columns, addresses, categories)
+
+    ### HELPER METHODS ###
+
+    def _take(self, selector):
+        """
+        Returns a ColumnarTSAStream containing the packets selected by
+        the provided slice, index array or boolean mask. The returned
+        stream shares its dictionaries with this one.
+        """
+        columns = {}
+        for field, column in self._columns.items():
+            columns[field] = column[selector]
+        return ColumnarTSAStream(columns, self._addresses, self._categories)
+
+    def _match(self, key, value):
+        """
+        Returns a boolean mask of the packets whose value for
+        the provided key is equal to the provided value.
+        """
+        column = self._columns[key]
+        if key in ColumnarTSAStream.TIMESTAMP_FIELDS:
+            return column == _datetime_to_ns(value)
+        elif key in ColumnarTSAStream.INTEGER_FIELDS:
+            return column == _null_to_minus_one(value)
+        elif key in ColumnarTSAStream.ADDRESS_FIELDS:
+            return column == self._addresses.lookup(value)
+        elif key in ColumnarTSAStream.CATEGORICAL_FIELDS:
+            return column == self._categories[key].lookup(value)
+        else:
+            return np.fromiter((x == value for x in column), dtype=bool,
+                    count=len(column))
+
+    def _decode_packet(self, index):
+        """
+        Creates the TSAPacket at the provided index of the stream.
+        """
+        columns = self._columns
+        init_data = {}
+        init_data['timestamp'] = _ns_to_datetime(
+                int(columns['timestamp'][index]))
+        for field in ColumnarTSAStream.INTEGER_FIELDS:
+            value = int(columns[field][index])
+            init_data[field] = value if value >= 0 else None
+        for field in ColumnarTSAStream.ADDRESS_FIELDS:
+            init_data[field] = self._addresses.decode(
+                    columns[field][index])
+        for field in ColumnarTSAStream.CATEGORICAL_FIELDS:
+            init_data[field] = self._categories[field].decode(
+                    columns[field][index])
+        for field in ColumnarTSAStream.OBJECT_FIELDS:
+            init_data[field] = columns[field][index]
+        return TSAPacket(init_data)
+
+
+class _Dictionary:
+    """
+    Maps the distinct values of a dictionary encoded column to
+    integer ids, and back. None is always encoded as -1.
+    """
+
+    def __init__(self, values=()):
+        self.values = []
+        self._ids = {}
+        self._decode_array = None
+        for value in values:
+            self.encode(value)
+
+    def encode(self, value):
+        """
+        Returns the id of the provided value, assigning it a new
+        id if it hasn't been seen before.
+        """
+        if value is None:
+            return -1
+        value_id = self._ids.get(value)
+        if value_id is None:
+            value_id = len(self.values)
+            self._ids[value] = value_id
+            self.values.append(value)
+            self._decode_array = None
+        return value_id
+
+    def lookup(self, value):
+        """
+        Returns the id of the provided value, or -2 (which matches
+        no entries) if the value hasn't been seen before.
+        """
+        if value is None:
+            return -1
+        return self._ids.get(value, -2)
+
+    def decode(self, value_id):
+        return self.values[value_id] if value_id >= 0 else None
+
+    def decode_array(self, ids):
+        """
+        Returns an object array of the values for an array of ids.
+        """
+        if self._decode_array is None:
+            # Put None at the end, so an id of -1 indexes it
+            self._decode_array = np.empty(len(self.values) + 1, dtype=object)
+            self._decode_array[:-1] = self.values
+        return self._decode_array[ids]
+
+def _remap(ids, source, target):
+    """
+    Converts an array of ids into the source _Dictionary into
+    an array of ids of the same values in the target _Dictionary.
+    """
+    mapping = np.array([target.encode(x) for x in source.values] + [-1],
+            dtype=ids.dtype)
+    return mapping[ids]
+
+def _null_to_minus_one(value):
+    return -1 if value is None else value
+
+def _datetime_to_ns(timestamp):
+    """
+    Converts a (naive, local time) datetime into an integer
+    number of nanoseconds since the epoch.
+    """
+    seconds = int(timestamp.replace(microsecond=0).timestamp())
+    return seconds * NANOSECONDS_IN_SECONDS + timestamp.microsecond * 1000
+
+def _ns_to_datetime(timestamp_ns):
+    """
+    Converts an integer number of nanoseconds since the epoch
+    back into a (naive, local time) datetime.
+    """
+    (seconds, nanoseconds) = divmod(timestamp_ns, NANOSECONDS_IN_SECONDS)
+    return datetime.fromtimestamp(seconds) + \
+            timedelta(microseconds=nanoseconds // 1000)
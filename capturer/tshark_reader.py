@@ -0,0 +1,101 @@
+"""
+Reads packets by running tshark in field extraction mode (-T fields),
+which outputs only the fields TSAPacket needs as one tab separated
+line per packet, instead of the full dissection pyshark parses into
+layered objects.
+
+The values yielded by the functions in this module are lists of the
+values of TSAPacket.TSHARK_FIELDS, suitable for passing to
+TSAPacket.parse_tshark_fields.
+"""
+
+from capturer.tsa_packet import TSAPacket
+
+import shutil
+import subprocess
+import tempfile
+
+class TsharkException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+def get_tshark_path():
+    """
+    Returns the path of the tshark binary pyshark is configured to use,
+    or of the one on the PATH if pyshark is missing or can't tell (the
+    function to ask it with was renamed in pyshark 0.4).
+
+    Raises TsharkException if tshark can't be found.
+    """
+    try:
+        from pyshark.tshark import tshark
+    except ImportError:
+        tshark = None
+    for function_name in ('get_process_path', 'get_tshark_path'):
+        if hasattr(tshark, function_name):
+            try:
+                return getattr(tshark, function_name)()
+            except Exception:
+                # pyshark raises its own exception if it finds none
+                break
+
+    tshark_path = shutil.which("tshark")
+    if tshark_path is None:
+        raise TsharkException("tshark could not be found")
+    return tshark_path
+
+def iter_file_fields(cap_filename, display_filter=None):
+    """
+    Yields the field values of each packet in the provided
+    capture file (that matches display_filter, if provided).
+
+    Raises TsharkException if tshark fails.
+    """
+    args = ['-r', cap_filename]
+    if display_filter:
+        args += ['-Y', display_filter]
+    return _iter_fields(args)
+
+def iter_live_fields(cap_interface, bpf_filter=None, display_filter=None):
+    """
+    Captures packets on the provided interface, and yields the field
+    values of each as soon as tshark outputs it. Runs until the
+    consumer stops iterating, or tshark exits.
+
+    Raises TsharkException if tshark fails.
+    """
+    args = ['-i', cap_interface, '-l']
+    if bpf_filter:
+        args += ['-f', bpf_filter]
+    if display_filter:
+        args += ['-Y', display_filter]
+    return _iter_fields(args)
+
+def _iter_fields(args):
+    command = [get_tshark_path()] + args + ['-n', '-T', 'fields',
+            '-E', 'separator=/t', '-E', 'occurrence=a', '-E', 'aggregator=,',
+            '-E', 'quote=n', '-E', 'header=n']
+    for field in TSAPacket.TSHARK_FIELDS:
+        command += ['-e', field]
+
+    # stderr goes to a file, so a chatty tshark can't fill up the
+    # pipe and block while this process is only reading stdout
+    with tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                stderr=stderr_file, universal_newlines=True,
+                errors='replace')
+        try:
+            for line in process.stdout:
+                yield line.rstrip('\n').split('\t')
+            return_code = process.wait()
+        finally:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+            process.stdout.close()
+
+        if return_code != 0:
+            stderr_file.seek(0)
+            raise TsharkException("tshark exited with status %d: %s" % (
+                    return_code, stderr_file.read().decode(errors='replace')
+                    .strip()))
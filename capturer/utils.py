@@ -2,9 +2,98 @@
 Defines utility functions for the capturer layer
 """
 
+import collections
+import threading
+import time
+
 def split_cdl(cdl_string):
     """
     Accepts a comma delimited list of values as a string,
     and returns a list of the string elements.
     """
     return [x.strip() for x in cdl_string.split(',')]
+
+def min_dns_ttl(ttls):
+    """
+    Returns the smallest of the provided DNS TTLs (integers or
+    strings), in seconds. TTLs with the most significant bit set
+    are treated as 0 (see RFC 2181, section 8).
+    """
+    return min(int(ttl) if int(ttl) < 2 ** 31 else 0 for ttl in ttls)
+
+class LRUCache:
+    """
+    Thread safe mapping with a bounded size, whose entries expire
+    after a time to live (in seconds) set when they are stored.
+
+    Once maxsize entries are stored, storing another evicts the least
+    recently used entry. A maxsize or ttl of None means no limit.
+    Lookups, hits, misses, expirations and evictions are counted, and
+    may be read with get_stats.
+    """
+
+    def __init__(self, maxsize=None, ttl=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        # key -> (expiry time, value), least recently used first
+        self._entries = collections.OrderedDict()
+        self._stats = {'hits': 0, 'misses': 0, 'expirations': 0,
+                       'evictions': 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] > self._clock()
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored for the provided key, or default if
+        there is none (or it has expired).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > self._clock():
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return entry[1]
+                del self._entries[key]
+                self._stats['expirations'] += 1
+            self._stats['misses'] += 1
+            return default
+
+    def put(self, key, value, ttl=None):
+        """
+        Stores a value for the provided key, which expires after ttl
+        seconds (or the cache's default ttl, if none is provided).
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expiry = self._clock() + ttl if ttl is not None else float('inf')
+        with self._lock:
+            self._entries[key] = (expiry, value)
+            self._entries.move_to_end(key)
+            while self.maxsize and len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        """
+        Returns a dictionary of the cache's counters (hits, misses,
+        expirations, evictions), its current size, and its hit ratio.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0
+        return stats
@@ -5,103 +5,720 @@ This module should be initialized via either of the init methods
 before its other methods are used.
 """
 
+from capturer import capture_cache, capture_filters, pcap_reader, telemetry
+from capturer.capture_follower import CaptureFollower
+from capturer.capture_merger import CaptureMerger
+from capturer.packet_buffer import PacketBuffer, SpillStore
 from capturer.tsa_packet import TSAPacket, TSAPacketParseException
-from capturer.tsa_stream import TSAStream
+from capturer.tsa_stream import ColumnarTSAStream, TSAStream
+from capturer.utils import split_cdl
+from settings import get_setting
 
-import collections
+import functools
+import multiprocessing
+import os
 import pyshark
+import queue
+import resource
+import sys
 import threading
+import time
 
-# Pyshark Capture object containing the
-# current captured Wireshark packets
-pyshark_capture = None
+# Whether either of the init methods has been called
+initialized = False
 
-# Deque that acts as a ring buffer for
-# the captured and parsed Wireshark packets
-packet_deque = collections.deque(maxlen=20000)
+# Pyshark Capture objects containing the current captured
+# Wireshark packets (one per captured interface)
+pyshark_captures = []
 
-# Background thread used to capture packets with
+# Ring buffer for the captured and parsed Wireshark packets
+packet_buffer = None
+
+# Background thread used to capture packets with (or to merge the
+# packets captured on multiple interfaces into the buffer with)
 background_thread = None
 
+# Background threads capturing packets on each of
+# multiple interfaces, and the queue they feed
+capture_threads = []
+merge_queue = None
+
+# Name of the file the progress of a directory follow is
+# checkpointed to, if the FollowCheckpointFile setting is empty
+FOLLOW_CHECKPOINT_FILENAME = ".tsa-follow-checkpoint.json"
+
+# Maximum number of captured packets waiting to be merged. Packets
+# captured while the queue is full are dropped (and counted).
+MERGE_QUEUE_SIZE = 100000
+
+# Collects the packets read from a file while they are being read,
+# if they are to be written to the capture cache afterwards
+cache_writer = None
+
+# Number of chunks a file is split into per parser worker process,
+# so that workers which finish early can pick up more work
+CHUNKS_PER_WORKER = 4
+
+# Statistics about the last file ingestion, or the running live capture
+ingest_stats = {}
+
+# How often (in seconds) the ingestion statistics
+# of a live capture are brought up to date
+LIVE_STATS_INTERVAL = 10
+
 def init_from_file(cap_filename):
     """
     Initializes the wireshark proxy using the provided .pcap file.
+
+    The file is read with the reader chosen by the FileReader setting:
+    either 'native', which decodes the packets directly from the file
+    (falling back to pyshark for any packets it can't decode),
+    'tshark', which has tshark extract only the fields TSAPacket needs,
+    or 'pyshark', which dissects every packet with tshark.
+
+    Packets that can't be parsed, or are excluded by the filter
+    section of the settings file, are dropped by tshark where possible
+    (see capturer.capture_filters).
+
+    Packets are streamed through the parser one at a time, so memory
+    use is bounded by the size of the buffer rather than the file.
+    Throughput and peak memory use are recorded in ingest_stats.
+
+    If the EnableCache setting is on, the parsed packets are saved to
+    a cache file (see capturer.capture_cache), which is loaded instead
+    of parsing the file again the next time it is read with the same
+    settings.
     """
-    global pyshark_capture, packet_deque
-    if pyshark_capture:
+    global initialized, packet_buffer, cache_writer
+    if initialized:
         raise RuntimeError("Attempted to double initialize wireshark proxy.")
+    initialized = True
+    packet_buffer = _create_packet_buffer()
+    telemetry.register_collector(_collect_buffer_metrics)
+
+    start_time = time.time()
+    reader = get_setting('app', 'FileReader')
+    use_cache = get_setting('cache', 'EnableCache', 'bool')
+    num_packets = None
+    if use_cache:
+        num_packets = _read_file_cache(cap_filename, reader)
+    if num_packets is not None:
+        reader = 'cache'
+    elif use_cache:
+        cache_writer = capture_cache.CacheWriter()
+
+    if reader == 'native':
+        try:
+            num_packets = _read_file_native(cap_filename)
+        except pcap_reader.PcapFormatException:
+            packet_buffer.close()
+            packet_buffer = _create_packet_buffer()
+            if cache_writer is not None:
+                cache_writer = capture_cache.CacheWriter()
+            reader = 'pyshark'
+    elif reader == 'tshark':
+        # Imported only when used, so the other readers never depend on it
+        from capturer import tshark_reader
+        num_packets = _ingest(_parse_packets(tshark_reader.iter_file_fields(
+                cap_filename, capture_filters.build_display_filter()),
+                TSAPacket.parse_tshark_fields))
+    if num_packets is None:
+        num_packets = _ingest(_parse_packets(_iter_pyshark_file(
+                cap_filename, capture_filters.build_display_filter())))
+    if cache_writer is not None:
+        _write_file_cache(cap_filename, get_setting('app', 'FileReader'))
+
+    _record_ingest_stats(reader, num_packets, time.time() - start_time)
+    print("Read {} packets from {} in {:.2f}s ({:.0f} packets/sec), "
+            "peak RSS {:.1f} MB".format(num_packets, cap_filename,
+            ingest_stats['seconds'], ingest_stats['packets_per_sec'],
+            ingest_stats['peak_rss_bytes'] / (1024 * 1024)))
+
+def _create_packet_buffer():
+    """
+    Creates a PacketBuffer with the retention limits in the buffer
+    section of the settings file. Limits set to 0 are not applied.
+    """
+    spill_store = None
+    spill_directory = get_setting('buffer', 'SpillDirectory')
+    if spill_directory:
+        spill_store = SpillStore(spill_directory,
+                segment_size=get_setting('buffer', 'SpillSegmentPackets', 'int'),
+                max_segments=get_setting('buffer', 'SpillMaxSegments', 'int'))
+
+    return PacketBuffer(
+            maxlen=get_setting('buffer', 'MaxPackets', 'int'),
+            max_age=get_setting('buffer', 'MaxAgeSeconds', 'int'),
+            max_bytes=get_setting('buffer', 'MaxMemoryMB', 'int') * 1024 * 1024,
+            spill_store=spill_store)
+
+def _get_cache_filename(cap_filename):
+    return capture_cache.get_cache_filename(cap_filename,
+            get_setting('cache', 'CacheDirectory'))
+
+def _read_file_cache(cap_filename, reader):
+    """
+    Places the packets in the capture cache for the provided file into
+    the buffer, if there is a cache matching the file and the current
+    settings. Returns the number of packets read, or None if there was
+    no usable cache.
+    """
+    global packet_buffer
+    cache_filename = _get_cache_filename(cap_filename)
+    try:
+        stream = capture_cache.read_cache(cache_filename, cap_filename,
+                reader, capture_filters.build_display_filter())
+    except capture_cache.CaptureCacheException as e:
+        print("Ignoring capture cache {}: {}".format(cache_filename, e))
+        return None
+    if stream is None:
+        return None
+
+    # Only the packets that will remain in the buffer need to be
+    # decoded, unless the rest are to be spilled
+    num_packets = len(stream)
+    if packet_buffer.spill_store is None and packet_buffer.maxlen:
+        stream = stream[-packet_buffer.maxlen:]
+    packet_buffer.extend(stream.get_packets())
+    return num_packets
+
+def _write_file_cache(cap_filename, reader):
+    """
+    Writes the packets collected by the cache writer to the capture
+    cache for the provided file. Failing to write the cache is not
+    fatal, as it only makes the next startup slower.
+    """
+    global cache_writer
+    cache_filename = _get_cache_filename(cap_filename)
+    try:
+        cache_writer.write(cache_filename, capture_cache.get_cache_key(
+                cap_filename, reader, capture_filters.build_display_filter()))
+    except OSError as e:
+        print("Could not write capture cache {}: {}".format(cache_filename, e))
+    finally:
+        cache_writer = None
+
+def _read_file_native(cap_filename):
+    """
+    Reads the packets in the provided file with the native pcap
+    reader, and places them into the buffer. Returns the number of
+    packets read.
+
+    Packets the native reader could not decode are parsed with pyshark
+    instead. Every packet must reach the buffer in file order (and only
+    once, as it may be spilled), so packets are placed into the buffer
+    until the first such frame is found, after which the rest of the
+    file is only scanned for them. They are then parsed with pyshark,
+    and the file is parsed natively again from the first of them, with
+    the pyshark packets placed into the buffer in their frames' places.
+
+    If the ParserWorkers setting is greater than 1, the file is first
+    parsed in that many worker processes.
+
+    Raises PcapFormatException if the file could not be read natively.
+    """
+    is_included = capture_filters.build_packet_predicate()
+    num_workers = get_setting('app', 'ParserWorkers', 'int')
+    capture_file = pcap_reader.open_capture(cap_filename)
+    try:
+        if num_workers > 1:
+            (num_packets, fallback_frames, resume_frame) = \
+                    _read_file_parallel(capture_file, cap_filename,
+                    num_workers, is_included)
+        else:
+            (num_packets, fallback_frames, resume_frame) = \
+                    _read_file_serial(capture_file, is_included)
+        if resume_frame is None:
+            return num_packets
+        return num_packets + _ingest(_iter_merged_packets(capture_file,
+                cap_filename, fallback_frames, resume_frame, is_included))
+    finally:
+        capture_file.close()
+
+def _read_file_serial(capture_file, is_included=None):
+    """
+    Parses the provided capture file, placing the packets into the
+    buffer up to the first frame that could not be decoded natively.
+    Returns a (num_packets, fallback_frames, resume_frame) tuple,
+    where num_packets is the number of packets placed into the buffer,
+    fallback_frames the numbers of the frames that could not be
+    decoded, and resume_frame the number of the first frame whose
+    packet was not placed into the buffer (or None if all were).
+    is_included is passed through to CaptureFile.parse.
+    """
+    fallback_frames = []
+    rejections = {}
+    results = capture_file.parse(rejections=rejections,
+            is_included=is_included)
 
-    pyshark_capture = pyshark.FileCapture(cap_filename)
+    def packets_until_fallback():
+        for frame_number, tsa_packet in results:
+            if tsa_packet is None:
+                fallback_frames.append(frame_number)
+                return
+            yield tsa_packet
 
-    # Attempt to parse each packet and drop the ones that fail
-    # from the dequeue. Stop once we've run out of packets.
-    index = 0
-    while True:
+    num_packets = _ingest(packets_until_fallback())
+    # Carry on through the rest of the file, only
+    # to find the other frames needing pyshark
+    fallback_frames.extend(frame_number for frame_number, tsa_packet
+            in results if tsa_packet is None)
+    _record_parse_results(num_packets, rejections)
+    resume_frame = fallback_frames[0] if fallback_frames else None
+    return (num_packets, fallback_frames, resume_frame)
+
+def _read_file_parallel(capture_file, cap_filename, num_workers,
+        is_included=None):
+    """
+    Splits the provided capture file into record aligned chunks, parses
+    them in a pool of num_workers processes, and places the resulting
+    packets into the buffer in file order, so the result is the same as
+    reading the file serially. Packets are placed into the buffer up to
+    the first chunk containing a frame that could not be decoded
+    natively. Returns a tuple like _read_file_serial does, except that
+    resume_frame is the first frame of that chunk. is_included is
+    passed through to CaptureFile.parse.
+    """
+    global packet_buffer
+    chunks = capture_file.split(num_workers * CHUNKS_PER_WORKER)
+
+    # Unless they are being spilled or cached, only the packets that
+    # will remain in the buffer need to be sent back from the workers
+    keep_last = packet_buffer.maxlen or None
+    if packet_buffer.spill_store or cache_writer is not None:
+        keep_last = None
+    parse_chunk = functools.partial(pcap_reader.parse_chunk, cap_filename,
+            keep_last=keep_last, is_included=is_included)
+    num_packets = 0
+    fallback_frames = []
+    resume_frame = None
+    with multiprocessing.Pool(num_workers) as pool:
+        for chunk, (num_chunk_packets, tsa_packets, chunk_fallback_frames,
+                rejections) in zip(chunks, pool.imap(parse_chunk, chunks)):
+            if chunk_fallback_frames and resume_frame is None:
+                resume_frame = chunk.frame_offset + 1
+            fallback_frames.extend(chunk_fallback_frames)
+            if resume_frame is not None:
+                # Parsed again (and counted) once the fallback
+                # frames have been parsed
+                _record_parse_results(0, rejections)
+                continue
+            num_packets += num_chunk_packets
+            _record_parse_results(num_chunk_packets, rejections)
+            packet_buffer.extend(tsa_packets)
+            if cache_writer is not None:
+                cache_writer.extend(tsa_packets)
+    return (num_packets, fallback_frames, resume_frame)
+
+def _iter_merged_packets(capture_file, cap_filename, fallback_frames,
+        start_frame, is_included=None):
+    """
+    Yields the packets of the provided capture file (opened from
+    cap_filename) from start_frame on, in frame order. The provided
+    frames, which could not be decoded natively, are parsed with
+    pyshark first, and the others are parsed natively again.
+    is_included is passed through to CaptureFile.parse.
+    """
+    fallback_packets = _parse_fallback_frames(cap_filename, fallback_frames)
+    num_native = 0
+    for frame_number, tsa_packet in capture_file.parse(
+            is_included=is_included, start_frame=start_frame):
+        if tsa_packet is None:
+            tsa_packet = fallback_packets.get(frame_number)
+            if tsa_packet is None:
+                continue
+        else:
+            num_native += 1
+        yield tsa_packet
+    # Rejections were counted when the file was first parsed
+    _record_parse_results(num_native, {})
+
+def _parse_fallback_frames(cap_filename, fallback_frames):
+    """
+    Parses the provided frames of the provided file with pyshark, and
+    returns a dictionary relating the number of each frame that parsed
+    to its TSAPacket.
+    """
+    display_filter = "frame.number in {%s}" % " ".join(
+            str(frame_number) for frame_number in fallback_frames)
+    display_filter = capture_filters.build_display_filter(display_filter)
+    fallback_packets = {}
+    for packet in _iter_pyshark_file(cap_filename, display_filter):
+        for tsa_packet in _parse_packets([packet]):
+            fallback_packets[int(packet.number)] = tsa_packet
+    return fallback_packets
+
+def _iter_pyshark_file(cap_filename, display_filter=None):
+    """
+    Yields the pyshark packets in the provided file one at a time.
+    The capture does not keep a reference to the yielded packets, so
+    each is freed as soon as the consumer is done with it.
+    """
+    file_capture = pyshark.FileCapture(cap_filename, keep_packets=False,
+            display_filter=display_filter)
+    try:
+        for packet in file_capture:
+            yield packet
+    finally:
+        file_capture.close()
+
+def _parse_packets(packets, parse_packet=TSAPacket.parse_pyshark_packet):
+    """
+    Yields a TSAPacket for each of the provided packets (pyshark
+    packets by default, or any input accepted by parse_packet),
+    dropping the ones that fail to parse (which are only counted
+    in the telemetry, by rejection reason).
+    """
+    for packet in packets:
+        telemetry.increment('capture_packets_seen_total')
         try:
-            packet = pyshark_capture[index]
-            tsa_packet = TSAPacket.parse_pyshark_packet(packet)
-            packet_deque.append(tsa_packet)
-        except TSAPacketParseException:
+            tsa_packet = parse_packet(packet)
+        except TSAPacketParseException as e:
+            telemetry.increment('capture_packets_rejected_total',
+                    reason=e.reason)
             continue
-        except KeyError:
-            break
-        finally:
-            index += 1
+        telemetry.increment('capture_packets_parsed_total')
+        yield tsa_packet
+
+def _record_parse_results(num_parsed, rejections):
+    """
+    Adds the outcome of parsing packets natively to the telemetry.
+    Records sent to pyshark are counted when pyshark parses them.
+    """
+    num_rejected = sum(rejections.values())
+    telemetry.increment('capture_packets_seen_total', num_parsed + num_rejected)
+    telemetry.increment('capture_packets_parsed_total', num_parsed)
+    for reason, count in rejections.items():
+        telemetry.increment('capture_packets_rejected_total', count,
+                reason=reason)
 
-def init_live_capture(cap_interface):
+def _collect_buffer_metrics():
+    """
+    Telemetry collector reporting the state of the packet buffer.
+    """
+    buffer = packet_buffer
+    if buffer is None:
+        return {}
+    return {
+        ('buffer_packets', ()): len(buffer),
+        ('buffer_bytes', ()): buffer.num_bytes,
+        ('capture_packets_evicted_total', ()): buffer.num_evicted,
+    }
+
+def _ingest(tsa_packets):
+    """
+    Places the provided TSAPackets into the buffer (and the cache
+    writer, if there is one), and returns the number of packets placed.
+    """
+    global packet_buffer
+    num_packets = 0
+    for tsa_packet in tsa_packets:
+        packet_buffer.append(tsa_packet)
+        if cache_writer is not None:
+            cache_writer.add(tsa_packet)
+        num_packets += 1
+    return num_packets
+
+def _record_ingest_stats(reader, num_packets, seconds):
+    """
+    Records the throughput and peak memory use of an ingestion.
+    """
+    global ingest_stats
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on OS X, and kilobytes elsewhere
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+    ingest_stats = {
+        'reader': reader,
+        'packets': num_packets,
+        'seconds': seconds,
+        'packets_per_sec': num_packets / seconds if seconds else 0,
+        'peak_rss_bytes': peak_rss,
+    }
+
+def get_ingest_stats():
+    """
+    Returns a dictionary describing the last file ingestion, or the
+    running live capture (as of the last LIVE_STATS_INTERVAL), with
+    the following fields (or an empty dictionary if no packets have
+    been read yet):
+        reader:  reader used ('native' | 'tshark' | 'pyshark' | 'cache'
+                 | 'follow')
+        packets:  number of packets parsed
+        seconds:  time taken to read the file
+        packets_per_sec:  parsing throughput
+        peak_rss_bytes:  peak resident memory of the process
+    """
+    return dict(ingest_stats)
+
+def init_live_capture(cap_interfaces):
     """
     Initializes the wireshark proxy and begins a wireshark
     live capture as a background thread.
+
+    cap_interfaces may be a single interface, a comma delimited list
+    of interfaces, or a list of interfaces. When capturing on multiple
+    interfaces, each is captured in its own thread, and the packets are
+    merged into the buffer in timestamp order, without the copies of
+    packets seen on more than one interface (see CaptureMerger).
+
+    Packets are captured with the reader chosen by the LiveReader
+    setting: either 'pyshark', which dissects every packet, or
+    'tshark', which has tshark extract only the fields TSAPacket needs.
     """
-    global pyshark_capture, background_thread
-    if pyshark_capture:
+    global initialized, packet_buffer, background_thread, capture_threads, \
+            merge_queue
+    if initialized:
         raise RuntimeError("Attempted to double initialize wireshark proxy.")
+    initialized = True
+    packet_buffer = _create_packet_buffer()
+    telemetry.register_collector(_collect_buffer_metrics)
+
+    if isinstance(cap_interfaces, str):
+        cap_interfaces = split_cdl(cap_interfaces)
+    reader = get_setting('app', 'LiveReader')
 
     # Define method that continuously captures and
-    # parses packets and places them into the deque
+    # parses packets and places them into the buffer
     def capture_packets():
-        global pyshark_capture, packet_deque
-        pyshark_capture = pyshark.LiveCapture(cap_interface)
-        for packet in pyshark_capture.sniff_continuously():
+        global packet_buffer
+        stats = _LiveStats(reader)
+        for tsa_packet in _iter_live_packets(cap_interfaces[0], reader):
+            packet_buffer.append(tsa_packet)
+            stats.record(tsa_packet)
+
+    # Define methods that capture packets on one interface each, and
+    # place them into the merge queue, and that merges the packets in
+    # the queue into the buffer
+    def capture_interface_packets(cap_interface):
+        for tsa_packet in _iter_live_packets(cap_interface, reader):
+            telemetry.increment('capture_interface_packets_total',
+                    interface=cap_interface)
             try:
-                tsa_packet = TSAPacket.parse_pyshark_packet(packet)
-                packet_deque.append(tsa_packet)
-            except TSAPacketParseException:
-                continue
+                merge_queue.put_nowait((cap_interface, tsa_packet))
+            except queue.Full:
+                telemetry.increment('capture_interface_dropped_total',
+                        interface=cap_interface)
+
+    def merge_packets():
+        global packet_buffer
+        merger = CaptureMerger(
+                get_setting('app', 'MergeDelayMs', 'int') / 1000,
+                get_setting('app', 'DuplicateWindowMs', 'int') / 1000)
+        stats = _LiveStats(reader)
+        while True:
+            ready_time = merger.next_ready_time()
+            timeout = None if ready_time is None else \
+                    max(0, ready_time - time.time())
+            try:
+                merger.add(*merge_queue.get(timeout=timeout))
+            except queue.Empty:
+                pass
+
+            duplicates = {}
+            for (cap_interface, tsa_packet) in merger.pop_ready(time.time(),
+                    duplicates):
+                packet_buffer.append(tsa_packet)
+                stats.record(tsa_packet)
+            for cap_interface, count in duplicates.items():
+                telemetry.increment('capture_interface_duplicates_total',
+                        count, interface=cap_interface)
+
+    # Run these methods in the background
+    if len(cap_interfaces) == 1:
+        background_thread = threading.Thread(target=capture_packets)
+        background_thread.start()
+        return
+
+    merge_queue = queue.Queue(MERGE_QUEUE_SIZE)
+    background_thread = threading.Thread(target=merge_packets)
+    background_thread.start()
+    for cap_interface in cap_interfaces:
+        capture_thread = threading.Thread(target=capture_interface_packets,
+                args=(cap_interface,))
+        capture_thread.start()
+        capture_threads.append(capture_thread)
+
+def init_follow_directory(cap_directory):
+    """
+    Initializes the wireshark proxy, and begins following the capture
+    files written to the provided directory by an external capturer
+    (see CaptureFollower) in a background thread. The directory is
+    polled every FollowPollSeconds for new packets.
+
+    Records the native reader can't decode are parsed with pyshark
+    once the capturer has moved on from the file they are in. So that
+    the buffer stays in file order, the packets after the first such
+    record in a file are held back until then, and merged with them
+    by frame number (as when reading a file natively).
+    """
+    global initialized, packet_buffer, background_thread
+    if initialized:
+        raise RuntimeError("Attempted to double initialize wireshark proxy.")
+    initialized = True
+    packet_buffer = _create_packet_buffer()
+    telemetry.register_collector(_collect_buffer_metrics)
+
+    checkpoint_filename = get_setting('app', 'FollowCheckpointFile') or \
+            os.path.join(cap_directory, FOLLOW_CHECKPOINT_FILENAME)
+    follower = CaptureFollower(cap_directory,
+            get_setting('app', 'FollowPattern'), checkpoint_filename)
+    poll_interval = get_setting('app', 'FollowPollSeconds', 'int')
+    is_included = capture_filters.build_packet_predicate()
+
+    # Define method that continuously polls the directory
+    # for new packets and places them into the buffer
+    def follow_packets():
+        global packet_buffer
+        stats = _LiveStats('follow')
+        while True:
+            rejections = {}
+            (tsa_packets, completed_files) = follower.poll(rejections,
+                    is_included)
+            _record_parse_results(len(tsa_packets), rejections)
+            for tsa_packet in tsa_packets:
+                packet_buffer.append(tsa_packet)
+                stats.record(tsa_packet)
+
+            for (cap_filename, fallback_frames) in completed_files:
+                if not fallback_frames:
+                    continue
+                capture_file = pcap_reader.open_capture(cap_filename)
+                try:
+                    for tsa_packet in _iter_merged_packets(capture_file,
+                            cap_filename, fallback_frames,
+                            fallback_frames[0], is_included):
+                        packet_buffer.append(tsa_packet)
+                        stats.record(tsa_packet)
+                finally:
+                    capture_file.close()
+            time.sleep(poll_interval)
 
     # Run this method in the background
-    background_thread = threading.Thread(target=capture_packets)
+    background_thread = threading.Thread(target=follow_packets)
     background_thread.start()
 
+def _iter_live_packets(cap_interface, reader):
+    """
+    Captures packets on the provided interface with the provided
+    reader, and yields them as TSAPackets.
+    """
+    bpf_filter = capture_filters.build_bpf_filter()
+    display_filter = capture_filters.build_display_filter()
+    if reader == 'tshark':
+        from capturer import tshark_reader
+        return _parse_packets(tshark_reader.iter_live_fields(
+                cap_interface, bpf_filter, display_filter),
+                TSAPacket.parse_tshark_fields)
+    pyshark_capture = pyshark.LiveCapture(cap_interface,
+            bpf_filter=bpf_filter, display_filter=display_filter)
+    pyshark_captures.append(pyshark_capture)
+    return _parse_packets(pyshark_capture.sniff_continuously())
+
+class _LiveStats:
+    """
+    Records the latency of each packet placed into the buffer by a
+    live capture, and keeps ingest_stats up to date.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.num_packets = 0
+        self.start_time = self.last_stats_time = time.time()
+
+    def record(self, tsa_packet):
+        self.num_packets += 1
+        now = time.time()
+        telemetry.observe('capture_latency_seconds',
+                now - tsa_packet.timestamp.timestamp())
+        if now - self.last_stats_time >= LIVE_STATS_INTERVAL:
+            _record_ingest_stats(self.reader, self.num_packets,
+                    now - self.start_time)
+            self.last_stats_time = now
+
 def cleanup():
     """
     Stops any background processes / threads and
     returns the module to its uninitialized state.
     """
-    global pyshark_capture, packet_deque, background_thread
-    if pyshark_capture:
-        pyshark_capture = None
-    if packet_deque:
-        packet_deque.clear()
+    global initialized, pyshark_captures, packet_buffer, background_thread, \
+            cache_writer, capture_threads, merge_queue
+    initialized = False
+    cache_writer = None
+    telemetry.unregister_collector(_collect_buffer_metrics)
+    if pyshark_captures:
+        pyshark_captures = []
+    if packet_buffer is not None:
+        packet_buffer.close()
+        packet_buffer = None
     if background_thread:
         background_thread = None
+    if capture_threads:
+        capture_threads = []
+    merge_queue = None
 
-def read_packets(num_packets=None):
+def read_packets(num_packets=None, columnar=False, start_time=None,
+        end_time=None):
     """
     Reads num_packets packets from the tail of the capture, and
     returns them as a TSAStream. Packets that fail to parse are
     silently dropped from the returned stream, and not counted.
 
-    If num_packets is None, attempts to read all captured packets.
+    If num_packets is None, attempts to read all captured packets
+    still in the buffer. If start_time and / or end_time are provided,
+    reads all captured packets with a timestamp in [start_time,
+    end_time) instead. Either way, packets that have been spilled out
+    of the buffer to disk are read back in if needed.
+
+    If columnar is True, a ColumnarTSAStream is returned instead.
     """
-    global pyshark_capture, packet_deque
-    if pyshark_capture is None:
+    global initialized, packet_buffer
+    if not initialized:
         raise RuntimeError("Wireshark Proxy has not been initialized")
 
-    if not num_packets:
-        start_index = 0
+    if start_time or end_time:
+        tsa_packets = packet_buffer.read_range(start_time, end_time)
     else:
-        start_index = max(0, len(packet_deque) - num_packets)
-
-    tsa_packets = list(packet_deque)[start_index:]
+        tsa_packets = packet_buffer.read_tail(num_packets or None)
+    if columnar:
+        return ColumnarTSAStream.from_packets(tsa_packets)
     return TSAStream(tsa_packets)
+
+def read_packets_since(seq):
+    """
+    Reads the packets captured since the provided sequence number
+    (see PacketBuffer) without copying the rest of the buffer.
+
+    Returns a (tsa_stream, next_seq, oldest_seq) tuple, where tsa_stream
+    is a TSAStream of the new packets, next_seq is the sequence number
+    to pass to the next call, and oldest_seq is the sequence number of
+    the oldest packet still captured. If oldest_seq is greater than
+    seq, packets were evicted before they could be read.
+    """
+    global initialized, packet_buffer
+    if not initialized:
+        raise RuntimeError("Wireshark Proxy has not been initialized")
+
+    (tsa_packets, next_seq, oldest_seq) = packet_buffer.read_since(seq)
+    return (TSAStream(tsa_packets), next_seq, oldest_seq)
+
+def add_buffer_listener(listener):
+    """
+    Registers a listener that is told about each packet placed into,
+    and evicted from, the packet buffer (see PacketBuffer.add_listener).
+    """
+    global initialized, packet_buffer
+    if not initialized:
+        raise RuntimeError("Wireshark Proxy has not been initialized")
+
+    packet_buffer.add_listener(listener)
+
+def remove_buffer_listener(listener):
+    """
+    Unregisters a listener registered with add_buffer_listener.
+    """
+    global initialized, packet_buffer
+    if not initialized:
+        raise RuntimeError("Wireshark Proxy has not been initialized")
+
+    packet_buffer.remove_listener(listener)
@@ -2,7 +2,8 @@
 Defines the entry point for the application.
 """
 
-from capturer import geoip_proxy, p0f_proxy, wireshark_proxy
+from capturer import enrichment, geoip_proxy, p0f_proxy, wireshark_proxy
+from capturer.utils import split_cdl
 from analyzer.country import get_country_to_packet_count
 from analyzer.dns import get_tldn_to_packet_count
 from analyzer.metrics import get_bandwidth_traffic_volume, AVERAGE_BANDWIDTH, BANDWIDTH_DATA, TRAFFIC_VOLUME_DATA
@@ -19,12 +20,21 @@ if __name__ == "__main__":
     use_live_capture = get_setting('app', 'UseLiveCapture', 'bool')
     geoip_proxy.init_module()
     if use_live_capture:
-        capture_interface = get_setting('app', 'CaptureInterface')
-        wireshark_proxy.init_live_capture(capture_interface)
-        p0f_proxy.init_live_capture(capture_interface)
+        capture_interfaces = split_cdl(get_setting('app', 'CaptureInterface'))
+        wireshark_proxy.init_live_capture(capture_interfaces)
+        # p0f can only capture on a single interface
+        p0f_proxy.init_live_capture(capture_interfaces[0])
+        enrichment.init_module()
         print("Capturing initial packets...")
         sleep(10)
         print("Done!")
+    elif get_setting('app', 'FollowDirectory'):
+        wireshark_proxy.init_follow_directory(
+                get_setting('app', 'FollowDirectory'))
+        enrichment.init_module()
+        print("Reading initial packets...")
+        sleep(get_setting('app', 'FollowPollSeconds', 'int') + 1)
+        print("Done!")
     else:
 
         init_filepath = get_setting('app', 'InitFileLocation')
@@ -61,10 +71,12 @@ if __name__ == "__main__":
         print('{}, {}\n'.format(bt[0], bt[1]))
 
     # Start GUI
-    tsa_ui.start_ui(live_capture=use_live_capture)
+    tsa_ui.start_ui(live_capture=use_live_capture or
+            bool(get_setting('app', 'FollowDirectory')))
 
     # Perform clean up and exit the app
     print("All done. Perfoming cleanup...")
+    enrichment.cleanup()
     wireshark_proxy.cleanup()
     p0f_proxy.cleanup()
     geoip_proxy.cleanup()
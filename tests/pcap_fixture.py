@@ -0,0 +1,125 @@
+"""
+Builds small Ethernet .pcap files out of hand-assembled frames, so
+the readers can be tested on known packets without shipping captures.
+"""
+
+from capturer.tsa_packet import TSAPacket
+
+import socket
+import struct
+
+BASE_TIMESTAMP = 1500000000
+
+MAC_SRC = b'\x02\x00\x00\x00\x00\x01'
+MAC_DST = b'\x02\x00\x00\x00\x00\x02'
+
+def ethernet(ethertype, payload):
+    return MAC_DST + MAC_SRC + struct.pack('>H', ethertype) + payload
+
+def ipv4(src, dst, protocol, payload):
+    header = struct.pack('>BBHHHBBH4s4s', 0x45, 0, 20 + len(payload), 1, 0,
+            64, protocol, 0, socket.inet_aton(src), socket.inet_aton(dst))
+    return ethernet(0x0800, header + payload)
+
+def ipv6(src, dst, protocol, payload):
+    header = struct.pack('>IHBB16s16s', 6 << 28, len(payload), protocol, 64,
+            socket.inet_pton(socket.AF_INET6, src),
+            socket.inet_pton(socket.AF_INET6, dst))
+    return ethernet(0x86DD, header + payload)
+
+def tcp(src_port, dst_port, flags, payload=b""):
+    return struct.pack('>HHIIBBHHH', src_port, dst_port, 1, 0, 5 << 4,
+            flags, 65535, 0, 0) + payload
+
+def udp(src_port, dst_port, payload):
+    return struct.pack('>HHHH', src_port, dst_port, 8 + len(payload),
+            0) + payload
+
+def dns_name(name):
+    return b"".join(bytes([len(label)]) + label.encode('ascii')
+            for label in name.split('.')) + b'\x00'
+
+def dns_message(query_names, answers=()):
+    """
+    Returns a DNS message asking for each of the provided names (as
+    A records), with the provided (name, rr_type, ttl, rdata) answers.
+    """
+    flags = 0x8180 if answers else 0x0100
+    message = struct.pack('>HHHHHH', 0x1234, flags, len(query_names),
+            len(answers), 0, 0)
+    for name in query_names:
+        message += dns_name(name) + struct.pack('>HH', 1, 1)
+    for (name, rr_type, ttl, rdata) in answers:
+        message += dns_name(name) + struct.pack('>HHIH', rr_type, 1, ttl,
+                len(rdata)) + rdata
+    return message
+
+def icmp_unreachable(original_packet):
+    """
+    Returns an ICMP port unreachable message quoting the provided IPv4
+    packet (without its Ethernet header), which tshark dissects the
+    quoted headers of.
+    """
+    return struct.pack('>BBHI', 3, 3, 0, 0) + original_packet[14:42]
+
+def arp():
+    return ethernet(0x0806, struct.pack('>HHBBH', 1, 0x0800, 6, 4, 1) +
+            MAC_SRC + socket.inet_aton("10.0.0.1") + b'\x00' * 6 +
+            socket.inet_aton("10.0.0.2"))
+
+def mixed_frames():
+    """
+    Returns a list of frames covering what the readers must agree on:
+    IPv4 and IPv6, TCP and UDP, DNS queries with several questions and
+    responses with A and AAAA answers, HTTP, frames the parser rejects
+    (ARP, a TCP segment with neither SYN nor ACK set), and an ICMP
+    error, which the native reader leaves to pyshark.
+    """
+    dns_query = udp(53000, 53, dns_message(["example.com", "example.org"]))
+    return [
+        ipv4("10.0.0.1", "93.184.216.34", 6, tcp(40000, 443, 0x02)),
+        ipv6("2001:db8::1", "2001:db8::53", 17, dns_query),
+        ipv6("2001:db8::53", "2001:db8::1", 17, udp(53, 53000, dns_message(
+            ["example.com"], [("example.com", 28, 300, socket.inet_pton(
+                socket.AF_INET6, "2606:2800:220:1::1"))]))),
+        ipv4("10.0.0.1", "10.0.0.53", 17, udp(53001, 53,
+            dns_message(["example.net"]))),
+        ipv4("10.0.0.53", "10.0.0.1", 17, udp(53, 53001, dns_message(
+            ["example.net"], [("example.net", 1, 60,
+                socket.inet_aton("93.184.216.35"))]))),
+        ipv4("10.0.0.1", "93.184.216.34", 6, tcp(40001, 80, 0x18,
+            b"GET / HTTP/1.1\r\nHost: example.com\r\n\r\n")),
+        arp(),
+        ipv4("10.0.0.1", "93.184.216.34", 6, tcp(40002, 443, 0x01)),
+        ipv4("10.0.0.53", "10.0.0.1", 1, icmp_unreachable(ipv4("10.0.0.1",
+            "10.0.0.53", 17, udp(53002, 53, dns_message(["example.com"]))))),
+        ipv6("2001:db8::1", "2001:db8::2", 6, tcp(40003, 22, 0x12)),
+    ]
+
+def tshark_fields(index, frame_length, protocols, **values):
+    """
+    Returns the TSAPacket.TSHARK_FIELDS values tshark outputs for the
+    frame at the provided index, of the provided length and protocols,
+    with the provided field values (keyed by field name, with
+    underscores for dots).
+    """
+    values = dict(values, frame_time_epoch=str(BASE_TIMESTAMP + index),
+            frame_len=str(frame_length), frame_cap_len=str(frame_length),
+            frame_protocols=protocols)
+    return [values.get(field.replace('.', '_'), "")
+            for field in TSAPacket.TSHARK_FIELDS]
+
+def write_pcap(path, frames):
+    """
+    Writes the provided Ethernet frames to a .pcap file, one
+    second apart, and returns the timestamp of each.
+    """
+    timestamps = []
+    with open(path, 'wb') as pcap_file:
+        pcap_file.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0,
+                65535, 1))
+        for index, frame in enumerate(frames):
+            timestamps.append(BASE_TIMESTAMP + index)
+            pcap_file.write(struct.pack('<IIII', BASE_TIMESTAMP + index, 0,
+                    len(frame), len(frame)) + frame)
+    return timestamps
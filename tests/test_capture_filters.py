@@ -0,0 +1,37 @@
+"""
+Tests the BPF capture filters built from the settings.
+"""
+
+from capturer import capture_filters
+
+import pytest
+
+@pytest.fixture
+def settings(monkeypatch):
+    settings = {('filter', 'EnablePushdown'): True,
+            ('filter', 'ExcludeSubnets'): "",
+            ('filter', 'CaptureFilter'): ""}
+    monkeypatch.setattr(capture_filters, 'get_setting',
+            lambda section, key, value_type=None: settings[(section, key)])
+    return settings
+
+def test_bpf_filter_without_user_filters(settings):
+    assert capture_filters.build_bpf_filter() == \
+            "(ip or ip6) or ((vlan) and (ip or ip6))"
+
+def test_bpf_user_filters_applied_in_each_vlan_branch(settings):
+    settings[('filter', 'ExcludeSubnets')] = "10.0.0.0/8, 2001:db8::/32"
+    settings[('filter', 'CaptureFilter')] = "port 53"
+    # Everything after the vlan keyword is tested at VLAN tagged
+    # offsets, so untagged packets must be fully tested before it
+    user_filters = "(not net 10.0.0.0/8) and (not net 2001:db8::/32) " \
+            "and (port 53)"
+    assert capture_filters.build_bpf_filter() == \
+            "((ip or ip6) and %s) or ((vlan) and (ip or ip6) and %s)" % (
+            user_filters, user_filters)
+
+def test_bpf_filter_without_pushdown(settings):
+    settings[('filter', 'EnablePushdown')] = False
+    assert capture_filters.build_bpf_filter() is None
+    settings[('filter', 'CaptureFilter')] = "port 53"
+    assert capture_filters.build_bpf_filter() == "port 53"
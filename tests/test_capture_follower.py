@@ -0,0 +1,30 @@
+"""
+Tests that the capture follower holds back the packets of a file from
+its first frame left to pyshark, until the file is complete.
+"""
+
+from capturer.capture_follower import CaptureFollower
+from tests import pcap_fixture
+
+def test_packets_after_fallback_frame_held_until_file_complete(tmp_path):
+    frames = pcap_fixture.mixed_frames()
+    first_path = str(tmp_path / "capture-1.pcap")
+    pcap_fixture.write_pcap(first_path, frames)
+    follower = CaptureFollower(str(tmp_path))
+
+    # Frame 9 is left to pyshark, so frame 10 is held back
+    (tsa_packets, completed_files) = follower.poll()
+    assert [tsa_packet.src_port for tsa_packet in tsa_packets] == \
+            [40000, 53000, 53, 53001, 53, 40001]
+    assert completed_files == []
+
+    # Once the capturer rotates to the next file, the first is returned
+    # for merging, and the next file is only read by the following poll
+    pcap_fixture.write_pcap(str(tmp_path / "capture-2.pcap"), frames[:1])
+    (tsa_packets, completed_files) = follower.poll()
+    assert tsa_packets == []
+    assert completed_files == [(first_path, [9])]
+
+    (tsa_packets, completed_files) = follower.poll()
+    assert [tsa_packet.src_port for tsa_packet in tsa_packets] == [40000]
+    assert completed_files == []
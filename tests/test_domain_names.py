@@ -0,0 +1,19 @@
+"""
+Tests the registered domain names looked up in the public suffix trie.
+"""
+
+from analyzer.domain_names import get_registered_domain
+
+import pytest
+
+@pytest.mark.parametrize('host_name, domain', [
+    ("www.example.com", "example.com"),
+    ("www.news.bbc.co.uk", "bbc.co.uk"),
+    ("a.b.example.com.au", "example.com.au"),
+    # Wildcard entry (*.ck)
+    ("x.y.z.ck", "y.z.ck"),
+    ("WWW.Example.COM", "example.com"),
+    ("localhost", None),
+])
+def test_registered_domain(host_name, domain):
+    assert get_registered_domain(host_name) == domain
@@ -0,0 +1,220 @@
+"""
+Tests the p0f proxy's API client and lookup cache against a fake p0f
+API server, which answers queries with canned responses on a Unix
+socket in a temporary directory.
+"""
+
+from capturer import p0f_proxy
+from capturer.p0f_proxy import P0fClient
+from capturer.utils import LRUCache
+
+import os
+import socket
+import tempfile
+import threading
+
+import pytest
+
+POSITIVE_TTL = 300
+NEGATIVE_TTL = 30
+
+class FakeP0fServer:
+    """
+    Serves the p0f API on a Unix socket. Hosts in known_hosts are
+    answered with a match for the provided OS name, and other hosts
+    with no match. If close_after is provided, each connection is
+    closed after that many responses, as p0f does with idle ones.
+    """
+
+    def __init__(self, socket_path, known_hosts, close_after=None):
+        self.socket_path = socket_path
+        self.known_hosts = known_hosts
+        self.close_after = close_after
+        self.queries = []
+        self.num_connections = 0
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(socket_path)
+        self._server.listen(1)
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._server.close()
+
+    def _serve(self):
+        while True:
+            try:
+                (conn, _) = self._server.accept()
+            except OSError:
+                return
+            self.num_connections += 1
+            with conn:
+                self._serve_connection(conn)
+
+    def _serve_connection(self, conn):
+        num_responses = 0
+        while self.close_after is None or num_responses < self.close_after:
+            query = b""
+            while len(query) < P0fClient.QUERY_FORMAT.size:
+                data = conn.recv(P0fClient.QUERY_FORMAT.size - len(query))
+                if not data:
+                    return
+                query += data
+            (_, address_type, address) = P0fClient.QUERY_FORMAT.unpack(query)
+            if address_type == 4:
+                host_ip = socket.inet_ntop(socket.AF_INET, address[:4])
+            else:
+                host_ip = socket.inet_ntop(socket.AF_INET6, address)
+            self.queries.append(host_ip)
+            conn.sendall(make_response(self.known_hosts.get(host_ip)))
+            num_responses += 1
+
+def make_response(os_name):
+    """
+    Returns a p0f API response frame matching a host running the
+    provided OS, or a no match frame if os_name is None.
+    """
+    status = P0fClient.STATUS_NO_MATCH if os_name is None else \
+            P0fClient.STATUS_OK
+    return P0fClient.RESPONSE_FORMAT.pack(P0fClient.RESPONSE_MAGIC, status,
+            0, 0, 0, 60, 0, 0, 0, 3, 0, 0, (os_name or "").encode('utf8'),
+            b"10", b"", b"", b"Ethernet", b"English")
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def socket_dir():
+    with tempfile.TemporaryDirectory() as directory:
+        yield directory
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+@pytest.fixture
+def start_proxy(socket_dir, clock, monkeypatch):
+    """
+    Returns a function starting a fake p0f server with the provided
+    arguments, and pointing the proxy (with a cache of the provided
+    size) at it. The proxy is reset afterwards.
+    """
+    settings = {'CacheTTLSeconds': POSITIVE_TTL,
+                'NegativeCacheTTLSeconds': NEGATIVE_TTL}
+    monkeypatch.setattr(p0f_proxy, 'get_setting',
+            lambda section, setting, type='string': settings[setting])
+    servers = []
+
+    def start(known_hosts, close_after=None, cache_size=None):
+        socket_path = os.path.join(socket_dir, "p0f.sock")
+        server = FakeP0fServer(socket_path, known_hosts, close_after)
+        servers.append(server)
+        p0f_proxy.p0f_db = P0fClient(socket_path)
+        p0f_proxy.info_cache = LRUCache(cache_size, clock=clock)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
+    p0f_proxy.cleanup()
+
+def test_known_host_is_cached(start_proxy):
+    server = start_proxy({'10.0.0.1': "Linux"})
+    info = p0f_proxy.get_security_info('10.0.0.1')
+    assert info['os_name'] == "Linux"
+    assert info['os_full_name'] == "Linux 10"
+    assert info['link_type'] == "Ethernet"
+    assert info['num_hops'] == 3
+    assert info['uptime'] == 60
+
+    assert p0f_proxy.get_security_info('10.0.0.1') == info
+    assert server.queries == ['10.0.0.1']
+    stats = p0f_proxy.get_cache_stats()
+    assert (stats['hits'], stats['misses'], stats['negative_hits'],
+            stats['queries']) == (1, 1, 0, 1)
+
+def test_unknown_host_is_cached(start_proxy):
+    server = start_proxy({})
+    assert p0f_proxy.get_security_info('10.0.0.2') is None
+    assert p0f_proxy.get_security_info('10.0.0.2') is None
+    assert server.queries == ['10.0.0.2']
+    stats = p0f_proxy.get_cache_stats()
+    assert (stats['hits'], stats['misses'], stats['negative_hits'],
+            stats['queries']) == (1, 1, 1, 1)
+
+def test_negative_hits_counted_from_several_threads(start_proxy):
+    # As the enrichment workers look hosts up concurrently
+    start_proxy({})
+    p0f_proxy.get_security_info('10.0.0.2')
+    def look_up():
+        for _ in range(2000):
+            p0f_proxy.get_security_info('10.0.0.2')
+    threads = [threading.Thread(target=look_up) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert p0f_proxy.get_cache_stats()['negative_hits'] == 8 * 2000
+
+def test_ipv6_host(start_proxy):
+    server = start_proxy({'2001:db8::1': "Windows"})
+    assert p0f_proxy.get_security_info('2001:db8::1')['os_name'] == "Windows"
+    assert server.queries == ['2001:db8::1']
+
+def test_entries_expire_after_their_ttl(start_proxy, clock):
+    server = start_proxy({'10.0.0.1': "Linux"})
+    p0f_proxy.get_security_info_batch(['10.0.0.1', '10.0.0.2'])
+
+    # Only the negative entry has expired
+    clock.now = NEGATIVE_TTL + 1
+    p0f_proxy.get_security_info_batch(['10.0.0.1', '10.0.0.2'])
+    assert server.queries == ['10.0.0.1', '10.0.0.2', '10.0.0.2']
+
+    clock.now = POSITIVE_TTL + 1
+    p0f_proxy.get_security_info_batch(['10.0.0.1'])
+    assert server.queries == ['10.0.0.1', '10.0.0.2', '10.0.0.2', '10.0.0.1']
+    stats = p0f_proxy.get_cache_stats()
+    assert stats['expirations'] == 2
+    assert stats['queries'] == 4
+
+def test_least_recently_used_entry_is_evicted(start_proxy):
+    server = start_proxy({'10.0.0.1': "Linux", '10.0.0.2': "Linux",
+            '10.0.0.3': "Linux"}, cache_size=2)
+    p0f_proxy.get_security_info('10.0.0.1')
+    p0f_proxy.get_security_info('10.0.0.2')
+    # Use 10.0.0.1, so that 10.0.0.2 is evicted instead
+    p0f_proxy.get_security_info('10.0.0.1')
+    p0f_proxy.get_security_info('10.0.0.3')
+    p0f_proxy.get_security_info('10.0.0.1')
+    p0f_proxy.get_security_info('10.0.0.2')
+    assert server.queries == ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.2']
+    stats = p0f_proxy.get_cache_stats()
+    assert stats['evictions'] == 2
+    assert stats['size'] == 2
+
+def test_batch_uses_one_connection(start_proxy):
+    server = start_proxy({'10.0.0.1': "Linux"})
+    infos = p0f_proxy.get_security_info_batch(['10.0.0.1', '10.0.0.2',
+            '10.0.0.3', '10.0.0.1'])
+    assert infos['10.0.0.1']['os_name'] == "Linux"
+    assert infos['10.0.0.2'] is None and infos['10.0.0.3'] is None
+    assert server.queries == ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+    assert server.num_connections == 1
+
+def test_reconnects_after_server_closes_connection(start_proxy):
+    server = start_proxy({'10.0.0.1': "Linux"}, close_after=1)
+    infos = p0f_proxy.get_security_info_batch(['10.0.0.1', '10.0.0.2',
+            '10.0.0.3'])
+    assert infos['10.0.0.1']['os_name'] == "Linux"
+    assert server.queries == ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+    assert server.num_connections == 3
+    assert p0f_proxy.get_cache_stats()['queries'] == 3
+
+def test_query_fails_without_server(socket_dir):
+    client = P0fClient(os.path.join(socket_dir, "missing.sock"))
+    with pytest.raises(OSError):
+        client.get_info('10.0.0.1')
@@ -0,0 +1,224 @@
+"""
+Tests that the native, tshark and pyshark readers produce the same
+packets from the same capture. The native reader is checked against
+known values, and the tshark and pyshark parse methods against it,
+both on hand-written inputs and, where tshark and pyshark are
+installed, on the fixture capture itself.
+"""
+
+from capturer import pcap_reader, tshark_reader, wireshark_proxy
+from capturer.tsa_packet import TSAPacket, TSAPacketParseException
+from tests import pcap_fixture
+
+from datetime import datetime
+
+import shutil
+
+import pytest
+
+# Fields of the packets in pcap_fixture.mixed_frames, by frame number.
+# Frames the parser rejects are missing, and the ICMP error (which the
+# native reader leaves to pyshark) is None.
+EXPECTED_FIELDS = {
+    1: {'ip_version': "ipv4", 'src_addr': "10.0.0.1",
+        'dst_addr': "93.184.216.34", 'protocol': "tcp", 'src_port': 40000,
+        'dst_port': 443, 'tcp_op': "SYN", 'application_type': "none"},
+    2: {'ip_version': "ipv6", 'src_addr': "2001:db8::1",
+        'dst_addr': "2001:db8::53", 'protocol': "udp", 'src_port': 53000,
+        'dst_port': 53, 'application_type': "dns",
+        'dns_query_resp': "query",
+        'dns_query_names': ["example.com", "example.org"]},
+    3: {'ip_version': "ipv6", 'src_addr': "2001:db8::53",
+        'dst_addr': "2001:db8::1", 'protocol': "udp", 'src_port': 53,
+        'dst_port': 53000, 'application_type': "dns",
+        'dns_query_resp': "response", 'dns_query_names': ["example.com"],
+        'dns_resp_ip': "2606:2800:220:1::1",
+        'dns_resp_ips': ["2606:2800:220:1::1"], 'dns_resp_ttl': 300},
+    4: {'ip_version': "ipv4", 'src_addr': "10.0.0.1",
+        'dst_addr': "10.0.0.53", 'protocol': "udp", 'src_port': 53001,
+        'dst_port': 53, 'application_type': "dns",
+        'dns_query_resp': "query", 'dns_query_names': ["example.net"]},
+    5: {'ip_version': "ipv4", 'src_addr': "10.0.0.53",
+        'dst_addr': "10.0.0.1", 'protocol': "udp", 'src_port': 53,
+        'dst_port': 53001, 'application_type': "dns",
+        'dns_query_resp': "response", 'dns_query_names': ["example.net"],
+        'dns_resp_ip': "93.184.216.35", 'dns_resp_ips': ["93.184.216.35"],
+        'dns_resp_ttl': 60},
+    6: {'ip_version': "ipv4", 'src_addr': "10.0.0.1",
+        'dst_addr': "93.184.216.34", 'protocol': "tcp", 'src_port': 40001,
+        'dst_port': 80, 'tcp_op': "ACK", 'application_type': "http",
+        'http_req_resp': "request", 'http_method': "GET"},
+    9: None,
+    10: {'ip_version': "ipv6", 'src_addr': "2001:db8::1",
+        'dst_addr': "2001:db8::2", 'protocol': "tcp", 'src_port': 40003,
+        'dst_port': 22, 'tcp_op': "SYN-ACK", 'application_type': "none"},
+}
+
+@pytest.fixture(scope='module')
+def capture(tmp_path_factory):
+    """
+    Writes the mixed fixture capture, and returns its path, the frames
+    in it, and the packets the native reader parsed out of it by frame
+    number (None for frames left to pyshark).
+    """
+    cap_filename = str(tmp_path_factory.mktemp("readers") / "mixed.pcap")
+    frames = pcap_fixture.mixed_frames()
+    pcap_fixture.write_pcap(cap_filename, frames)
+    capture_file = pcap_reader.open_capture(cap_filename)
+    try:
+        native_packets = dict(capture_file.parse())
+    finally:
+        capture_file.close()
+    return (cap_filename, frames, native_packets)
+
+def test_native_reader(capture):
+    (_, frames, native_packets) = capture
+    assert sorted(native_packets) == sorted(EXPECTED_FIELDS)
+    for frame_number, fields in EXPECTED_FIELDS.items():
+        tsa_packet = native_packets[frame_number]
+        if fields is None:
+            assert tsa_packet is None
+            continue
+        expected = dict(fields, length=len(frames[frame_number - 1]),
+                timestamp=datetime.fromtimestamp(
+                    pcap_fixture.BASE_TIMESTAMP + frame_number - 1))
+        assert dict(tsa_packet.items()) == dict(TSAPacket(expected).items())
+
+def test_tshark_fields_match_native(capture):
+    (_, frames, native_packets) = capture
+    rows = {
+        2: pcap_fixture.tshark_fields(1, len(frames[1]),
+            "eth:ethertype:ipv6:udp:dns", ipv6_src="2001:db8::1",
+            ipv6_dst="2001:db8::53",
+            udp_srcport="53000", udp_dstport="53",
+            dns_qry_name="example.com,example.org"),
+        3: pcap_fixture.tshark_fields(2, len(frames[2]),
+            "eth:ethertype:ipv6:udp:dns", ipv6_src="2001:db8::53",
+            ipv6_dst="2001:db8::1",
+            udp_srcport="53", udp_dstport="53000",
+            dns_qry_name="example.com", dns_resp_name="example.com",
+            dns_aaaa="2606:2800:220:1::1", dns_count_answers="1",
+            dns_resp_type="28", dns_resp_ttl="300"),
+        5: pcap_fixture.tshark_fields(4, len(frames[4]),
+            "eth:ethertype:ip:udp:dns", ip_src="10.0.0.53",
+            ip_dst="10.0.0.1",
+            udp_srcport="53", udp_dstport="53001",
+            dns_qry_name="example.net", dns_resp_name="example.net",
+            dns_a="93.184.216.35", dns_count_answers="1",
+            dns_resp_type="1", dns_resp_ttl="60"),
+        10: pcap_fixture.tshark_fields(9, len(frames[9]),
+            "eth:ethertype:ipv6:tcp", ipv6_src="2001:db8::1",
+            ipv6_dst="2001:db8::2",
+            tcp_srcport="40003", tcp_dstport="22", tcp_flags_syn="True",
+            tcp_flags_ack="True"),
+    }
+    for frame_number, values in rows.items():
+        assert TSAPacket.parse_tshark_fields(values) == \
+                native_packets[frame_number]
+
+class FakeField:
+    def __init__(self, show):
+        self.show = show
+
+class FakeLayer:
+    """
+    Stands in for a pyshark layer, with the provided field values
+    (lists of every occurrence, keyed by pyshark field name).
+    """
+
+    def __init__(self, layer_name, **fields):
+        self.layer_name = layer_name
+        self.fields = fields
+        self.field_names = list(fields)
+
+    def __getattr__(self, name):
+        if name in self.__dict__.get('fields', {}):
+            return self.fields[name][0]
+        raise AttributeError(name)
+
+    def get_field(self, name):
+        field = FakeField(self.fields[name][0])
+        field.all_fields = [FakeField(show) for show in self.fields[name]]
+        return field
+
+class FakePacket:
+    """
+    Stands in for a pyshark packet made of the provided layers.
+    """
+
+    def __init__(self, index, length, layers):
+        self.layers = layers
+        self.sniff_timestamp = str(pcap_fixture.BASE_TIMESTAMP + index)
+        self.length = self.captured_length = str(length)
+
+    def __contains__(self, layer_name):
+        return any(layer.layer_name == layer_name for layer in self.layers)
+
+    def __getattr__(self, name):
+        for layer in self.__dict__.get('layers', []):
+            if layer.layer_name == name:
+                return layer
+        raise AttributeError(name)
+
+def test_pyshark_packets_match_native(capture):
+    (_, frames, native_packets) = capture
+    packets = {
+        2: FakePacket(1, len(frames[1]), [FakeLayer('eth'),
+            FakeLayer('ipv6', src=["2001:db8::1"], dst=["2001:db8::53"]),
+            FakeLayer('udp', srcport=["53000"], dstport=["53"]),
+            FakeLayer('dns', qry_name=["example.com", "example.org"])]),
+        3: FakePacket(2, len(frames[2]), [FakeLayer('eth'),
+            FakeLayer('ipv6', src=["2001:db8::53"], dst=["2001:db8::1"]),
+            FakeLayer('udp', srcport=["53"], dstport=["53000"]),
+            FakeLayer('dns', qry_name=["example.com"],
+                resp_name=["example.com"], aaaa=["2606:2800:220:1::1"],
+                count_answers=["1"], resp_type=["28"], resp_ttl=["300"])]),
+        4: FakePacket(3, len(frames[3]), [FakeLayer('eth'),
+            FakeLayer('ip', version=["4"], src=["10.0.0.1"],
+                dst=["10.0.0.53"]),
+            FakeLayer('udp', srcport=["53001"], dstport=["53"]),
+            FakeLayer('dns', qry_name=["example.net"])]),
+    }
+    for frame_number, packet in packets.items():
+        assert TSAPacket.parse_pyshark_packet(packet) == \
+                native_packets[frame_number]
+
+def parse_or_none(parse_packet, packet):
+    try:
+        return parse_packet(packet)
+    except TSAPacketParseException:
+        return None
+
+def check_matches_native(native_packets, parsed_packets):
+    """
+    Checks that packets parsed by another reader (by frame number,
+    None for rejected frames) match those of the native reader, other
+    than for the frames the native reader leaves to pyshark.
+    """
+    for frame_number, tsa_packet in parsed_packets.items():
+        if frame_number not in native_packets:
+            assert tsa_packet is None
+        elif native_packets[frame_number] is not None:
+            assert tsa_packet == native_packets[frame_number]
+        else:
+            assert tsa_packet is not None
+
+@pytest.mark.skipif(shutil.which('tshark') is None,
+        reason="tshark is not installed")
+def test_tshark_reader_matches_native(capture):
+    (cap_filename, frames, native_packets) = capture
+    parsed_packets = {index + 1: parse_or_none(TSAPacket.parse_tshark_fields,
+            values) for index, values in
+            enumerate(tshark_reader.iter_file_fields(cap_filename))}
+    assert len(parsed_packets) == len(frames)
+    check_matches_native(native_packets, parsed_packets)
+
+@pytest.mark.skipif(shutil.which('tshark') is None,
+        reason="tshark is not installed")
+def test_pyshark_reader_matches_native(capture):
+    (cap_filename, frames, native_packets) = capture
+    parsed_packets = {int(packet.number): parse_or_none(
+            TSAPacket.parse_pyshark_packet, packet) for packet in
+            wireshark_proxy._iter_pyshark_file(cap_filename)}
+    assert len(parsed_packets) == len(frames)
+    check_matches_native(native_packets, parsed_packets)
@@ -0,0 +1,130 @@
+"""
+Tests that files read natively reach the packet buffer in frame order,
+including the frames the native reader leaves to pyshark.
+"""
+
+from capturer import capture_filters, pcap_reader, wireshark_proxy
+from capturer.packet_buffer import PacketBuffer
+from capturer.tsa_packet import TSAPacket
+from tests import pcap_fixture
+
+from datetime import datetime
+
+import pytest
+
+class AppendRecorder:
+    """
+    Buffer listener recording every packet placed into
+    and removed from the buffer.
+    """
+
+    def __init__(self):
+        self.appended = []
+        self.evicted = []
+
+    def on_append(self, tsa_packet):
+        self.appended.append(tsa_packet)
+
+    def on_evict(self, tsa_packet):
+        self.evicted.append(tsa_packet)
+
+def make_fallback_packet(frame_number, timestamp):
+    return TSAPacket({'timestamp': datetime.fromtimestamp(timestamp),
+            'ip_version': "ipv4", 'src_addr': "10.0.0.53",
+            'dst_addr': "10.0.0.1", 'protocol': "udp",
+            'src_port': frame_number, 'dst_port': 53,
+            'application_type': "none", 'length': 70})
+
+@pytest.fixture
+def capture(tmp_path, monkeypatch):
+    """
+    Writes a capture of several copies of the mixed fixture frames,
+    and returns its path along with the packets expected in the buffer,
+    with the pyshark fallback replaced by canned packets.
+    """
+    cap_filename = str(tmp_path / "mixed.pcap")
+    timestamps = pcap_fixture.write_pcap(cap_filename,
+            pcap_fixture.mixed_frames() * 5)
+
+    expected = []
+    fallback_packets = {}
+    capture_file = pcap_reader.open_capture(cap_filename)
+    try:
+        for frame_number, tsa_packet in capture_file.parse():
+            if tsa_packet is None:
+                tsa_packet = make_fallback_packet(frame_number,
+                        timestamps[frame_number - 1])
+                fallback_packets[frame_number] = tsa_packet
+            expected.append(tsa_packet)
+    finally:
+        capture_file.close()
+
+    def parse_fallback_frames(parsed_filename, fallback_frames):
+        assert parsed_filename == cap_filename
+        assert fallback_frames == sorted(fallback_packets)
+        return fallback_packets
+    monkeypatch.setattr(wireshark_proxy, '_parse_fallback_frames',
+            parse_fallback_frames)
+    return (cap_filename, expected)
+
+@pytest.fixture
+def settings(monkeypatch):
+    """
+    Replaces the settings the native reader uses with a dictionary
+    (keyed by (section, key) tuples), which is returned.
+    """
+    settings = {('app', 'ParserWorkers'): 1,
+            ('filter', 'ExcludeSubnets'): ""}
+    def get_setting(section, key, value_type=None):
+        return settings[(section, key)]
+    monkeypatch.setattr(wireshark_proxy, 'get_setting', get_setting)
+    monkeypatch.setattr(capture_filters, 'get_setting', get_setting)
+    return settings
+
+def use_buffer(monkeypatch, packet_buffer):
+    monkeypatch.setattr(wireshark_proxy, 'packet_buffer', packet_buffer)
+    monkeypatch.setattr(wireshark_proxy, 'cache_writer', None)
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_fallback_packets_merged_in_frame_order(capture, settings,
+        monkeypatch, num_workers):
+    (cap_filename, expected) = capture
+    settings[('app', 'ParserWorkers')] = num_workers
+    packet_buffer = PacketBuffer()
+    recorder = AppendRecorder()
+    packet_buffer.add_listener(recorder)
+    use_buffer(monkeypatch, packet_buffer)
+
+    assert wireshark_proxy._read_file_native(cap_filename) == len(expected)
+    assert packet_buffer.read_tail() == expected
+    # Each packet is placed into the buffer exactly once
+    assert recorder.appended == expected
+    assert recorder.evicted == []
+
+@pytest.mark.parametrize("maxlen", [0, 7])
+def test_parallel_read_keeps_packets_up_to_maxlen(capture, settings,
+        monkeypatch, maxlen):
+    # A MaxPackets setting of 0 means there is no limit
+    (cap_filename, expected) = capture
+    settings[('app', 'ParserWorkers')] = 2
+    packet_buffer = PacketBuffer(maxlen=maxlen)
+    use_buffer(monkeypatch, packet_buffer)
+
+    assert wireshark_proxy._read_file_native(cap_filename) == len(expected)
+    assert packet_buffer.read_tail() == expected[-maxlen:]
+
+def test_merged_packets_resume_at_first_fallback_frame(capture):
+    # As when following a directory, once the file is complete
+    (cap_filename, expected) = capture
+    capture_file = pcap_reader.open_capture(cap_filename)
+    try:
+        fallback_frames = [frame_number for frame_number, tsa_packet
+                in capture_file.parse() if tsa_packet is None]
+        merged_packets = list(wireshark_proxy._iter_merged_packets(
+                capture_file, cap_filename, fallback_frames,
+                fallback_frames[0]))
+    finally:
+        capture_file.close()
+    # The first fallback frame (frame 9) follows 6 packets
+    assert fallback_frames[0] == 9
+    assert merged_packets == expected[6:]
@@ -41,6 +41,8 @@ def get_index_page():
         dcc.Link('Maps', href='/maps', style=styles.LINK),
         html.Br(),
         dcc.Link('Metrics', href='/metrics', style=styles.LINK),
+        html.Br(),
+        dcc.Link('Security', href='/security', style=styles.LINK),
     ])
 
 
@@ -116,9 +118,22 @@ def get_metrics_page():
 
 
 def get_security_page():
+    suspects = tsa_ui.get_curr_state().get(tsa_ui.SECURITY_SUSPECTS, [])
+    suspect_items = [html.Li('{}: {}'.format(addr, reason))
+                     for addr, reason in suspects]
+
+    alerts = tsa_ui.get_curr_state().get(tsa_ui.SECURITY_ALERTS, [])
+    alert_items = [html.Li('{} ({}): {} since {}'.format(addr, kind, reason,
+                                                          flagged_time))
+                   for kind, addr, reason, flagged_time in alerts]
+
     return html.Div([
         html.H1('Security'),
         dcc.Link('Back to Main', href='/', style=styles.LINK),
+        html.H3('Current Alerts'),
+        html.Ul(alert_items or [html.Li('None')]),
+        html.H3('Suspected Hosts'),
+        html.Ul(suspect_items or [html.Li('None')]),
     ])
 
 def get_map_page():
@@ -1,19 +1,25 @@
 
 # TSA libraries
-from capturer import p0f_proxy, wireshark_proxy
+from capturer import p0f_proxy, telemetry, wireshark_proxy
+from analyzer.aggregate import StreamingAggregates, build_ip_table
+from analyzer.dns_index import DNSIndex
 from analyzer.country import get_country_to_packet_count, get_country_to_traffic_size
 from analyzer.dns import get_tldn_to_packet_count, get_tldn_to_traffic_size, consolidate_fqdn_data
-from analyzer.metrics import get_bandwidth_traffic_volume, AVERAGE_BANDWIDTH, TRAFFIC_VOLUME_DATA, BANDWIDTH_DATA
+from analyzer.security import SecurityDetector, build_security_counters, get_syn_flood_attackers, get_ddos_victims, get_reflection_victims
+from analyzer.metrics import RollupStore, get_bandwidth_traffic_volume, AVERAGE_BANDWIDTH, TRAFFIC_VOLUME_DATA, BANDWIDTH_DATA
 from settings import get_setting
 
 # DASH ui libraries and plotly
 import dash
 import dash_core_components as dcc
 from dash.dependencies import Input, Output, State
+import flask
 import plotly.graph_objs as go
 
 
 # Python builtin libraries
+import collections
+from datetime import timedelta
 import threading
 from time import sleep
 
@@ -24,11 +30,34 @@ from . import styles
 # Global variables
 state = {}
 
+# Aggregates of the capture buffer, kept up to date as packets
+# are captured (during live captures only)
+streaming_aggregates = None
+
+# Names of the addresses in the DNS responses captured, including
+# those evicted from the buffer (during live captures only)
+dns_index = None
+
+# Per-second traffic counters of the whole capture, including
+# the packets evicted from the buffer (during live captures only)
+rollup_store = None
+
+# Per-host SYN / ACK and DNS counters of the last few seconds of
+# the capture, flagging attacks as they start (live captures only)
+security_detector = None
+
+# Alerts raised by security_detector on the capture thread, waiting
+# to be reported by the UI state thread (see report_security_alerts).
+# Bounded, so the oldest are dropped if the UI thread falls behind
+pending_security_alerts = collections.deque(maxlen=1000)
+
 COUNTRY_COUNTS = "country_counts"
 TLDN_COUNTS = "tldn_counts"
 COUNTRY_TRAFFIC = "country_traffic"
 TLDN_TRAFFIC = "tldn_traffic"
 TLDN_OVERALL_INFO = "tldn_overall_info"
+SECURITY_SUSPECTS = "security_suspects"
+SECURITY_ALERTS = "security_alerts"
 
 STATE_UPDATE_RATE = 10 # seconds
 
@@ -40,7 +69,22 @@ app.layout = layouts.get_app_layout()
 
 
 def start_ui(live_capture=False):
+    global streaming_aggregates, rollup_store, dns_index, security_detector
     if live_capture:
+        dns_index = DNSIndex(max_bytes=get_setting('dns', 'IndexMaxMemoryMB',
+                'int') * 1024 * 1024 or None, min_ttl=get_setting('dns',
+                'MinTTLSeconds', 'int'))
+        wireshark_proxy.add_buffer_listener(dns_index)
+        streaming_aggregates = StreamingAggregates(dns_index)
+        wireshark_proxy.add_buffer_listener(streaming_aggregates)
+        rollup_store = RollupStore()
+        wireshark_proxy.add_buffer_listener(rollup_store)
+        security_detector = SecurityDetector(
+                window_seconds=get_setting('security', 'WindowSeconds', 'int'),
+                bucket_seconds=get_setting('security', 'BucketSeconds', 'int'),
+                alert_callback=queue_security_alert)
+        wireshark_proxy.add_buffer_listener(security_detector)
+
         # start up background thread to periodically update ui state.
         ui_state_thread = threading.Thread(target=updater)
         ui_state_thread.start()
@@ -49,28 +93,72 @@ def start_ui(live_capture=False):
 
     app.run_server(debug=get_setting('app', 'EnableDebugMode'))
 
+def queue_security_alert(kind, addr, reason, timestamp):
+    # Called on the capture thread, with the capture buffer locked
+    pending_security_alerts.append((kind, addr, reason, timestamp))
+
+def report_security_alerts():
+    """
+    Prints the alerts raised since the last call, and stores the
+    hosts currently flagged in the UI state.
+    """
+    while pending_security_alerts:
+        (kind, addr, reason, timestamp) = pending_security_alerts.popleft()
+        print("Security alert ({0}): {1}: {2} ({3})".format(timestamp, kind,
+                addr, reason))
+    state[SECURITY_ALERTS] = security_detector.get_alerts()
+
 def updater():
     sleep(1)
     update_ui_state()
 
-    # update state every UPDATE_RATE seconds
+    # update state every UPDATE_RATE seconds, reporting
+    # security alerts every second in between
     while True:
-        sleep(STATE_UPDATE_RATE)
+        for _ in range(STATE_UPDATE_RATE):
+            report_security_alerts()
+            sleep(1)
         update_ui_state()
 
 def update_ui_state():
 
     global state
 
-    packets = wireshark_proxy.read_packets().get_packets()
-
-    country_count_tups = list(get_country_to_packet_count(packets).items())
-    country_traffic_tups = list(get_country_to_traffic_size(packets).items())
-    tldn_count_tups = list(get_tldn_to_packet_count(packets).items())
-    tldn_traffic_tups = list(get_tldn_to_traffic_size(packets).items())
-    tldn_overall_info = list(consolidate_fqdn_data(packets).items())
-
-    get_traffic_info = get_bandwidth_traffic_volume(packets, buckets=25)
+    # During live captures, the analysis functions only need the
+    # snapshots of the aggregates, so the buffer is not copied
+    if streaming_aggregates:
+        packets = None
+        (ip_table, security_counters) = streaming_aggregates.snapshot()
+    else:
+        packets = wireshark_proxy.read_packets().get_packets()
+        ip_table = build_ip_table(packets)
+        security_counters = build_security_counters(packets)
+
+    country_count_tups = list(get_country_to_packet_count(packets,
+            ip_table).items())
+    country_traffic_tups = list(get_country_to_traffic_size(packets,
+            ip_table).items())
+    tldn_count_tups = list(get_tldn_to_packet_count(packets,
+            ip_table).items())
+    tldn_traffic_tups = list(get_tldn_to_traffic_size(packets,
+            ip_table).items())
+    tldn_overall_info = list(consolidate_fqdn_data(packets, ip_table).items())
+    security_suspects = \
+            get_syn_flood_attackers(packets, security_counters) + \
+            get_ddos_victims(packets, security_counters) + \
+            get_reflection_victims(packets, security_counters)
+
+    if rollup_store:
+        window_seconds = get_setting('app', 'MetricsWindowSeconds', 'int')
+        start_time = None
+        if window_seconds and rollup_store.latest_time:
+            start_time = max(rollup_store.earliest_time,
+                    rollup_store.latest_time - timedelta(
+                        seconds=window_seconds))
+        get_traffic_info = rollup_store.get_bandwidth_traffic_volume(
+                start_time, buckets=25)
+    else:
+        get_traffic_info = get_bandwidth_traffic_volume(packets, buckets=25)
 
     state[COUNTRY_COUNTS] = country_count_tups
     state[COUNTRY_TRAFFIC] = country_traffic_tups
@@ -78,6 +166,7 @@ def update_ui_state():
     state[TLDN_COUNTS] = tldn_count_tups
     state[TLDN_TRAFFIC] = tldn_traffic_tups
     state[TLDN_OVERALL_INFO] = tldn_overall_info
+    state[SECURITY_SUSPECTS] = security_suspects
 
     state[BANDWIDTH_DATA] = get_traffic_info[BANDWIDTH_DATA]
     state[AVERAGE_BANDWIDTH] = get_traffic_info[AVERAGE_BANDWIDTH]
@@ -200,6 +289,16 @@ def update_page(pathname):
         return layouts.get_map_page()
     elif pathname == '/metrics':
         return layouts.get_metrics_page()
+    elif pathname == '/security':
+        return layouts.get_security_page()
     else:
         return layouts.get_index_page()
 
+
+# Serve the capture pipeline telemetry in Prometheus text format.
+# Registered on the underlying Flask server, outside of the Dash pages
+# (which already use /metrics for the metrics page).
+@app.server.route('/telemetry')
+def serve_telemetry():
+    return flask.Response(telemetry.format_prometheus(),
+                          mimetype='text/plain; version=0.0.4')